@@ -1,12 +1,38 @@
 import requests
+import requests.adapters
 import json
 import secrets
 import sqlite3
 import random
 import plotly.plotly as py
 import plotly.graph_objs as go
+import plotly.offline
+import plotly.utils
 from plotly.graph_objs import *
 import webbrowser
+import os
+import mmap
+import time
+import atexit
+import collections
+import threading
+import concurrent.futures
+import multiprocessing
+import queue
+import tempfile
+import contextlib
+import math
+import numpy as np
+import array
+import codecs
+import itertools
+import sys
+import argparse
+import hashlib
+import re
+import cProfile
+import pstats
+import heapq
 
 #A user will enter a search for a place. This will provide a rating and/or review back to the user, 
 #along with a list of nearby places with nearby ratings and images if found. 
@@ -20,19 +46,924 @@ flickr_apikey = secrets.FLICKR_KEY
 mapbox_apikey = secrets.mapbox_accesstoken
 
 
+#--------------------------------------------------------------------------------------------
+#-----INSTRUMENTATION
+#--------------------------------------------------------------------------------------------
+#Timers and counters around the stages of a search: "with timed_stage('http.yelp'):" adds the block's time to
+#that stage and count_event('cache.hit') bumps a counter. Stages running on several threads add up, so a stage
+#can take longer than the search. measure() wraps one search or display: it prints a per-stage summary and
+#appends the stages and counters as one JSON line to METRICS_FNAME ("python3 final.py metrics" aggregates them).
+METRICS = True #False turns timed_stage/count_event/measure into no-ops (final_server.py runs without them)
+METRICS_SUMMARY = True #print the per-stage summary at the end of each measure()
+METRICS_FNAME = 'metrics.jsonl'
+PROFILE = False #also run each measure() under cProfile, saving the stats to PROFILE_DIR
+PROFILE_DIR = 'profiles'
+PROFILE_TOP = 15 #functions printed from each profile, by cumulative time
+STAGE_HOOKS = [] #callables hook(stage, seconds) run as each timed stage ends, e.g. to trace every call
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {} #stage -> [calls, seconds, max seconds]
+            self.counters = {}
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, 0.0]
+            timer = self.stages[stage]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            stages = dict((stage, {'calls': t[0], 'seconds': t[1], 'max': t[2]}) for (stage, t) in self.stages.items())
+            return (stages, dict(self.counters))
+
+STAGE_METRICS = Metrics()
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    if not METRICS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_METRICS.add_time(stage, seconds)
+        for hook in STAGE_HOOKS:
+            hook(stage, seconds)
+
+def count_event(counter, n=1):
+    if METRICS:
+        STAGE_METRICS.count(counter, n)
+
+#Nearest-rank percentile
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[max(0, int(math.ceil(q / 100.0 * len(ordered))) - 1)]
+
+def print_metrics(label, wall, stages, counters):
+    print("{} took {:.2f}s".format(label, wall))
+    for stage in sorted(stages, key=lambda ea: -stages[ea]['seconds']):
+        t = stages[stage]
+        print("  {:22} {:6} calls {:9.3f}s  max {:7.3f}s".format(stage, t['calls'], t['seconds'], t['max']))
+    if len(counters) > 0:
+        print("  " + ", ".join("{} {}".format(counter, counters[counter]) for counter in sorted(counters)))
+
+#Measures one search or display (kind, plus fields such as the search term, go into the metrics line appended
+#to fname, METRICS_FNAME by default). Only one measure() should run at a time: it resets the shared stage timers.
+@contextlib.contextmanager
+def measure(kind, fname=None, **fields):
+    if not METRICS:
+        yield
+        return
+    STAGE_METRICS.reset()
+    profiler = cProfile.Profile() if PROFILE else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable() #profiles this thread only: pool threads show up as time waiting on futures
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        record = {'time': time.time(), 'kind': kind}
+        record.update(fields)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            record['profile'] = os.path.join(PROFILE_DIR, '{}-{}.prof'.format(kind, time.strftime('%Y%m%d-%H%M%S')))
+            profiler.dump_stats(record['profile'])
+        (stages, counters) = STAGE_METRICS.snapshot()
+        record.update({'wall': wall, 'stages': stages, 'counters': counters})
+        if METRICS_SUMMARY:
+            print('-----------')
+            print_metrics(' '.join([kind.capitalize()] + ["'{}'".format(v) for v in fields.values()]), wall, stages, counters)
+            if profiler is not None:
+                print("Profile saved to {}".format(record['profile']))
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        with open(fname or METRICS_FNAME, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+#Totals per stage and counter over the metrics lines of one kind, with p50/p95 of the wall time
+def aggregate_metrics(fname=METRICS_FNAME, kind='search'):
+    walls = []
+    stages = {}
+    counters = {}
+    with open(fname) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] != kind:
+                continue
+            walls.append(record['wall'])
+            for (stage, t) in record['stages'].items():
+                total = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max': 0.0})
+                total['calls'] += t['calls']
+                total['seconds'] += t['seconds']
+                total['max'] = max(total['max'], t['max'])
+            for (counter, n) in record['counters'].items():
+                counters[counter] = counters.get(counter, 0) + n
+    if len(walls) == 0:
+        return None
+    return {'runs': len(walls), 'wall': sum(walls), 'wall_p50': percentile(walls, 50), 'wall_p95': percentile(walls, 95),
+        'stages': stages, 'counters': counters}
+
+
 #--------------------------------------------------------------------------------------------
 #-----CACHING & REQUESTING DATA
 #--------------------------------------------------------------------------------------------
 CACHE_FNAME = 'cache.json'
-try:
-    cache_file = open(CACHE_FNAME, 'r')
-    cache_contents = cache_file.read()
-    CACHE_DICTION = json.loads(cache_contents)
-    cache_file.close()
-except:
-    CACHE_DICTION = {}
-    
-
+CACHE_BACKEND = 'log' # 'json' (legacy whole-file rewrite), 'log' (append-only log + index) or 'sqlite'
+CACHE_LOG_FNAME = 'cache.log'
+CACHE_INDEX_FNAME = 'cache.idx'
+CACHE_DB_FNAME = 'cache.db'
+CACHE_STATS_FNAME = 'cache_stats.json'
+
+GOOGLE_TEXTSEARCH_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
+YELP_SEARCH_URL = 'https://api.yelp.com/v3/businesses/search'
+FLICKR_REST_URL = "https://api.flickr.com/services/rest/"
+
+#Cache keys start with the base url of the request, which tells us the provider
+CACHE_PROVIDERS = {
+    GOOGLE_TEXTSEARCH_URL: 'google',
+    YELP_SEARCH_URL: 'yelp',
+    FLICKR_REST_URL: 'flickr',
+}
+#Seconds an entry stays fresh, per provider (None = never expires)
+CACHE_TTLS = {
+    'google': 30 * 24 * 3600,
+    'yelp': 7 * 24 * 3600, #ratings and review counts go stale quickly
+    'flickr': 30 * 24 * 3600,
+    'other': None,
+}
+CACHE_MAX_BYTES = 512 * 1024 * 1024 #upper bound on the encoded size of all live entries
+CACHE_EVICTION = 'lru' # 'lru' or 'lfu'
+
+
+#Legacy store: the whole cache lives in memory and cache.json is rewritten on every new entry
+#readonly=True (in every store) refuses writes and deletes, for processes that only read another's cache
+class JsonFileCache():
+    def __init__(self, fname=CACHE_FNAME, readonly=False):
+        self.fname = fname
+        self.readonly = readonly
+        try:
+            cache_file = open(self.fname, 'r')
+            cache_contents = cache_file.read()
+            self.diction = json.loads(cache_contents)
+            cache_file.close()
+            self.loaded = os.path.getmtime(self.fname) #the file keeps no per-entry times
+        except:
+            self.diction = {}
+            self.loaded = time.time()
+        self.created = {}
+
+    def write(self):
+        dumped_json_cache = json.dumps(self.diction) #using json as dictionary format in the cache
+        fw = open(self.fname,"w")
+        fw.write(dumped_json_cache)
+        fw.close()
+
+    def __contains__(self, key):
+        return key in self.diction
+
+    def __getitem__(self, key):
+        return self.diction[key]
+
+    def __setitem__(self, key, value):
+        check_writable(self)
+        self.diction[key] = value
+        self.created[key] = time.time()
+        self.write()
+
+    #Stores a value given as the bytes of its JSON text, in one or more chunks (joined: the value is kept in memory anyway)
+    def set_raw(self, key, chunks, created=None):
+        self[key] = json.loads(b''.join(chunks).decode('utf-8'))
+        if created is not None:
+            self.created[key] = created
+
+    def __len__(self):
+        return len(self.diction)
+
+    def keys(self):
+        return list(self.diction.keys())
+
+    #(size in bytes, time written) of one entry
+    def stat(self, key):
+        return (len(json.dumps(self.diction[key])), self.created.get(key, self.loaded))
+
+    def entries(self):
+        for key in self.diction:
+            size, created = self.stat(key)
+            yield (key, size, created)
+
+    def delete(self, key):
+        check_writable(self)
+        del self.diction[key]
+        self.created.pop(key, None)
+        self.write()
+
+    def close(self):
+        pass
+
+
+#Append-only store: each value is appended to the log file and its (offset, length, time) appended to the index file,
+#so a new entry only writes its own bytes. Only the index is read on open (key -> (offset, length, time)); values are
+#decoded one at a time out of a read-only memory map of the log, so resident memory does not grow with the cache.
+#Deleting appends a tombstone to the index; the log is compacted once dead bytes outweigh live ones.
+class AppendLogCache():
+    compact_min_bytes = 1024 * 1024
+
+    def __init__(self, log_fname=CACHE_LOG_FNAME, index_fname=CACHE_INDEX_FNAME, readonly=False):
+        self.log_fname = log_fname
+        self.index_fname = index_fname
+        self.readonly = readonly
+        self.index = {}
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        if os.path.exists(self.index_fname):
+            written = os.path.getmtime(self.index_fname) #for index lines written before times were recorded
+            with open(self.index_fname, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue #partial line left by an interrupted write
+                    if len(entry) == 3:
+                        entry.append(written)
+                    key, offset, length, created = entry
+                    if key in self.index:
+                        self.dead_bytes += self.index[key][1]
+                        self.live_bytes -= self.index[key][1]
+                        del self.index[key]
+                    if offset >= 0: #offset -1 is a tombstone
+                        self.index[key] = (offset, length, created)
+                        self.live_bytes += length
+        if readonly: #a snapshot: the open log stays readable even if the writer compacts it
+            self.log_file = open(self.log_fname, 'rb') if len(self.index) > 0 else None
+            self.index_file = None
+        else:
+            self.log_file = open(self.log_fname, 'ab+')
+            self.index_file = open(self.index_fname, 'a')
+        self.log_map = None
+
+    #(re)maps the log when an entry lies past the end of the current map, i.e. it was appended after mapping
+    def get_map(self, end):
+        if self.log_map is None or len(self.log_map) < end:
+            if self.log_map is not None:
+                self.log_map.close()
+            self.log_map = mmap.mmap(self.log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.log_map
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        offset, length, created = self.index[key]
+        log_map = self.get_map(offset + length)
+        return json.loads(log_map[offset:offset + length].decode('utf-8'))
+
+    def append_index(self, key, offset, length, created):
+        self.index_file.write(json.dumps([key, offset, length, created]) + '\n')
+        self.index_file.flush()
+
+    def __setitem__(self, key, value):
+        self.set_raw(key, [json.dumps(value).encode('utf-8')])
+
+    #Appends a value given as the bytes of its JSON text; the chunks (any iterable) are written as they come, without joining
+    #created backdates the entry (a rekeyed entry keeps the age of the one it replaces)
+    def set_raw(self, key, chunks, created=None):
+        check_writable(self)
+        self.log_file.seek(0, os.SEEK_END)
+        offset = self.log_file.tell()
+        for chunk in chunks:
+            self.log_file.write(chunk)
+        self.log_file.write(b'\n')
+        self.log_file.flush()
+        length = self.log_file.tell() - offset
+        #index entry goes last so a crash never leaves it pointing at a partial value
+        if created is None:
+            created = time.time()
+        self.append_index(key, offset, length, created)
+        if key in self.index:
+            self.dead_bytes += self.index[key][1]
+            self.live_bytes -= self.index[key][1]
+        self.index[key] = (offset, length, created)
+        self.live_bytes += length
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def stat(self, key):
+        offset, length, created = self.index[key]
+        return (length, created)
+
+    def entries(self):
+        for key, (offset, length, created) in list(self.index.items()):
+            yield (key, length, created)
+
+    def delete(self, key):
+        check_writable(self)
+        offset, length, created = self.index.pop(key)
+        self.append_index(key, -1, 0, time.time())
+        self.live_bytes -= length
+        self.dead_bytes += length
+        if self.dead_bytes > max(self.live_bytes, self.compact_min_bytes):
+            self.compact()
+
+    #Rewrites only the live entries into fresh files and swaps them in
+    def compact(self):
+        tmp_log = self.log_fname + '.tmp'
+        tmp_index = self.index_fname + '.tmp'
+        new_index = {}
+        with open(tmp_log, 'wb') as lf, open(tmp_index, 'w') as xf:
+            for key, (offset, length, created) in self.index.items():
+                log_map = self.get_map(offset + length)
+                new_index[key] = (lf.tell(), length, created)
+                lf.write(log_map[offset:offset + length])
+                xf.write(json.dumps([key, new_index[key][0], length, created]) + '\n')
+        self.close()
+        os.replace(tmp_log, self.log_fname)
+        os.replace(tmp_index, self.index_fname)
+        self.index = new_index
+        self.dead_bytes = 0
+        self.log_file = open(self.log_fname, 'ab+')
+        self.index_file = open(self.index_fname, 'a')
+
+    def close(self):
+        if self.log_map is not None:
+            self.log_map.close()
+            self.log_map = None
+        for f in (self.log_file, self.index_file):
+            if f is not None:
+                f.close()
+
+
+#SQLite store: one row per entry in a key/value table
+class SqliteCache():
+    def __init__(self, db_name=CACHE_DB_FNAME, readonly=False):
+        self.readonly = readonly
+        if readonly: #SQLite itself refuses the writes
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(db_name), uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(db_name, check_same_thread=False) #calls are serialised by CacheLayer.lock
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS 'Cache' (
+                'Key' TEXT PRIMARY KEY,
+                'Value' TEXT,
+                'Size' INTEGER,
+                'Created' REAL
+                );
+            ''')
+        columns = [ea[1] for ea in self.conn.execute('PRAGMA table_info(Cache)')]
+        if 'Created' not in columns: #table made before sizes and times were recorded
+            self.conn.execute('ALTER TABLE Cache ADD COLUMN Size INTEGER')
+            self.conn.execute('ALTER TABLE Cache ADD COLUMN Created REAL')
+            self.conn.execute('UPDATE Cache SET Size = length(Value), Created = ?', [time.time()])
+        self.conn.commit()
+
+    def __contains__(self, key):
+        sql = 'SELECT 1 FROM Cache WHERE Key = ?'
+        return self.conn.execute(sql, [key]).fetchone() is not None
+
+    def __getitem__(self, key):
+        sql = 'SELECT Value FROM Cache WHERE Key = ?'
+        row = self.conn.execute(sql, [key]).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.set_raw(key, [json.dumps(value).encode('utf-8')])
+
+    #The chunks are joined: the value is bound as one TEXT parameter
+    def set_raw(self, key, chunks, created=None):
+        data = b''.join(chunks).decode('utf-8')
+        sql = 'INSERT OR REPLACE INTO Cache (Key, Value, Size, Created) VALUES (?,?,?,?)'
+        self.conn.execute(sql, (key, data, len(data), time.time() if created is None else created))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM Cache').fetchone()[0]
+
+    def keys(self):
+        return [ea[0] for ea in self.conn.execute('SELECT Key FROM Cache')]
+
+    def stat(self, key):
+        row = self.conn.execute('SELECT Size, Created FROM Cache WHERE Key = ?', [key]).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def entries(self):
+        return self.conn.execute('SELECT Key, Size, Created FROM Cache').fetchall()
+
+    def delete(self, key):
+        self.conn.execute('DELETE FROM Cache WHERE Key = ?', [key])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+CACHE_BACKENDS = {
+    'json': JsonFileCache,
+    'log': AppendLogCache,
+    'sqlite': SqliteCache,
+}
+
+def check_writable(store):
+    if store.readonly:
+        raise PermissionError('{} was opened read-only'.format(type(store).__name__))
+
+#Copies every entry of an old-format cache.json into store under its canonical key (one-shot, skips keys already present)
+def migrate_json_cache(store, json_fname=CACHE_FNAME):
+    with open(json_fname, 'r') as f:
+        old_cache = json.loads(f.read())
+    ct = 0
+    for key in old_cache:
+        new_key = rekey(key)
+        if new_key not in store:
+            store[new_key] = old_cache[key]
+            ct += 1
+    return ct
+
+def open_cache(backend=CACHE_BACKEND, readonly=False):
+    store = CACHE_BACKENDS[backend](readonly=readonly)
+    if not readonly and backend != 'json' and len(store) == 0 and os.path.exists(CACHE_FNAME):
+        print("Migrating {} to {} cache...".format(CACHE_FNAME, backend))
+        ct = migrate_json_cache(store)
+        print("Migrated {} entries".format(ct))
+    return store
+
+
+#Stands in for the store until it is first used, so importing final does not open or read any cache file
+class LazyCache():
+    def __init__(self, backend=None, readonly=False):
+        self.backend = backend
+        self.readonly = readonly
+        self.store = None
+
+    def get_store(self):
+        if self.store is None:
+            with timed_stage('cache.open'):
+                self.store = open_cache(self.backend or CACHE_BACKEND, self.readonly)
+        return self.store
+
+    def __contains__(self, key):
+        return key in self.get_store()
+
+    def __getitem__(self, key):
+        return self.get_store()[key]
+
+    def __setitem__(self, key, value):
+        self.get_store()[key] = value
+
+    def set_raw(self, key, chunks, created=None):
+        self.get_store().set_raw(key, chunks, created)
+
+    def __len__(self):
+        return len(self.get_store())
+
+    def keys(self):
+        return self.get_store().keys()
+
+    def stat(self, key):
+        return self.get_store().stat(key)
+
+    def entries(self):
+        return self.get_store().entries()
+
+    def delete(self, key):
+        self.get_store().delete(key)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+#Takes a request url, a cache key ('<provider>:<digest>') or a legacy cache key (base url + parameters)
+def provider_for_key(key):
+    for url in CACHE_PROVIDERS:
+        if key.startswith(url):
+            return CACHE_PROVIDERS[url]
+    provider = key.split(':', 1)[0]
+    if provider in CACHE_TTLS:
+        return provider
+    return 'other'
+
+
+#Policy layer over a store: expires entries past their provider's TTL, keeps the live entries under
+#max_bytes by evicting the least recently (lru) or least frequently (lfu) used ones, and counts
+#hits/misses/expirations/evictions per provider. Usage tracking is built on first use from the store's entries.
+#For lfu, victims come off a heap of (uses, order, key): an entry goes stale when its key is used again or
+#forgotten, is skipped when popped, and the heap is rebuilt once stale entries outnumber the live ones.
+class CacheLayer():
+    def __init__(self, store, max_bytes=None, policy=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.usage = None #OrderedDict of key -> size, least recently used first
+        self.freq = {}
+        self.heap = []
+        self.order = itertools.count() #breaks ties between equally used keys, least recently used first
+        self.total_bytes = 0
+        self.stats = {}
+        self.lock = threading.RLock() #store files/connections and usage tracking are shared by search threads
+
+    def load_usage(self):
+        if self.usage is None:
+            if self.max_bytes is None:
+                self.max_bytes = CACHE_MAX_BYTES
+            if self.policy is None:
+                self.policy = CACHE_EVICTION
+            entries = sorted(self.store.entries(), key=lambda ea: ea[2]) #oldest first
+            self.usage = collections.OrderedDict()
+            for key, size, created in entries:
+                self.usage[key] = size
+                self.freq[key] = 0
+                self.total_bytes += size
+            if self.policy == 'lfu':
+                self.rebuild_heap()
+
+    def rebuild_heap(self):
+        self.heap = [(self.freq[key], next(self.order), key) for key in self.usage]
+        heapq.heapify(self.heap)
+
+    def count(self, provider, counter):
+        if provider not in self.stats:
+            self.stats[provider] = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'writes': 0, 'coalesced': 0}
+        self.stats[provider][counter] += 1
+
+    def touch(self, key):
+        self.usage.move_to_end(key)
+        self.freq[key] = self.freq.get(key, 0) + 1
+        if self.policy == 'lfu':
+            heapq.heappush(self.heap, (self.freq[key], next(self.order), key))
+            if len(self.heap) > 2 * len(self.usage) + 64:
+                self.rebuild_heap()
+
+    def forget(self, key):
+        self.total_bytes -= self.usage.pop(key)
+        self.freq.pop(key, None)
+        self.store.delete(key)
+
+    #Returns the cached value, or None when the key is missing or expired.
+    #While CACHE_ONLY is set the store is never changed: an expired entry is still served (a replay has nothing
+    #fresher to use) and an unreadable one is a miss that stays in the store.
+    def get(self, key):
+        with self.lock:
+            return self.locked_get(key)
+
+    def locked_get(self, key):
+        self.load_usage()
+        provider = provider_for_key(key)
+        if key not in self.usage:
+            self.count(provider, 'misses')
+            return None
+        if self.expired(key):
+            self.count(provider, 'expired')
+            if not CACHE_ONLY:
+                self.forget(key)
+                self.count(provider, 'misses')
+                return None
+        try:
+            value = self.store[key]
+        except ValueError: #unreadable entry, e.g. left by an interrupted compaction
+            if not CACHE_ONLY:
+                self.forget(key)
+            self.count(provider, 'misses')
+            return None
+        self.touch(key)
+        self.count(provider, 'hits')
+        return value
+
+    def expired(self, key):
+        size, created = self.store.stat(key)
+        ttl = CACHE_TTLS.get(provider_for_key(key))
+        return ttl is not None and time.time() - created > ttl
+
+    def set(self, key, value):
+        with self.lock:
+            self.load_usage()
+            self.store[key] = value
+            self.track_write(key)
+
+    def set_raw(self, key, chunks):
+        with self.lock:
+            self.load_usage()
+            self.store.set_raw(key, chunks)
+            self.track_write(key)
+
+    def track_write(self, key):
+        size, created = self.store.stat(key)
+        self.total_bytes += size - self.usage.get(key, 0)
+        self.usage[key] = size
+        self.touch(key)
+        self.count(provider_for_key(key), 'writes')
+        self.evict(key)
+
+    def evict(self, keep):
+        while self.total_bytes > self.max_bytes and len(self.usage) > 1:
+            if self.policy == 'lfu':
+                victim = self.lfu_victim(keep)
+            else:
+                victim = next(ea for ea in self.usage if ea != keep)
+            self.forget(victim)
+            self.count(provider_for_key(victim), 'evictions')
+
+    def lfu_victim(self, keep):
+        kept = None
+        while True:
+            entry = heapq.heappop(self.heap)
+            (uses, order, key) = entry
+            if self.freq.get(key) != uses:
+                continue #stale
+            if key == keep:
+                kept = entry
+                continue
+            if kept is not None:
+                heapq.heappush(self.heap, kept)
+            return key
+
+    #Same answer as get() without counting or touching: an expired entry is missing unless CACHE_ONLY serves it
+    def __contains__(self, key):
+        with self.lock:
+            self.load_usage()
+            return key in self.usage and (CACHE_ONLY or not self.expired(key))
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.store)
+
+    def keys(self):
+        with self.lock:
+            return self.store.keys()
+
+    def close(self):
+        with self.lock:
+            self.store.close()
+            self.usage = None
+            self.freq = {}
+            self.heap = []
+            self.total_bytes = 0
+
+
+CACHE_DICTION = CacheLayer(LazyCache())
+
+#Counters for the running process, e.g. cache_stats()['providers']['yelp']['hits']
+def cache_stats():
+    totals = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'writes': 0, 'coalesced': 0}
+    for provider in CACHE_DICTION.stats:
+        for counter in totals:
+            totals[counter] += CACHE_DICTION.stats[provider].get(counter, 0)
+    return {
+        'providers': CACHE_DICTION.stats,
+        'totals': totals,
+        'entries': len(CACHE_DICTION.usage) if CACHE_DICTION.usage is not None else None,
+        'bytes': CACHE_DICTION.total_bytes,
+        'max_bytes': CACHE_DICTION.max_bytes,
+        'policy': CACHE_DICTION.policy,
+    }
+
+#Registered with atexit by "python3 final.py --profile": appends this run's counters to cache_stats.json (one JSON object per line)
+def dump_cache_stats(fname=CACHE_STATS_FNAME):
+    if len(CACHE_DICTION.stats) == 0:
+        return
+    stats = cache_stats()
+    stats['time'] = time.time()
+    with open(fname, 'a') as f:
+        f.write(json.dumps(stats) + '\n')
+    totals = stats['totals']
+    print("Cache: {} hits, {} misses, {} expired, {} evicted, {} coalesced ({} bytes in {} entries)".format(
+        totals['hits'], totals['misses'], totals['expired'], totals['evictions'], totals['coalesced'], stats['bytes'], stats['entries']))
+
+
+#Per-provider HTTP settings: (connect, read) timeouts, how many times to retry a 429/5xx or dropped
+#connection, and the steady request rate (per second) and burst allowed for each API key
+PROVIDER_SETTINGS = {
+    'google': {'timeout': (3.05, 10), 'retries': 4, 'rate': 10, 'burst': 10},
+    'yelp': {'timeout': (3.05, 10), 'retries': 4, 'rate': 5, 'burst': 5},
+    'flickr': {'timeout': (3.05, 20), 'retries': 4, 'rate': 1, 'burst': 5}, #3600 calls/hour per key
+    'other': {'timeout': (3.05, 20), 'retries': 2, 'rate': 5, 'burst': 5},
+}
+RETRY_STATUS = (429, 500, 502, 503, 504)
+GOOGLE_OVER_LIMIT = 'OVER_QUERY_LIMIT' #"status" of a Google response refused for quota
+BACKOFF_BASE = 0.5 #seconds; the n-th retry waits a random time up to BACKOFF_BASE * 2**n
+BACKOFF_MAX = 30
+HTTP_POOL_SIZE = 16 #keep-alive connections per provider
+
+
+#Blocks callers so that no more than rate requests/second (after an initial burst) go out
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+HTTP_SESSIONS = {}
+RATE_LIMITERS = {}
+HTTP_LOCK = threading.Lock()
+
+#One keep-alive session per provider, shared by all threads (the urllib3 connection pool is thread-safe)
+def get_session(provider):
+    with HTTP_LOCK:
+        if provider not in HTTP_SESSIONS:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            HTTP_SESSIONS[provider] = session
+        return HTTP_SESSIONS[provider]
+
+def get_rate_limiter(provider, apikey):
+    with HTTP_LOCK:
+        if (provider, apikey) not in RATE_LIMITERS:
+            settings = PROVIDER_SETTINGS[provider]
+            RATE_LIMITERS[(provider, apikey)] = TokenBucket(settings['rate'], settings['burst'])
+        return RATE_LIMITERS[(provider, apikey)]
+
+#The credential a request is billed against: Google 'key', Flickr 'api_key' or the Yelp bearer token
+def apikey_for_request(params, headers):
+    if headers is not None and 'Authorization' in headers:
+        return headers['Authorization']
+    if params is not None:
+        return params.get('key', params.get('api_key'))
+    return None
+
+def backoff_delay(attempt, resp=None):
+    if resp is not None and 'Retry-After' in resp.headers:
+        try:
+            return min(BACKOFF_MAX, float(resp.headers['Retry-After']))
+        except ValueError:
+            pass #an HTTP date instead of seconds
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+#GET through the provider's pooled session, waiting on the key's rate limiter and retrying
+#429/5xx responses and connection errors with jittered exponential backoff
+def http_get(url, params=None, headers=None, stream=False):
+    provider = provider_for_key(url)
+    settings = PROVIDER_SETTINGS[provider]
+    session = get_session(provider)
+    limiter = get_rate_limiter(provider, apikey_for_request(params, headers))
+    rate_limited = getattr(session, 'rate_limited', True) #replayed fixtures use no API quota
+    attempt = 0
+    while True:
+        if rate_limited:
+            with timed_stage('http.ratelimit'):
+                limiter.acquire()
+        try:
+            with timed_stage('http.' + provider): #to the end of the body, or to the headers when streaming
+                resp = session.get(url, params=params, headers=headers, timeout=settings['timeout'], stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= settings['retries']:
+                raise
+            wait = backoff_delay(attempt)
+            print("{} request failed ({}), retrying in {:.1f}s".format(provider, type(e).__name__, wait))
+        else:
+            #Google reports rate limiting in the body of a 200 response (a streamed body is checked by ResponseStream)
+            over_limit = provider == 'google' and not stream and '"{}"'.format(GOOGLE_OVER_LIMIT) in resp.text
+            if resp.status_code not in RETRY_STATUS and not over_limit:
+                return resp
+            if attempt >= settings['retries']:
+                if over_limit:
+                    resp.close()
+                    raise requests.HTTPError('{} still {} after {} retries'.format(provider, GOOGLE_OVER_LIMIT, attempt), response=resp)
+                return resp #callers raise_for_status
+            wait = backoff_delay(attempt, resp)
+            resp.close() #hand the connection back to the pool
+            print("{} returned {}, retrying in {:.1f}s".format(provider, GOOGLE_OVER_LIMIT if over_limit else resp.status_code, wait))
+        count_event('http.retry')
+        time.sleep(wait)
+        attempt += 1
+
+
+#Record/replay transport: a FixtureSession stands in for a provider's session in HTTP_SESSIONS. 'replay' serves
+#every response from a fixture file named by the request's cache key (so credentials never reach it), after
+#sleeping latency plus up to jitter seconds to stand in for the network; 'record' makes the requests and saves
+#each 200 response as a fixture. Requests answered by the cache never reach the transport.
+FIXTURE_DIR = 'fixtures'
+FIXTURE_LATENCY = {'google': 0.15, 'yelp': 0.25, 'flickr': 0.4, 'other': 0.1} #seconds per replayed response
+
+class FixtureMiss(KeyError):
+    pass
+
+class FixtureResponse():
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} replayed from fixture'.format(self.status_code), response=self)
+
+    def close(self):
+        pass
+
+def fixture_path(url, params, fixture_dir=FIXTURE_DIR):
+    return os.path.join(fixture_dir, cache_key(url, params).replace(':', '-') + '.json')
+
+def write_fixture(url, params, status_code, headers, body, fixture_dir=FIXTURE_DIR):
+    fname = fixture_path(url, params, fixture_dir)
+    fixture = {
+        'url': url,
+        'params': dict((k, v) for (k, v) in (params or {}).items() if k not in CACHE_AUTH_PARAMS),
+        'status': status_code,
+        'headers': headers,
+        'body': body,
+    }
+    os.makedirs(fixture_dir, exist_ok=True)
+    with open(fname + '.partial', 'w') as f:
+        f.write(json.dumps(fixture))
+    os.replace(fname + '.partial', fname)
+
+class FixtureSession():
+    def __init__(self, fixture_dir=FIXTURE_DIR, mode='replay', latency=0.0, jitter=0.0):
+        self.fixture_dir = fixture_dir
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limited = mode == 'record'
+        self.session = requests.Session() if mode == 'record' else None
+
+    def get(self, url, params=None, headers=None, timeout=None, stream=False):
+        if self.mode == 'record':
+            resp = self.session.get(url, params=params, headers=headers, timeout=timeout)
+            kept = dict((k, v) for (k, v) in resp.headers.items() if k in ('Content-Type', 'Retry-After'))
+            if resp.status_code == 200:
+                write_fixture(url, params, resp.status_code, kept, resp.text, self.fixture_dir)
+            return FixtureResponse(resp.status_code, kept, resp.content)
+        try:
+            with open(fixture_path(url, params, self.fixture_dir), 'r') as f:
+                fixture = json.loads(f.read())
+        except FileNotFoundError:
+            raise FixtureMiss(cache_key(url, params))
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        return FixtureResponse(fixture['status'], fixture['headers'], fixture['body'].encode('utf-8'))
+
+#Sends every provider's requests through fixtures in fixture_dir; latency is seconds or a dict per provider
+#(None = FIXTURE_LATENCY). use_network() goes back to live sessions.
+def use_fixtures(fixture_dir=FIXTURE_DIR, mode='replay', latency=None, jitter=0.0):
+    if latency is None:
+        latency = FIXTURE_LATENCY
+    with HTTP_LOCK:
+        for provider in PROVIDER_SETTINGS:
+            delay = latency.get(provider, 0.0) if isinstance(latency, dict) else latency
+            HTTP_SESSIONS[provider] = FixtureSession(fixture_dir, mode, delay, jitter)
+
+def use_network():
+    with HTTP_LOCK:
+        HTTP_SESSIONS.clear()
+
+
+#Legacy cache key: the base url followed by every parameter but api_key (rekey() converts these)
 def params_unique_combination(baseurl, params_d, private_keys=["api_key"]):
     if params_d is not None:
         alphabetized_keys = sorted(params_d.keys())
@@ -45,34 +976,455 @@ def params_unique_combination(baseurl, params_d, private_keys=["api_key"]):
         return baseurl
 
 
-def make_request_using_cache(url, params = None, headers = None):
+#Cache keys are '<provider>:<hex digest>' of the base url and the normalized parameters. Credentials never
+#reach the key, the values of the numeric parameters are compared as numbers (42, 42.0 and the string ' 42.0'
+#are one value) and coordinates are rounded to CACHE_COORD_DECIMALS places, so lookups a few metres apart share
+#one entry. Every other value, such as a search query, is kept exactly as it was given.
+CACHE_AUTH_PARAMS = ('key', 'api_key', 'api_sig', 'auth_token', 'access_token', 'oauth_token')
+CACHE_COORD_PARAMS = ('lat', 'lon', 'latitude', 'longitude')
+CACHE_NUMBER_PARAMS = CACHE_COORD_PARAMS + ('limit', 'offset', 'page', 'per_page', 'radius')
+CACHE_COORD_DECIMALS = 4 #about 11 m; None keeps coordinates exact
+CACHE_KEY_BYTES = 16
+NUMBER_RE = re.compile(r'-?\d+(\.\d*)?$')
+
+def normalize_param(name, value, coord_decimals=None):
+    if name not in CACHE_NUMBER_PARAMS:
+        return value
+    if isinstance(value, str):
+        if NUMBER_RE.match(value.strip()) is None:
+            return value
+        value = float(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return value
+    if name in CACHE_COORD_PARAMS and coord_decimals is not None:
+        value = round(value, coord_decimals)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def cache_key(url, params=None, coord_decimals=CACHE_COORD_DECIMALS):
+    normalized = []
+    for name in sorted(params or {}):
+        if name not in CACHE_AUTH_PARAMS:
+            normalized.append([name, normalize_param(name, params[name], coord_decimals)])
+    canonical = json.dumps([url, normalized], separators=(',', ':'), sort_keys=True)
+    digest = hashlib.blake2b(canonical.encode('utf-8'), digest_size=CACHE_KEY_BYTES).hexdigest()
+    return '{}:{}'.format(provider_for_key(url), digest)
+
+#The parameter names the request builders use; a legacy key is split on these
+LEGACY_KEY_PARAMS = ('api_key', 'format', 'key', 'lat', 'latitude', 'limit', 'lon', 'longitude', 'method',
+    'offset', 'page', 'pagetoken', 'query', 'tag_mode')
+LEGACY_KEY_RE = re.compile('(?:^|_)({})-'.format('|'.join(sorted(LEGACY_KEY_PARAMS, key=len, reverse=True))))
+
+#(url, params) behind a legacy cache key, or None if key is not one
+def parse_legacy_key(key):
+    url = None
+    for provider_url in CACHE_PROVIDERS:
+        if key.startswith(provider_url):
+            url = provider_url
+    if url is None:
+        return None
+    rest = key[len(url):]
+    names = []
+    for m in LEGACY_KEY_RE.finditer(rest):
+        #parameters were written in sorted order, so a name out of order is part of the previous value
+        if len(names) == 0 and m.start() != 0:
+            return None
+        if len(names) == 0 or m.group(1) > names[-1][0]:
+            names.append((m.group(1), m.start(), m.end()))
+    if len(names) == 0:
+        return (url, None) if rest == '' else None
+    params = {}
+    for ct, (name, start, end) in enumerate(names):
+        stop = names[ct + 1][1] if ct + 1 < len(names) else len(rest)
+        params[name] = rest[end:stop]
+    return (url, params)
+
+#Canonical key for a legacy or canonical key (keys of unknown form are kept as they are)
+def rekey(key, coord_decimals=CACHE_COORD_DECIMALS):
+    parsed = parse_legacy_key(key)
+    if parsed is None:
+        return key
+    return cache_key(parsed[0], parsed[1], coord_decimals)
+
+#Rewrites the entries of a cache under canonical keys: the cache.json file json_fname in one pass, or else the
+#configured store in place. Legacy keys that now share a key keep the newest entry, with its age.
+#The report's merge_rate is the share of rekeyed entries merged away: replaying the requests behind them,
+#that is the share that would now hit an entry written for another one.
+def rekey_cache(json_fname=None, coord_decimals=CACHE_COORD_DECIMALS):
+    if json_fname is not None:
+        with open(json_fname, 'r') as f:
+            old_cache = json.loads(f.read())
+        old_keys = list(old_cache.keys())
+    else:
+        store = CACHE_DICTION.store.get_store()
+        old_keys = store.keys()
+    new_keys = {}
+    for key in old_keys:
+        new_key = rekey(key, coord_decimals)
+        if new_key != key:
+            new_keys[key] = new_key
+    if json_fname is not None:
+        new_cache = {}
+        for key in old_keys:
+            new_cache[new_keys.get(key, key)] = old_cache[key] #no per-entry times: the last one wins
+        mtime = os.path.getmtime(json_fname)
+        with open(json_fname + '.partial', 'w') as f:
+            f.write(json.dumps(new_cache))
+        os.utime(json_fname + '.partial', (mtime, mtime)) #the file time is the age of every entry
+        os.replace(json_fname + '.partial', json_fname)
+        entries_after = len(new_cache)
+    else:
+        newest = {}
+        for key in new_keys:
+            created = store.stat(key)[1]
+            new_key = new_keys[key]
+            if new_key not in newest or created > newest[new_key][1]:
+                newest[new_key] = (key, created)
+        for new_key in newest:
+            (key, created) = newest[new_key]
+            if new_key not in store or store.stat(new_key)[1] < created:
+                store.set_raw(new_key, [json.dumps(store[key]).encode('utf-8')], created)
+        for key in new_keys:
+            store.delete(key)
+        entries_after = len(store)
+    rekeyed = len(new_keys)
+    merged = len(old_keys) - entries_after
+    return {
+        'entries_before': len(old_keys),
+        'entries_after': entries_after,
+        'rekeyed': rekeyed,
+        'merged': merged,
+        'merge_rate': merged / float(rekeyed) if rekeyed else 0.0,
+    }
+
+
+#Batch ingestion turns off the per-request lines (REQUEST_LOG) and can replay from the cache alone (CACHE_ONLY),
+#in which case a request that is not cached raises CacheMiss instead of going to the network
+REQUEST_LOG = True
+CACHE_ONLY = False
+
+class CacheMiss(KeyError):
+    pass
+
+
+#Single flight: while a request for a cache key is in flight, other callers missing the same key wait for
+#it and share its result (or its exception) instead of making the same call and cache write again
+class Flight():
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight():
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    #Returns (flight, leader): the leader makes the call and must end() the flight; the others wait() on it
+    def begin(self, key):
+        with self.lock:
+            if key in self.flights:
+                return (self.flights[key], False)
+            flight = Flight()
+            self.flights[key] = flight
+            return (flight, True)
+
+    def end(self, key, flight):
+        with self.lock:
+            del self.flights[key]
+        flight.done.set()
+
+REQUEST_FLIGHTS = SingleFlight()
+
+#Joins the flight for unique_ident; returns (flight, leader), or (None, False) with the followers' shared
+#result counted, so the caller only needs to act when it leads
+def join_flight(unique_ident):
+    (flight, leader) = REQUEST_FLIGHTS.begin(unique_ident)
+    if not leader:
+        if REQUEST_LOG:
+            print("Waiting for the same request in flight...")
+        with CACHE_DICTION.lock:
+            CACHE_DICTION.count(provider_for_key(unique_ident), 'coalesced')
+    return (flight, leader)
+
+
+#cacheable(data) returning False hands the response back without caching it (e.g. a page that is not ready yet)
+#key_params, when given, names the entry in place of params (for params that change on every request)
+def make_request_using_cache(url, params = None, headers = None, cacheable = None, key_params = None):
     # unique_ident = get_unique_key(url) 
-    unique_ident = params_unique_combination(url, params)   
-    if unique_ident in CACHE_DICTION:    ## first, look in the cache to see if we already have this data
-        print("Getting cached data...")
-        return CACHE_DICTION[unique_ident]    
-    else:    ## if not, fetch the data afresh, add it to the cache, then write the cache to file
-        print("Making a request for new data...")
-        resp = requests.get(url, headers = headers, params=params) # Make the request and cache the new data
-        # print(resp)
-        if params is None:
-            CACHE_DICTION[unique_ident] = resp.text #storing entire text of html
-        elif url == "https://api.flickr.com/services/rest/":
-            text = resp.text[14:-1]
-            CACHE_DICTION[unique_ident] = json.loads(text)
+    unique_ident = cache_key(url, params if key_params is None else key_params)
+    with timed_stage('cache.get'):
+        cached = CACHE_DICTION.get(unique_ident) ## first, look in the cache to see if we already have fresh data
+    if cached is not None:
+        count_event('cache.hit')
+        if REQUEST_LOG:
+            print("Getting cached data...")
+        return cached
+    else:    ## if not, fetch the data afresh, add it to the cache, then write the entry to the cache store
+        count_event('cache.miss')
+        if CACHE_ONLY:
+            raise CacheMiss(unique_ident)
+        (flight, leader) = join_flight(unique_ident) # identical calls already in flight share one request
+        if not leader:
+            return flight.wait()
+        try:
+            if unique_ident in CACHE_DICTION: # written by a flight that ended since the lookup above
+                flight.result = CACHE_DICTION.get(unique_ident)
+                if flight.result is not None:
+                    return flight.result
+            if REQUEST_LOG:
+                print("Making a request for new data...")
+            resp = http_get(url, params = params, headers = headers) # Make the request and cache the new data
+            # print(resp)
+            resp.raise_for_status() # never cache an error page
+            with timed_stage('parse.json'):
+                if params is None:
+                    data = resp.text #storing entire text of html
+                elif url == FLICKR_REST_URL:
+                    text = resp.text #JSONP: decode from the first '{' instead of copying a slice without the wrapper
+                    data = JSON_DECODER.raw_decode(text, text.index('{'))[0]
+                else:
+                    data = json.loads(resp.text)
+            if cacheable is None or cacheable(data):
+                with timed_stage('cache.write'):
+                    CACHE_DICTION[unique_ident] = data # the store writes only this entry to disk
+            flight.result = data
+            return data
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            REQUEST_FLIGHTS.end(unique_ident, flight)
+
+
+#Streaming: records are decoded one at a time as the response bytes arrive, rather than after the whole body
+#has been read and parsed. STREAM_PATHS gives the keys leading to each provider's array of records.
+STREAM_CHUNK_BYTES = 16384
+STREAM_PATHS = {
+    'google': ['results'],
+    'yelp': ['businesses'],
+    'flickr': ['photos', 'photo'],
+}
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = ' \t\n\r'
+
+#Incremental parser for one array of objects inside a JSON (or JSONP) document. feed() takes the next chunk
+#of bytes and returns the array elements completed so far; the text before and after the array is kept so
+#that close() can return the rest of the document (with the array emptied) for metadata such as page counts.
+class JsonArrayStream():
+    def __init__(self, path):
+        self.path = path
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.state = 'seek' # 'seek' -> 'array' -> 'after'
+        self.prefix = ''
+        self.suffix = []
+        #seek state: open containers ('{' or '['), the current key of each open object, string scanning
+        self.stack = []
+        self.keys = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.last_string = None
+
+    def feed(self, chunk):
+        text = self.decoder.decode(chunk)
+        if self.state == 'after':
+            self.suffix.append(text)
+            return []
+        self.buffer += text
+        records = []
+        if self.state == 'seek':
+            self.seek()
+        if self.state == 'array':
+            self.read_elements(records)
+        return records
+
+    #Scans the text before the array character by character (it is short: a JSONP wrapper and a few fields)
+    def seek(self):
+        buf = self.buffer
+        i = self.pos
+        while i < len(buf):
+            c = buf[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    self.last_string = json.loads(buf[self.string_start:i + 1])
+            elif c == '"':
+                self.in_string = True
+                self.string_start = i
+            elif c == ':' and len(self.stack) > 0 and self.stack[-1] == '{':
+                self.keys[-1] = self.last_string
+            elif c == '{':
+                self.stack.append('{')
+                self.keys.append(None)
+            elif c == '[':
+                if self.stack == ['{'] * len(self.path) and self.keys == self.path:
+                    self.prefix = buf[:i + 1]
+                    self.buffer = buf[i + 1:]
+                    self.pos = 0
+                    self.state = 'array'
+                    return
+                self.stack.append('[')
+                self.keys.append(None)
+            elif c in '}]':
+                self.stack.pop()
+                self.keys.pop()
+            i += 1
+        self.pos = i
+
+    #Decodes whole elements with the C decoder; a partial element at the end waits for the next chunk
+    def read_elements(self, records):
+        buf = self.buffer
+        pos = 0
+        while True:
+            while pos < len(buf) and (buf[pos] in JSON_WHITESPACE or buf[pos] == ','):
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                self.state = 'after'
+                self.suffix.append(buf[pos:])
+                pos = len(buf)
+                break
+            try:
+                (record, end) = JSON_DECODER.raw_decode(buf, pos)
+            except ValueError:
+                break #incomplete element
+            records.append(record)
+            pos = end
+        self.buffer = buf[pos:]
+
+    #The document without its records, e.g. {"photos": {"page": 1, "pages": 12, "photo": []}, "stat": "ok"}
+    def close(self):
+        if self.state != 'after':
+            raise ValueError('response ended before the end of the {} array'.format('.'.join(self.path)))
+        text = self.prefix + ''.join(self.suffix) + self.decoder.decode(b'', final=True)
+        return JSON_DECODER.raw_decode(text, text.index('{'))[0]
+
+#Drops a JSONP wrapper such as jsonFlickrApi( ... ) from the response chunks as they pass, holding back only
+#the bytes after the last '}' seen so far
+def strip_jsonp(chunks):
+    chunks = (ea for ea in chunks if len(ea) > 0)
+    first = next(chunks, b'')
+    if first.lstrip()[:1] in (b'{', b'['):
+        yield first
+        yield from chunks
+        return
+    while b'{' not in first:
+        first = next(chunks, None)
+        if first is None:
+            return
+    tail = b''
+    for chunk in itertools.chain([first[first.index(b'{'):]], chunks):
+        if b'}' in chunk:
+            end = chunk.rindex(b'}') + 1
+            yield tail + chunk[:end]
+            tail = chunk[end:]
         else:
-            CACHE_DICTION[unique_ident] = json.loads(resp.text)
-        dumped_json_cache = json.dumps(CACHE_DICTION) #using json as dictionary format in the cache
-        fw = open(CACHE_FNAME,"w")
-        fw.write(dumped_json_cache)
-        fw.close() # Close the open file
-        return CACHE_DICTION[unique_ident]
+            tail += chunk
+
+#Iterating yields the records of one provider response, from the cache or streamed from the network.
+#Once exhausted, envelope holds the rest of the response. The received bytes are spooled to a temporary file as
+#they arrive and copied into the cache STREAM_CHUNK_BYTES at a time once the response is complete, so neither
+#the body nor a list of its chunks is held in memory; a stream abandoned part way is not cached.
+class ResponseStream():
+    def __init__(self, url, params=None, headers=None):
+        self.url = url
+        self.params = params
+        self.headers = headers
+        self.path = STREAM_PATHS[provider_for_key(url)]
+        self.envelope = None
+
+    def __iter__(self):
+        unique_ident = cache_key(self.url, self.params)
+        with timed_stage('cache.get'):
+            cached = CACHE_DICTION.get(unique_ident)
+        if cached is not None:
+            count_event('cache.hit')
+            yield from self.cached_records(cached)
+            return
+        count_event('cache.miss')
+        if CACHE_ONLY:
+            raise CacheMiss(unique_ident)
+        (flight, leader) = join_flight(unique_ident) # identical calls already in flight share one request
+        if not leader:
+            flight.wait()
+            cached = CACHE_DICTION.get(unique_ident) # None if that stream was abandoned part way
+            if cached is not None:
+                yield from self.cached_records(cached)
+            else:
+                yield from self.streamed_records(unique_ident, None)
+            return
+        yield from self.streamed_records(unique_ident, flight)
+
+    def cached_records(self, cached):
+        if REQUEST_LOG:
+            print("Getting cached data...")
+        records = cached
+        for key in self.path:
+            records = records[key]
+        for record in records:
+            yield record
+        self.envelope = cached
+
+    #flight (when this stream leads one) is ended once the response is cached, or the stream fails or is dropped
+    def streamed_records(self, unique_ident, flight):
+        try:
+            if flight is not None and unique_ident in CACHE_DICTION: # written by a flight that ended since the lookup
+                cached = CACHE_DICTION.get(unique_ident)
+                if cached is not None:
+                    yield from self.cached_records(cached)
+                    return
+            if REQUEST_LOG:
+                print("Making a streaming request for new data...")
+            resp = http_get(self.url, params = self.params, headers = self.headers, stream = True)
+            with tempfile.TemporaryFile() as spool: # other streams share the cache log, so the entry is appended whole
+                try:
+                    resp.raise_for_status() # never cache an error page
+                    parser = JsonArrayStream(self.path)
+                    for chunk in resp.iter_content(STREAM_CHUNK_BYTES):
+                        spool.write(chunk)
+                        for record in parser.feed(chunk):
+                            yield record
+                    self.envelope = parser.close()
+                finally:
+                    resp.close()
+                if self.envelope.get('status') == GOOGLE_OVER_LIMIT: # a refused Google search; not retried once streamed
+                    raise requests.HTTPError('google returned {}'.format(GOOGLE_OVER_LIMIT), response=resp)
+                spool.seek(0)
+                with timed_stage('cache.write'):
+                    CACHE_DICTION.set_raw(unique_ident, strip_jsonp(iter(lambda: spool.read(STREAM_CHUNK_BYTES), b'')))
+        except Exception as e:
+            if flight is not None:
+                flight.error = e
+            raise
+        finally:
+            if flight is not None:
+                REQUEST_FLIGHTS.end(unique_ident, flight)
 
 
 #--------------------------------------------------------------------------------------------
 #-----CLASS DEFINITIONS
 #--------------------------------------------------------------------------------------------
+#__slots__ keeps the per-instance __dict__ off records that are built per row
 class GooglePlace():
+    __slots__ = ('name', 'lat', 'lon', 'rating')
+
     def __init__(self, name, latitude, longitude, rating):
         self.name = name
         self.lat = latitude
@@ -83,6 +1435,8 @@ class GooglePlace():
         return self.name + ' (' + str(self.lat) + ', ' + str(self.lon) + ')'
 
 class YelpPlace():
+    __slots__ = ('name', 'lat', 'lon', 'rating', 'review_count', 'price', 'searchterm', 'url')
+
     def __init__(self, name, latitude, longitude, rating, review_count, price, searchterm, url):
         self.name = name
         self.lat = latitude
@@ -96,7 +1450,26 @@ class YelpPlace():
     def __str__(self):
         return self.name + ' (' + str(self.lat) + ', ' + str(self.lon) + ') is rated ' + str(self.rating) 
 
+#Aggregate Yelp ratings for the places found near one search place (see ratings_summary)
+class RatingsSummary():
+    __slots__ = ('searchterm', 'places', 'rated', 'average', 'weighted', 'reviews', 'prices')
+
+    def __init__(self, searchterm, places, rated, rating_sum, reviews, weighted_sum, prices):
+        self.searchterm = searchterm
+        self.places = places
+        self.rated = rated
+        self.average = rating_sum / rated if rated > 0 else None
+        self.weighted = weighted_sum / reviews if reviews > 0 else self.average
+        self.reviews = reviews
+        self.prices = prices #{'$': count, ..., 'None': count}
+
+    def __str__(self):
+        average = 'unrated' if self.average is None else 'average {:.2f}, review-weighted {:.2f}'.format(self.average, self.weighted)
+        return '{}: {} places, {} ({} reviews)'.format(self.searchterm, self.places, average, self.reviews)
+
 class FlickrPhoto():
+    __slots__ = ('title', 'farmid', 'serverid', 'id', 'secret', 'lat', 'lon', 'req', 'searchterm')
+
     def __init__(self, title, latitude, longitude, farmid, serverid, id, secret, req, searchterm):
         self.title = title
         self.farmid = farmid
@@ -108,36 +1481,164 @@ class FlickrPhoto():
         self.req = req
         self.searchterm = searchterm
 
-    def __str__(self):
+    @property
+    def url(self):
         return 'https://farm{}.staticflickr.com/{}/{}_{}_h.jpg'.format(self.farmid,self.serverid,self.id,self.secret)
 
+    def __str__(self):
+        return self.url
+
+
+#Column-per-field container for many records of one type. fields are the record's attributes in constructor
+#order; those in numeric are kept in array('d') (None becomes NaN), the rest in plain lists. Records are
+#only built when the batch is indexed or iterated, so parsing, inserting and plotting need no per-row objects.
+class RecordBatch():
+    record_type = None
+    fields = ()
+    numeric = ()
+
+    def __init__(self):
+        self.columns = {}
+        for field in self.fields:
+            if field in self.numeric:
+                self.columns[field] = array.array('d')
+            else:
+                self.columns[field] = []
+
+    @classmethod
+    def from_rows(cls, rows):
+        batch = cls()
+        if len(rows) > 0:
+            for (field, values) in zip(cls.fields, zip(*rows)):
+                if field in cls.numeric:
+                    batch.columns[field] = array.array('d', [float('nan') if ea is None else ea for ea in values])
+                else:
+                    batch.columns[field] = list(values)
+        return batch
+
+    def append(self, *values):
+        for (field, value) in zip(self.fields, values):
+            if value is None and field in self.numeric:
+                value = float('nan')
+            self.columns[field].append(value)
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]])
+
+    def __getitem__(self, i):
+        return self.record_type(*[self.columns[field][i] for field in self.fields])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    #Values of one field (derived fields are computed by subclasses)
+    def values(self, field):
+        return self.columns[field]
+
+    #A numeric field as a NumPy array
+    def column(self, field):
+        return np.array(self.values(field), dtype=float)
+
+    #Tuples of the given fields, e.g. for executemany
+    def rows(self, fields):
+        return list(zip(*[self.values(field) for field in fields]))
+
+class GooglePlaceBatch(RecordBatch):
+    record_type = GooglePlace
+    fields = ('name', 'lat', 'lon', 'rating')
+    numeric = ('lat', 'lon') #rating can be "None"
+
+class YelpPlaceBatch(RecordBatch):
+    record_type = YelpPlace
+    fields = ('name', 'lat', 'lon', 'rating', 'review_count', 'price', 'searchterm', 'url')
+    numeric = ('lat', 'lon', 'rating')
+
+class FlickrPhotoBatch(RecordBatch):
+    record_type = FlickrPhoto
+    fields = ('title', 'lat', 'lon', 'farmid', 'serverid', 'id', 'secret', 'req', 'searchterm')
+    numeric = ('lat', 'lon')
+
+    def values(self, field):
+        if field == 'url':
+            return ['https://farm{}.staticflickr.com/{}/{}_{}_h.jpg'.format(farmid, serverid, id, secret) for (farmid, serverid, id, secret)
+                in zip(self.columns['farmid'], self.columns['serverid'], self.columns['id'], self.columns['secret'])]
+        return RecordBatch.values(self, field)
+
+#Tuples of the given fields from a RecordBatch or a list of records
+def record_rows(records, fields):
+    if isinstance(records, RecordBatch):
+        return records.rows(fields)
+    return [tuple(getattr(obj, field) for field in fields) for obj in records]
+
 
 #--------------------------------------------------------------------------------------------
 #-----INITIALIZE DATABASE
 #--------------------------------------------------------------------------------------------
 DBNAME = 'final.db'
 
+#Creates the tables if they are missing and applies any pending schema migrations. Never prompts and never
+#drops data, so it is safe to run on every start; use rebuild_db to rewrite an existing database from scratch.
 def init_db(db_name):
-    try:
-        conn = sqlite3.connect(db_name)
-        cur = conn.cursor()
-    except Error as e:
-        print(e)
-
-    #Create Table Statements
-    create_table_google = '''
-        CREATE TABLE 'GooglePlaces' (
-            'Id' INTEGER PRIMARY KEY AUTOINCREMENT,
-            'Name' TEXT,
-            'Latitude' REAL,
-            'Longitude' REAL,
-            'Rating' REAL
-            );
-        '''
-    create_table_yelp = '''
-        CREATE TABLE 'YelpPlaces' (
+    migrate_db(db_name)
+
+#The original (version 0) tables; later changes to them are SCHEMA_MIGRATIONS
+BASE_TABLES = [
+    ('GooglePlaces', [('Id', 'INTEGER PRIMARY KEY AUTOINCREMENT'), ('Name', 'TEXT'), ('Latitude', 'REAL'),
+        ('Longitude', 'REAL'), ('Rating', 'REAL')]),
+    ('YelpPlaces', [('Id', 'INTEGER PRIMARY KEY AUTOINCREMENT'), ('SearchId', 'INTEGER'), ('SearchName', 'TEXT'),
+        ('Name', 'TEXT'), ('Latitude', 'REAL'), ('Longitude', 'REAL'), ('Rating', 'REAL'), ('ReviewCount', 'INTEGER'),
+        ('Price', 'TEXT'), ('URL', 'TEXT')]),
+    #SearchId is primary key from google places
+    #SearchName is name of location we are searching for photos around
+    #ReqId is whether the place lives in google (1) or yelp (2)
+    ('FlickrImages', [('Id', 'INTEGER PRIMARY KEY AUTOINCREMENT'), ('SearchId', 'INTEGER'), ('SearchName', 'TEXT'),
+        ('ReqId', 'INTEGER'), ('Title', 'TEXT'), ('FarmId', 'TEXT'), ('ServerId', 'TEXT'), ('PhotoId', 'TEXT'),
+        ('Secret', 'TEXT'), ('URL', 'TEXT')]),
+]
+
+def create_tables(cur):
+    for (table, columns) in BASE_TABLES:
+        cur.execute("CREATE TABLE IF NOT EXISTS '{}' (\n{}\n)".format(table,
+            ',\n'.join("'{}' {}".format(name, definition) for (name, definition) in columns)))
+
+
+#Each table has a natural key that the upserts in insert_*_data resolve conflicts on
+UNIQUE_KEYS = [
+    ('GooglePlaces', 'GooglePlacesName', ['Name']),
+    ('YelpPlaces', 'YelpPlacesSearchNameName', ['SearchName', 'Name']),
+    ('FlickrImages', 'FlickrImagesSearchNamePhotoId', ['SearchName', 'PhotoId']),
+]
+
+#Rows written before the key was enforced keep their first copy; the other copies are moved to
+#'<table>Duplicates' (same columns) rather than deleted. Returns the number of rows moved per table.
+DUPLICATES_TABLE = '{}Duplicates'
+
+def ensure_unique_keys(cur):
+    moved = {}
+    for table, index, columns in UNIQUE_KEYS:
+        create_index = "CREATE UNIQUE INDEX IF NOT EXISTS '{}' ON '{}' ({})".format(index, table, ','.join(columns))
+        try:
+            cur.execute(create_index)
+        except sqlite3.IntegrityError:
+            names = ','.join(name for (name, definition) in dict(BASE_TABLES)[table])
+            duplicates = DUPLICATES_TABLE.format(table)
+            where = "FROM '{0}' WHERE Id NOT IN (SELECT MIN(Id) FROM '{0}' GROUP BY {1})".format(table, ','.join(columns))
+            cur.execute("CREATE TABLE IF NOT EXISTS '{}' AS SELECT {} FROM '{}' WHERE 0".format(duplicates, names, table))
+            cur.execute("INSERT INTO '{}' ({}) SELECT {} {}".format(duplicates, names, names, where))
+            moved[table] = cur.execute('DELETE ' + where).rowcount
+            print("Moved {} duplicate rows of {} to {}".format(moved[table], table, duplicates))
+            cur.execute(create_index)
+    return moved
+
+#Rebuilds YelpPlaces with SearchId as a real foreign key to GooglePlaces. FlickrImages.SearchId points at
+#GooglePlaces or YelpPlaces depending on ReqId, which a declared foreign key cannot express, so it is
+#enforced by triggers instead. SearchIds that point at no place are cleared rather than kept dangling.
+def add_foreign_keys(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS 'YelpPlacesNew' (
             'Id' INTEGER PRIMARY KEY AUTOINCREMENT,
-            'SearchId' INTEGER,
+            'SearchId' INTEGER REFERENCES 'GooglePlaces' ('Id') ON DELETE CASCADE,
             'SearchName' TEXT,
             'Name' TEXT,
             'Latitude' REAL,
@@ -147,147 +1648,530 @@ def init_db(db_name):
             'Price' TEXT,
             'URL' TEXT
             );
-        '''
-    create_table_flickr = '''
-        CREATE TABLE 'FlickrImages' (
-            'Id' INTEGER PRIMARY KEY AUTOINCREMENT,
-            'SearchId' INTEGER,
-            'SearchName' TEXT,
-            'ReqId' INTEGER,
-            'Title' TEXT,
-            'FarmId' TEXT,
-            'ServerId' TEXT,
-            'PhotoId' TEXT,
-            'Secret' TEXT,
-            'URL' TEXT
+        ''')
+    cur.execute('''
+        INSERT INTO 'YelpPlacesNew' (Id,SearchId,SearchName,Name,Latitude,Longitude,Rating,ReviewCount,Price,URL)
+        SELECT Id, (SELECT Id FROM GooglePlaces WHERE GooglePlaces.Id = YelpPlaces.SearchId),
+            SearchName,Name,Latitude,Longitude,Rating,ReviewCount,Price,URL
+        FROM YelpPlaces
+        ''')
+    cur.execute("DROP TABLE 'YelpPlaces'")
+    cur.execute("ALTER TABLE 'YelpPlacesNew' RENAME TO 'YelpPlaces'")
+    ensure_unique_keys(cur) #dropped along with the old table
+
+    cur.execute('''
+        UPDATE FlickrImages SET SearchId = NULL
+        WHERE (ReqId = 1 AND SearchId NOT IN (SELECT Id FROM GooglePlaces))
+            OR (ReqId != 1 AND SearchId NOT IN (SELECT Id FROM YelpPlaces))
+        ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS 'FlickrImagesSearchIdInsert' BEFORE INSERT ON 'FlickrImages'
+        WHEN NEW.SearchId IS NOT NULL AND CASE WHEN NEW.ReqId = 1
+            THEN NOT EXISTS (SELECT 1 FROM GooglePlaces WHERE Id = NEW.SearchId)
+            ELSE NOT EXISTS (SELECT 1 FROM YelpPlaces WHERE Id = NEW.SearchId) END
+        BEGIN SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed'); END
+        ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS 'FlickrImagesSearchIdUpdate' BEFORE UPDATE OF SearchId, ReqId ON 'FlickrImages'
+        WHEN NEW.SearchId IS NOT NULL AND CASE WHEN NEW.ReqId = 1
+            THEN NOT EXISTS (SELECT 1 FROM GooglePlaces WHERE Id = NEW.SearchId)
+            ELSE NOT EXISTS (SELECT 1 FROM YelpPlaces WHERE Id = NEW.SearchId) END
+        BEGIN SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed'); END
+        ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS 'GooglePlacesDeleteImages' AFTER DELETE ON 'GooglePlaces'
+        BEGIN DELETE FROM FlickrImages WHERE ReqId = 1 AND SearchId = OLD.Id; END
+        ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS 'YelpPlacesDeleteImages' AFTER DELETE ON 'YelpPlaces'
+        BEGIN DELETE FROM FlickrImages WHERE ReqId != 1 AND SearchId = OLD.Id; END
+        ''')
+
+#Indexes for the hot lookups. GooglePlaces.Name and YelpPlaces.SearchName are already the leading columns
+#of the unique keys; the covering index lets getflickr_fromdb answer from the index alone.
+def add_search_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS 'YelpPlacesName' ON 'YelpPlaces' (Name)")
+    cur.execute("CREATE INDEX IF NOT EXISTS 'YelpPlacesSearchId' ON 'YelpPlaces' (SearchId)")
+    cur.execute("CREATE INDEX IF NOT EXISTS 'FlickrImagesSearchNameCover' ON 'FlickrImages' (SearchName,Title,URL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS 'FlickrImagesPhotoId' ON 'FlickrImages' (PhotoId)")
+    cur.execute("CREATE INDEX IF NOT EXISTS 'FlickrImagesSearchId' ON 'FlickrImages' (ReqId,SearchId)")
+
+#Photos of one search place in rowid order (every index ends with the rowid), for stepping to the n-th photo
+#of a place (replaced by the Ordinal index of version 8, which reaches it in one lookup)
+def add_sampling_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS 'FlickrImagesSearchName' ON 'FlickrImages' (SearchName)")
+
+#Number of photos per search place, kept in step with FlickrImages by triggers (as YelpSummary is), so a
+#random photo of a place is drawn from its exact count without counting it first
+def add_photo_counts(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS 'FlickrCounts' (
+            'SearchName' TEXT PRIMARY KEY NOT NULL,
+            'Photos' INTEGER NOT NULL DEFAULT 0
             );
-        '''
-
-    #Check if table exists
-
-    existing_google_statement = '''
-        SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'GooglePlaces'
-    '''
-    cur.execute(existing_google_statement)
-    for ea in cur:
-        exists_google = ea[0] # =0 if table does not exist
-
-    if exists_google != 0:
-        uinput = input("Google table exists. Delete? yes/no ")
-        if uinput == 'yes':
-            drop_statement = '''
-            DROP TABLE IF EXISTS 'GooglePlaces';
-            '''
-            cur.execute(drop_statement)
-            cur.execute(create_table_google)
-    else:
-        cur.execute(create_table_google)
-
-    existing_yelp_statement = '''
-        SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'YelpPlaces'
-        '''
-    cur.execute(existing_yelp_statement)
-    for ea in cur:
-        exists_yelp = ea[0] # =0 if table does not exist
-
-    if exists_yelp != 0:
-        uinput = input("Yelp table exists. Delete? yes/no ")
-        if uinput == 'yes':
-            drop_statement = '''
-            DROP TABLE IF EXISTS 'YelpPlaces';
-            '''
-            cur.execute(drop_statement)
-            cur.execute(create_table_yelp)
-    else:
-        cur.execute(create_table_yelp)
-
-    existing_flickr_statement = '''
-        SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'FlickrImages'
-        '''
-    cur.execute(existing_flickr_statement)
-    for ea in cur:
-        exists_flickr = ea[0] # =0 if table does not exist
-
-    if exists_flickr != 0:
-        uinput = input("Flickr table exists. Delete? yes/no ")
-        if uinput == 'yes':
-            drop_statement = '''
-            DROP TABLE IF EXISTS 'FlickrImages';
-            '''
-            cur.execute(drop_statement)
-            cur.execute(create_table_flickr)
-    else:
-        cur.execute(create_table_flickr)
-#SearchId is primary key from google places
-#SearchName is name of location we are searching for photos around
-#ReqId is whether the place lives in google (1) or yelp (2)  
-
-
+        ''')
+    cur.execute('DELETE FROM FlickrCounts')
+    cur.execute('''
+        INSERT INTO FlickrCounts (SearchName, Photos)
+        SELECT SearchName, COUNT(*) FROM FlickrImages WHERE SearchName IS NOT NULL GROUP BY SearchName
+        ''')
+    add = '''INSERT INTO FlickrCounts (SearchName) SELECT NEW.SearchName
+            WHERE NOT EXISTS (SELECT 1 FROM FlickrCounts WHERE SearchName = NEW.SearchName);
+        UPDATE FlickrCounts SET Photos = Photos + 1 WHERE SearchName = NEW.SearchName;'''
+    remove = "UPDATE FlickrCounts SET Photos = Photos - 1 WHERE SearchName = OLD.SearchName;"
+    for (name, event, condition, body) in [
+            ('FlickrCountsInsert', 'AFTER INSERT', 'NEW.SearchName IS NOT NULL', add),
+            ('FlickrCountsDelete', 'AFTER DELETE', 'OLD.SearchName IS NOT NULL', remove),
+            ('FlickrCountsUpdateOld', 'AFTER UPDATE OF SearchName', 'OLD.SearchName IS NOT NULL', remove),
+            ('FlickrCountsUpdateNew', 'AFTER UPDATE OF SearchName', 'NEW.SearchName IS NOT NULL', add)]:
+        cur.execute("CREATE TRIGGER IF NOT EXISTS '{}' {} ON 'FlickrImages' WHEN {} BEGIN {} END".format(name, event, condition, body))
+
+#Dense position (0 to Photos - 1) of each photo among the photos of its search place, so sample_key_rows reads
+#the n-th photo of a place with one index lookup. Kept by triggers that replace the count triggers of version 7:
+#a new photo takes the next position, and a removed photo's position is given to the place's last photo.
+FLICKR_ORDINAL_ADD = '''INSERT INTO FlickrCounts (SearchName) SELECT NEW.SearchName
+        WHERE NEW.SearchName IS NOT NULL AND NOT EXISTS (SELECT 1 FROM FlickrCounts WHERE SearchName = NEW.SearchName);
+    UPDATE FlickrImages SET Ordinal = (SELECT Photos FROM FlickrCounts WHERE SearchName = NEW.SearchName) WHERE rowid = NEW.rowid;
+    UPDATE FlickrCounts SET Photos = Photos + 1 WHERE SearchName = NEW.SearchName;'''
+FLICKR_ORDINAL_REMOVE = '''UPDATE FlickrImages SET Ordinal = OLD.Ordinal
+        WHERE SearchName = OLD.SearchName AND Ordinal = (SELECT Photos - 1 FROM FlickrCounts WHERE SearchName = OLD.SearchName);
+    UPDATE FlickrCounts SET Photos = Photos - 1 WHERE SearchName = OLD.SearchName;'''
+
+def add_photo_ordinals(cur):
+    if 'Ordinal' not in [ea[1] for ea in cur.execute("PRAGMA table_info('FlickrImages')")]:
+        cur.execute("ALTER TABLE 'FlickrImages' ADD COLUMN 'Ordinal' INTEGER")
+    rows = cur.execute('SELECT rowid, SearchName FROM FlickrImages WHERE SearchName IS NOT NULL ORDER BY SearchName, rowid').fetchall()
+    ordinals = []
+    for (searchname, photos) in itertools.groupby(rows, key=lambda ea: ea[1]):
+        ordinals.extend((ct, ea[0]) for (ct, ea) in enumerate(photos))
+    cur.executemany('UPDATE FlickrImages SET Ordinal = ? WHERE rowid = ?', ordinals)
+    #not UNIQUE: a photo moved to another place keeps its old position until the trigger gives it a new one
+    cur.execute("CREATE INDEX IF NOT EXISTS 'FlickrImagesSearchNameOrdinal' ON 'FlickrImages' (SearchName, Ordinal)")
+    cur.execute("DROP INDEX IF EXISTS 'FlickrImagesSearchName'")
+    for name in ['FlickrCountsInsert', 'FlickrCountsDelete', 'FlickrCountsUpdateOld', 'FlickrCountsUpdateNew']:
+        cur.execute("DROP TRIGGER IF EXISTS '{}'".format(name))
+    for (name, event, condition, body) in [
+            ('FlickrOrdinalsInsert', 'AFTER INSERT', 'NEW.SearchName IS NOT NULL', FLICKR_ORDINAL_ADD),
+            ('FlickrOrdinalsDelete', 'AFTER DELETE', 'OLD.SearchName IS NOT NULL', FLICKR_ORDINAL_REMOVE),
+            ('FlickrOrdinalsUpdate', 'AFTER UPDATE OF SearchName', 'OLD.SearchName IS NOT NEW.SearchName',
+                FLICKR_ORDINAL_REMOVE + '\n    ' + FLICKR_ORDINAL_ADD)]:
+        cur.execute("CREATE TRIGGER IF NOT EXISTS '{}' {} ON 'FlickrImages' WHEN {} BEGIN {} END".format(name, event, condition, body))
+
+#R*Tree indexes over the coordinates of every stored Google and Yelp place (one box per point), kept in step
+#with the place tables by triggers. The rtree stores 32-bit floats, so lookups treat it as a candidate filter.
+SPATIAL_TABLES = [('GooglePlaces', 'GooglePlacesRtree'), ('YelpPlaces', 'YelpPlacesRtree')]
+
+def add_spatial_index(cur):
+    for (table, rtree) in SPATIAL_TABLES:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS '{}' USING rtree(Id, MinLat, MaxLat, MinLon, MaxLon)".format(rtree))
+        cur.execute('''
+            INSERT OR REPLACE INTO '{1}' (Id, MinLat, MaxLat, MinLon, MaxLon)
+            SELECT Id, Latitude, Latitude, Longitude, Longitude FROM '{0}'
+            WHERE typeof(Latitude) IN ('real', 'integer') AND typeof(Longitude) IN ('real', 'integer')
+            '''.format(table, rtree))
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS '{0}SpatialInsert' AFTER INSERT ON '{0}'
+            WHEN typeof(NEW.Latitude) IN ('real', 'integer') AND typeof(NEW.Longitude) IN ('real', 'integer')
+            BEGIN
+                INSERT INTO '{1}' (Id, MinLat, MaxLat, MinLon, MaxLon)
+                VALUES (NEW.Id, NEW.Latitude, NEW.Latitude, NEW.Longitude, NEW.Longitude);
+            END
+            '''.format(table, rtree))
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS '{0}SpatialUpdate' AFTER UPDATE OF Latitude, Longitude ON '{0}'
+            BEGIN
+                DELETE FROM '{1}' WHERE Id = OLD.Id;
+                INSERT INTO '{1}' (Id, MinLat, MaxLat, MinLon, MaxLon)
+                SELECT NEW.Id, NEW.Latitude, NEW.Latitude, NEW.Longitude, NEW.Longitude
+                WHERE typeof(NEW.Latitude) IN ('real', 'integer') AND typeof(NEW.Longitude) IN ('real', 'integer');
+            END
+            '''.format(table, rtree))
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS '{0}SpatialDelete' AFTER DELETE ON '{0}'
+            BEGIN
+                DELETE FROM '{1}' WHERE Id = OLD.Id;
+            END
+            '''.format(table, rtree))
+
+#Per search place aggregates of YelpPlaces (counts, rating sums, review-weighted rating sums, price tiers),
+#kept current by triggers on every insert, update and delete so a summary is one primary-key lookup
+PRICE_TIERS = ['$', '$$', '$$$', '$$$$']
+
+#What one YelpPlaces row (alias NEW, OLD or the table name) adds to each summary column
+def summary_terms(alias):
+    rated = "typeof({0}.Rating) IN ('real', 'integer')".format(alias)
+    columns = [
+        ('Places', '1'),
+        ('Rated', 'CASE WHEN {} THEN 1 ELSE 0 END'.format(rated)),
+        ('RatingSum', 'CASE WHEN {} THEN {}.Rating ELSE 0 END'.format(rated, alias)),
+        ('Reviews', 'CASE WHEN {} THEN COALESCE({}.ReviewCount, 0) ELSE 0 END'.format(rated, alias)),
+        ('WeightedRatingSum', 'CASE WHEN {0} THEN {1}.Rating * COALESCE({1}.ReviewCount, 0) ELSE 0 END'.format(rated, alias)),
+    ]
+    for (ct, tier) in enumerate(PRICE_TIERS):
+        columns.append(('Price{}'.format(ct + 1), "({}.Price IS '{}')".format(alias, tier)))
+    columns.append(('PriceUnknown', "({}.Price IS NULL OR {}.Price NOT IN ({}))".format(alias, alias, ','.join("'{}'".format(ea) for ea in PRICE_TIERS))))
+    return columns
+
+#SET clause adding (sign '+') or removing (sign '-') the row alias from its summary
+def summary_delta(alias, sign):
+    return ', '.join('{0} = {0} {1} ({2})'.format(name, sign, expression) for (name, expression) in summary_terms(alias))
+
+def add_ratings_summary(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS 'YelpSummary' (
+            'SearchName' TEXT PRIMARY KEY NOT NULL,
+            'Places' INTEGER NOT NULL DEFAULT 0,
+            'Rated' INTEGER NOT NULL DEFAULT 0,
+            'RatingSum' REAL NOT NULL DEFAULT 0,
+            'Reviews' INTEGER NOT NULL DEFAULT 0,
+            'WeightedRatingSum' REAL NOT NULL DEFAULT 0,
+            'Price1' INTEGER NOT NULL DEFAULT 0,
+            'Price2' INTEGER NOT NULL DEFAULT 0,
+            'Price3' INTEGER NOT NULL DEFAULT 0,
+            'Price4' INTEGER NOT NULL DEFAULT 0,
+            'PriceUnknown' INTEGER NOT NULL DEFAULT 0
+            );
+        ''')
+    terms = summary_terms('YelpPlaces')
+    cur.execute('DELETE FROM YelpSummary')
+    cur.execute('''
+        INSERT INTO YelpSummary (SearchName, {})
+        SELECT SearchName, {} FROM YelpPlaces WHERE SearchName IS NOT NULL GROUP BY SearchName
+        '''.format(', '.join(name for (name, expression) in terms), ', '.join('SUM({})'.format(expression) for (name, expression) in terms)))
+    #not INSERT OR IGNORE: a trigger takes the conflict handling of the statement that fired it (the upserts)
+    add = '''INSERT INTO YelpSummary (SearchName) SELECT NEW.SearchName
+            WHERE NOT EXISTS (SELECT 1 FROM YelpSummary WHERE SearchName = NEW.SearchName);
+        UPDATE YelpSummary SET {} WHERE SearchName = NEW.SearchName;'''.format(summary_delta('NEW', '+'))
+    remove = "UPDATE YelpSummary SET {} WHERE SearchName = OLD.SearchName;".format(summary_delta('OLD', '-'))
+    for (name, event, condition, body) in [
+            ('YelpSummaryInsert', 'AFTER INSERT', 'NEW.SearchName IS NOT NULL', add),
+            ('YelpSummaryDelete', 'AFTER DELETE', 'OLD.SearchName IS NOT NULL', remove),
+            ('YelpSummaryUpdateOld', 'AFTER UPDATE', 'OLD.SearchName IS NOT NULL', remove),
+            ('YelpSummaryUpdateNew', 'AFTER UPDATE', 'NEW.SearchName IS NOT NULL', add)]:
+        cur.execute("CREATE TRIGGER IF NOT EXISTS '{}' {} ON 'YelpPlaces' WHEN {} BEGIN {} END".format(name, event, condition, body))
+
+#Ordered schema changes: (version, description, function taking a cursor). Each runs once, in its own transaction.
+SCHEMA_MIGRATIONS = [
+    (1, 'unique keys for upserts', ensure_unique_keys),
+    (2, 'foreign keys from YelpPlaces/FlickrImages.SearchId', add_foreign_keys),
+    (3, 'search indexes', add_search_indexes),
+    (4, 'spatial index on place coordinates', add_spatial_index),
+    (5, 'ratings summary per search place', add_ratings_summary),
+    (6, 'index for sampling photos by rowid', add_sampling_index),
+    (7, 'photo counts per search place', add_photo_counts),
+    (8, 'photo positions per search place', add_photo_ordinals),
+]
+
+def schema_version(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS 'schema_version' (
+            'Version' INTEGER PRIMARY KEY,
+            'Description' TEXT,
+            'Applied' REAL
+            );
+        ''')
+    return cur.execute('SELECT COALESCE(MAX(Version), 0) FROM schema_version').fetchone()[0]
+
+#Creates the base tables and brings db_name up to target (default: latest), switching it to WAL journaling.
+#Safe to run again or from several processes at once: each step re-reads the version under the write lock,
+#so a migration another process has just applied is skipped rather than run twice.
+def migrate_db(db_name, target=None):
+    conn = sqlite3.connect(db_name, isolation_level=None, timeout=DB_TIMEOUT) #transactions are managed explicitly below
+    cur = conn.cursor()
+    cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute('PRAGMA foreign_keys = OFF') #tables are rebuilt; checked with foreign_key_check before commit
+    cur.execute('BEGIN IMMEDIATE')
+    create_tables(cur)
+    version = schema_version(cur)
+    cur.execute('COMMIT')
+    for (number, description, migration) in SCHEMA_MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        cur.execute('BEGIN IMMEDIATE')
+        if schema_version(cur) >= number:
+            cur.execute('ROLLBACK')
+            continue
+        print("Migrating {} to schema version {} ({})".format(db_name, number, description))
+        try:
+            migration(cur)
+            problems = cur.execute('PRAGMA foreign_key_check').fetchall()
+            if len(problems) > 0:
+                raise sqlite3.IntegrityError('foreign key violations: {}'.format(problems[:5]))
+            cur.execute('INSERT INTO schema_version (Version, Description, Applied) VALUES (?,?,?)', (number, description, time.time()))
+            cur.execute('COMMIT')
+        except:
+            cur.execute('ROLLBACK')
+            conn.close()
+            raise
     conn.close()
+    if target is None:
+        MIGRATED_DBS.add(db_name)
+
+MIGRATED_DBS = set()
+
+def remove_db_files(db_name):
+    for suffix in ['', '-wal', '-shm', '-journal']:
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
+
+#Rewrites db_name into a new file and copies that back over the original in one transaction, while the
+#database stays open everywhere (e.g. in final_server.py's reader pool). The base table rows (and any set aside
+#by ensure_unique_keys) are copied to a fresh file, every migration is run on it (which rebuilds the keys, indexes and triggers and compacts the
+#file), and the copy is checked. Writers wait for the whole rebuild; readers keep reading the old contents
+#until the copy commits and then see the new ones, as after any other write: the copy back is SQLite's backup
+#API, which writes through the database's own journal, so the file (and its inode) stays the one they have
+#open and PRAGMA data_version tells them it changed. If another connection writes in the moment between the
+#end of the rebuild and the start of the copy, the copy is abandoned and the original is left untouched.
+def rebuild_db(db_name):
+    new_name = db_name + '.rebuild'
+    remove_db_files(new_name)
+    lock = sqlite3.connect(db_name, isolation_level=None, timeout=DB_TIMEOUT)
+    watch = sqlite3.connect(db_name, isolation_level=None) #data_version counts the commits of other connections
+    try:
+        lock.execute('PRAGMA journal_mode = WAL') #as every connection sets it; lets watch read during the backup
+        lock.execute('BEGIN IMMEDIATE')
+        page_size = lock.execute('PRAGMA page_size').fetchone()[0]
+        conn = sqlite3.connect(new_name, isolation_level=None)
+        try:
+            conn.execute('PRAGMA page_size = {}'.format(page_size)) #a backup into a WAL database needs the same page size
+            conn.execute('BEGIN')
+            create_tables(conn)
+            conn.execute('ATTACH DATABASE ? AS old', [db_name])
+            existing = set(ea[0] for ea in conn.execute("SELECT name FROM old.sqlite_master WHERE type = 'table'"))
+            for (table, columns) in BASE_TABLES:
+                if table in existing:
+                    names = ','.join(name for (name, definition) in columns)
+                    conn.execute("INSERT INTO main.'{0}' ({1}) SELECT {1} FROM old.'{0}' ORDER BY Id".format(table, names))
+                if DUPLICATES_TABLE.format(table) in existing:
+                    conn.execute("CREATE TABLE main.'{0}' AS SELECT * FROM old.'{0}'".format(DUPLICATES_TABLE.format(table)))
+            conn.execute('COMMIT')
+            conn.execute('DETACH DATABASE old')
+        finally:
+            conn.close()
+        migrate_db(new_name)
+        conn = sqlite3.connect(new_name)
+        try:
+            check = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            counts = dict((table, conn.execute("SELECT COUNT(*) FROM '{}'".format(table)).fetchone()[0]) for (table, columns) in BASE_TABLES)
+            if check != 'ok':
+                raise sqlite3.DatabaseError('rebuilt database failed integrity_check: {}'.format(check))
+            version = watch.execute('PRAGMA data_version').fetchone()[0]
+            lock.execute('ROLLBACK') #the backup takes the write lock itself, with its first page
+            copied = [0]
+            def check_unchanged(status, remaining, total):
+                if copied[0] == 0 and watch.execute('PRAGMA data_version').fetchone()[0] != version:
+                    raise sqlite3.OperationalError('{} was written to during the rebuild; not swapping'.format(db_name))
+                copied[0] += 1
+            #one page per step so the check above runs while the write lock is held and nothing is committed yet
+            conn.backup(lock, pages=1, progress=check_unchanged)
+        finally:
+            conn.close()
+        lock.execute('PRAGMA wal_checkpoint') #moves the copy into the file if no reader holds the WAL
+    finally:
+        watch.close()
+        lock.close()
+        remove_db_files(new_name)
+    print("Rebuilt {}: {}".format(db_name, ', '.join('{} {} rows'.format(table, counts[table]) for (table, columns) in BASE_TABLES)))
+    return counts
+
+#Applied to every connection: WAL lets readers run alongside the writer, synchronous=NORMAL is durable
+#enough under WAL without an fsync per commit, and cache_size (negative = KiB) / mmap_size keep hot pages in memory
+DB_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('cache_size', -20000),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+]
+DB_POOL_SIZE = 8 #connections per database
+DB_STATEMENT_CACHE = 256 #prepared statements kept per connection, keyed by the SQL text
+DB_TIMEOUT = 30 #seconds to wait on a locked database
+
+#Connection with the tuned pragmas, migrating the database the first time this process opens it
+def connect_db(db_name, readonly=False):
+    if readonly:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(db_name), uri=True, timeout=DB_TIMEOUT,
+            check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    else:
+        if db_name not in MIGRATED_DBS:
+            migrate_db(db_name)
+        conn = sqlite3.connect(db_name, timeout=DB_TIMEOUT,
+            check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    for (pragma, value) in DB_PRAGMAS:
+        if readonly and pragma == 'journal_mode':
+            continue #a read-only connection cannot change the journal mode (it is stored in the file)
+        conn.execute('PRAGMA {} = {}'.format(pragma, value))
+    return conn
+
+#Up to size connections to one database, handed to one thread at a time. Connections are kept open between
+#checkouts, so each keeps its prepared statements; checkout blocks while all of them are in use.
+#close() closes the idle connections at once and each checked out one when it is checked in.
+class ConnectionPool():
+    def __init__(self, db_name, size=DB_POOL_SIZE, readonly=False):
+        self.db_name = db_name
+        self.size = size
+        self.readonly = readonly
+        self.idle = queue.LifoQueue() #most recently used first, so its page cache is warm
+        self.in_use = set()
+        self.opened = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        with self.lock:
+            if self.closed:
+                raise sqlite3.ProgrammingError('Cannot check out of a closed pool for {}'.format(self.db_name))
+            if self.idle.empty() and self.opened < self.size:
+                self.opened += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                conn = connect_db(self.db_name, self.readonly)
+            except:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        else:
+            conn = self.idle.get()
+        with self.lock:
+            self.in_use.add(conn)
+        return conn
+
+    def checkin(self, conn):
+        with self.lock:
+            self.in_use.discard(conn)
+            if self.closed:
+                conn.close()
+                self.opened -= 1
+                return
+        self.idle.put(conn)
+
+    #with pool.connection() as conn: ... commits on success and rolls back on an exception
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            while not self.idle.empty():
+                self.idle.get().close()
+                self.opened -= 1
+
+DB_POOLS = {}
+DB_POOLS_LOCK = threading.Lock()
+
+def get_pool(db_name=DBNAME, readonly=False):
+    with DB_POOLS_LOCK:
+        if (db_name, readonly) not in DB_POOLS:
+            DB_POOLS[(db_name, readonly)] = ConnectionPool(db_name, readonly=readonly)
+        return DB_POOLS[(db_name, readonly)]
+
+#Closes every pool, or only db_name's pools (connections in use are closed when checked in)
+def close_pools(db_name=None):
+    with DB_POOLS_LOCK:
+        for key in list(DB_POOLS.keys()):
+            if db_name is None or key[0] == db_name:
+                DB_POOLS.pop(key).close()
+
+atexit.register(close_pools)
 
 
 #--------------------------------------------------------------------------------------------
 #-----GATHER DATA FROM SOURCES
 #--------------------------------------------------------------------------------------------
 #Google Places API (Challenge Score: 2)
-def get_place_info(searchterm):
-    textsearchurl = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
+def google_request(searchterm):
+    textsearchurl = GOOGLE_TEXTSEARCH_URL
     textparams = {'query':searchterm, 'key':google_apikey}
+    return (textsearchurl, textparams, None)
+
+def add_google_result(places, ea):
+    lat = ea['geometry']['location']['lat']
+    lon = ea['geometry']['location']['lng']
+    name = ea['name']
+    if 'rating' in ea:
+        rating = ea['rating']
+    else:
+        rating = "None"
+    places.append(name, lat, lon, rating)
+
+def get_place_batch(searchterm):
+    (textsearchurl, textparams, headers) = google_request(searchterm)
     
     print('-----------------')
     print("Google Places API")
     textresp = make_request_using_cache(textsearchurl,textparams)
-    places = []
+    places = GooglePlaceBatch()
     if len(textresp['results']) != 0:
+        with timed_stage('records.google'):
             for ea in textresp['results']:
-                lat = ea['geometry']['location']['lat']
-                lon = ea['geometry']['location']['lng']
-                name = ea['name']
-                if 'rating' in ea:
-                    rating = ea['rating']
-                else:
-                    rating = "None"
-                places.append(GooglePlace(name, lat, lon, rating))
+                add_google_result(places, ea)
     else:
         print("No place found in Google Place Search")
     # for obj in places:
     #   print(obj)
     return places
 
+def get_place_info(searchterm):
+    return list(get_place_batch(searchterm))
+
 
 #Yelp Fusion (Challenge Score: 4)
-def get_yelp_info(lat,lon,searchterm):
-    yelp_baseurl_search = 'https://api.yelp.com/v3/businesses/search'
+def yelp_request(lat,lon):
+    yelp_baseurl_search = YELP_SEARCH_URL
     yelp_headers = {'Authorization': 'Bearer %s' % yelp_apikey, }
     yelp_parameters = {}
     yelp_parameters["latitude"] = lat
     yelp_parameters["longitude"] = lon
+    return (yelp_baseurl_search, yelp_parameters, yelp_headers)
+
+def add_yelp_business(yelpplaces, ea, searchterm):
+    name = ea['name']
+    latitude = ea['coordinates']['latitude']
+    longitude = ea['coordinates']['longitude']
+    rating = ea['rating']
+    review_count = ea['review_count']
+    url = ea['url']
+    if 'price' in ea:
+        price = ea['price']
+    else:
+        price = "None"
+    yelpplaces.append(name, latitude, longitude, rating, review_count, price, searchterm, url)
+
+def get_yelp_batch(lat,lon,searchterm):
+    (yelp_baseurl_search, yelp_parameters, yelp_headers) = yelp_request(lat,lon)
     
     print('-----------------')
     print("Yelp Search API")
     yelpresp = make_request_using_cache(yelp_baseurl_search, params = yelp_parameters, headers = yelp_headers)
-    yelpplaces = []
-    for ea in yelpresp['businesses']:
-        name = ea['name']
-        latitude = ea['coordinates']['latitude']
-        longitude = ea['coordinates']['longitude']
-        rating = ea['rating']
-        review_count = ea['review_count']
-        url = ea['url']
-        if 'price' in ea:
-            price = ea['price']
-        else:
-            price = "None"
-        yelpplaces.append(YelpPlace(name, latitude, longitude, rating, review_count, price, searchterm, url))
+    yelpplaces = YelpPlaceBatch()
+    with timed_stage('records.yelp'):
+        for ea in yelpresp['businesses']:
+            add_yelp_business(yelpplaces, ea, searchterm)
 # for obj in yelpplaces:
 #   print(obj)
     return yelpplaces
 
+def get_yelp_info(lat,lon,searchterm):
+    return list(get_yelp_batch(lat,lon,searchterm))
+
 
 #Instagram API (Challenge Score: 6) #no longer works??
 #Flickr API (Challenge Score: 2)
-def get_flickr_photos(lat,lon, searchterm, request):
-    flickr_baseurl = "https://api.flickr.com/services/rest/"
+def flickr_request(lat,lon):
+    flickr_baseurl = FLICKR_REST_URL
     flickr_parameters = {}
     flickr_parameters["method"] = "flickr.photos.search"
     flickr_parameters["api_key"] = flickr_apikey
@@ -295,172 +2179,371 @@ def get_flickr_photos(lat,lon, searchterm, request):
     flickr_parameters["lat"] = lat
     flickr_parameters["lon"] = lon
     flickr_parameters["tag_mode"] = "all"
+    return (flickr_baseurl, flickr_parameters, None)
+
+def flickr_req_id(request):
+    if request == "Google":
+        return 1
+    else:
+        return 2
+
+def add_flickr_photo(photos, ea, lat, lon, searchterm, req):
+    id = ea['id']
+    farmid = ea['farm']
+    serverid = ea['server']
+    secret = ea['secret']
+    if 'title' in ea:
+        title = ea['title']
+    else:
+        title = "None"
+    photos.append(title, lat, lon, farmid, serverid, id, secret, req, searchterm)
+
+def get_flickr_batch(lat,lon, searchterm, request):
+    (flickr_baseurl, flickr_parameters, headers) = flickr_request(lat,lon)
 
     print('-----------------')
     print("Flickr Data")
     flickrresp = make_request_using_cache(flickr_baseurl, params = flickr_parameters)
-    photos = []
-    if request == "Google":
-        req = 1
-    else:
-        req = 2
-    for ea in flickrresp['photos']['photo']:
-        id = ea['id']
-        farmid = ea['farm']
-        serverid = ea['server']
-        secret = ea['secret']
-        if 'title' in ea:
-            title = ea['title']
-        else:
-            title = "None"
-        photos.append(FlickrPhoto(title, lat, lon, farmid, serverid, id, secret, req, searchterm))
+    photos = FlickrPhotoBatch()
+    req = flickr_req_id(request)
+    with timed_stage('records.flickr'):
+        for ea in flickrresp['photos']['photo']:
+            add_flickr_photo(photos, ea, lat, lon, searchterm, req)
     # for obj in photos:
     #   print(obj)
     return photos
 
+def get_flickr_photos(lat,lon, searchterm, request):
+    return list(get_flickr_batch(lat,lon, searchterm, request))
 
-#--------------------------------------------------------------------------------------------
-#-----ADD TO DATABASE:
-#--------------------------------------------------------------------------------------------
-def insert_google_data(places,db_name):
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
 
-    for obj in places:
-        checkloc = '''
-                    SELECT Name
-                    FROM GooglePlaces
-                    WHERE GooglePlaces.Name = ?'''
-        check = cur.execute(checkloc,[obj.name]).fetchall()
-        
-        if len(check) > 0:
-            print("Already exists in GooglePlaces")
-            break
-        else:
-            insertions = (obj.name, obj.lat, obj.lon, obj.rating)
-            insertstatement = '''
-                INSERT INTO 'GooglePlaces' (Name,Latitude,Longitude,Rating)
-                VALUES (?,?,?,?)
-                '''
-            cur.execute(insertstatement,insertions)
-            conn.commit()
+#Streaming versions of the above: records are parsed as the response arrives and handed on in
+#batches of up to STREAM_BATCH_ROWS, e.g. straight into insert_stream()
+STREAM_BATCH_ROWS = 100
 
-    conn.close()
+def stream_batches(stream, batch_class, add_record):
+    batch = batch_class()
+    for ea in stream:
+        add_record(batch, ea)
+        if len(batch) >= STREAM_BATCH_ROWS:
+            yield batch
+            batch = batch_class()
+    if len(batch) > 0:
+        yield batch
 
-def insert_yelp_data(yelpplaces,db_name):
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
+def stream_place_batches(searchterm):
+    (url, params, headers) = google_request(searchterm)
+    print('-----------------')
+    print("Google Places API")
+    return stream_batches(ResponseStream(url, params, headers), GooglePlaceBatch, add_google_result)
 
-    for obj in yelpplaces:
-        # print(obj)
-        checkloc = '''
-                    SELECT Name
-                    FROM YelpPlaces
-                    WHERE YelpPlaces.Name = ? AND YelpPlaces.SearchName = ?'''
-        check = cur.execute(checkloc,(obj.name, obj.searchterm)).fetchall()
+def stream_yelp_batches(lat,lon,searchterm):
+    (url, params, headers) = yelp_request(lat,lon)
+    print('-----------------')
+    print("Yelp Search API")
+    return stream_batches(ResponseStream(url, params, headers), YelpPlaceBatch,
+        lambda batch, ea: add_yelp_business(batch, ea, searchterm))
 
-        if len(check) > 0:
-            print("Already exists in YelpPlaces")
+def stream_flickr_batches(lat,lon, searchterm, request):
+    (url, params, headers) = flickr_request(lat,lon)
+    req = flickr_req_id(request)
+    print('-----------------')
+    print("Flickr Data")
+    return stream_batches(ResponseStream(url, params, headers), FlickrPhotoBatch,
+        lambda batch, ea: add_flickr_photo(batch, ea, lat, lon, searchterm, req))
+
+
+#Pagination: every page of a search rather than only the first. The next page is requested on a background
+#thread as soon as the current one arrives, so it downloads while the caller works through the current page;
+#no more than two pages are held at once. Callers can stop early by abandoning the generator.
+GOOGLE_PAGETOKEN_DELAY = 2 #seconds before a next_page_token is accepted
+GOOGLE_PAGETOKEN_RETRIES = 5
+YELP_PAGE_SIZE = 50 #the largest limit Yelp accepts
+YELP_MAX_RESULTS = 1000 #Yelp rejects offset + limit past this
+
+#Google answers INVALID_REQUEST for a next_page_token that is not valid yet
+def google_page_ready(data):
+    return data.get('status') != 'INVALID_REQUEST'
+
+#A Google page after the first is requested by its one-time pagetoken alone and cached under the query and page
+#number, so a replayed search (whose cached first page holds an old token) still finds it
+def fetch_page(request):
+    (url, params, headers) = request
+    if url != GOOGLE_TEXTSEARCH_URL or 'pagetoken' not in params:
+        return make_request_using_cache(url, params, headers)
+    sent = {'pagetoken': params['pagetoken'], 'key': params['key']}
+    key_params = {'query': params['query'], 'page': params['page']}
+    for attempt in range(GOOGLE_PAGETOKEN_RETRIES):
+        data = make_request_using_cache(url, sent, headers, cacheable=google_page_ready, key_params=key_params)
+        if google_page_ready(data) or attempt == GOOGLE_PAGETOKEN_RETRIES - 1:
             break
-        else:
-            getkeystatement = '''
-                    SELECT Id, Name 
-                    FROM GooglePlaces
-                    WHERE GooglePlaces.Name = ?'''
-            cur.execute(getkeystatement, [str(obj.searchterm)])
+        time.sleep(GOOGLE_PAGETOKEN_DELAY)
+    return data
+
+#The request for the page after data, or None on the last page; fetched counts the records read so far
+def google_next_page(request, data, fetched):
+    if 'next_page_token' not in data:
+        return None
+    (url, params, headers) = request
+    return (url, {'query': params['query'], 'page': params.get('page', 1) + 1, 'pagetoken': data['next_page_token'],
+        'key': params['key']}, headers)
+
+def yelp_next_page(request, data, fetched):
+    total = min(data.get('total', 0), YELP_MAX_RESULTS)
+    if len(data['businesses']) == 0 or fetched >= total:
+        return None
+    (url, params, headers) = request
+    params = dict(params)
+    params['offset'] = fetched
+    params['limit'] = min(YELP_PAGE_SIZE, total - fetched)
+    return (url, params, headers)
+
+def flickr_next_page(request, data, fetched):
+    page = int(data['photos']['page'])
+    if page >= int(data['photos']['pages']):
+        return None
+    (url, params, headers) = request
+    params = dict(params)
+    params['page'] = page + 1
+    return (url, params, headers)
+
+#Yields the list of records on each page, starting from request (url, params, headers)
+def iter_pages(request, next_page, max_pages=None, fetch=fetch_page):
+    path = STREAM_PATHS[provider_for_key(request[0])]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending = executor.submit(fetch, request)
+    fetched = 0
+    pages = 0
+    try:
+        while pending is not None:
+            data = pending.result()
+            pages += 1
+            records = data
+            for key in path:
+                records = records[key]
+            fetched += len(records)
+            if max_pages is not None and pages >= max_pages:
+                request = None
+            else:
+                request = next_page(request, data, fetched)
+            pending = executor.submit(fetch, request) if request is not None else None
+            yield records
+    finally:
+        if pending is not None:
+            pending.cancel()
+        executor.shutdown(wait=False)
+
+def iter_place_batches(searchterm, max_pages=None):
+    pages = iter_pages(google_request(searchterm), google_next_page, max_pages)
+    return stream_batches(itertools.chain.from_iterable(pages), GooglePlaceBatch, add_google_result)
+
+def iter_yelp_batches(lat,lon,searchterm, max_pages=None):
+    pages = iter_pages(yelp_request(lat,lon), yelp_next_page, max_pages)
+    return stream_batches(itertools.chain.from_iterable(pages), YelpPlaceBatch,
+        lambda batch, ea: add_yelp_business(batch, ea, searchterm))
+
+def iter_flickr_batches(lat,lon, searchterm, request, max_pages=None):
+    pages = iter_pages(flickr_request(lat,lon), flickr_next_page, max_pages)
+    req = flickr_req_id(request)
+    return stream_batches(itertools.chain.from_iterable(pages), FlickrPhotoBatch,
+        lambda batch, ea: add_flickr_photo(batch, ea, lat, lon, searchterm, req))
+
+#Generator versions of get_place_info, get_yelp_info and get_flickr_photos that page through all results
+def iter_place_info(searchterm, max_pages=None):
+    for batch in iter_place_batches(searchterm, max_pages):
+        yield from batch
+
+def iter_yelp_info(lat,lon,searchterm, max_pages=None):
+    for batch in iter_yelp_batches(lat,lon,searchterm, max_pages):
+        yield from batch
+
+def iter_flickr_photos(lat,lon, searchterm, request, max_pages=None):
+    for batch in iter_flickr_batches(lat,lon, searchterm, request, max_pages):
+        yield from batch
 
 
-            for ea in cur:
-                # print("ea in yelpplaces", ea)
-                SearchId = ea[0]
+#--------------------------------------------------------------------------------------------
+#-----ADD TO DATABASE:
+#--------------------------------------------------------------------------------------------
+#Id of the place each search term refers to, looked up once per distinct name
+def lookup_search_ids(cur, table, names):
+    search_ids = {}
+    sql = "SELECT MAX(Id) FROM '{}' WHERE Name = ?".format(table)
+    for name in set(names):
+        search_ids[name] = cur.execute(sql, [str(name)]).fetchone()[0]
+    return search_ids
+
+#The insert functions upsert a whole list with executemany in a single transaction
+def insert_google_data(places,db_name):
+    with timed_stage('db.insert.google'), get_pool(db_name).connection() as conn:
+        cur = conn.cursor()
 
-            insertions = (SearchId, obj.searchterm, obj.name, obj.lat, obj.lon, obj.rating, obj.review_count, obj.price, obj.url)
-            insertstatement = '''
-            INSERT INTO 'YelpPlaces' (SearchId,SearchName,Name,Latitude,Longitude,Rating,ReviewCount,Price,URL)
-            VALUES (?,?,?,?,?,?,?,?,?)
+        insertions = record_rows(places, ['name', 'lat', 'lon', 'rating'])
+        insertstatement = '''
+            INSERT INTO 'GooglePlaces' (Name,Latitude,Longitude,Rating)
+            VALUES (?,?,?,?)
+            ON CONFLICT (Name) DO UPDATE SET
+                Latitude = excluded.Latitude,
+                Longitude = excluded.Longitude,
+                Rating = excluded.Rating
             '''
-            cur.execute(insertstatement,insertions)
-            conn.commit()
+        cur.executemany(insertstatement,insertions)
 
-    conn.close()
+def insert_yelp_data(yelpplaces,db_name):
+    with timed_stage('db.insert.yelp'), get_pool(db_name).connection() as conn:
+        cur = conn.cursor()
+
+        rows = record_rows(yelpplaces, ['searchterm', 'name', 'lat', 'lon', 'rating', 'review_count', 'price', 'url'])
+        search_ids = lookup_search_ids(cur, 'GooglePlaces', [ea[0] for ea in rows])
+        insertions = [(search_ids[ea[0]],) + ea for ea in rows]
+        insertstatement = '''
+        INSERT INTO 'YelpPlaces' (SearchId,SearchName,Name,Latitude,Longitude,Rating,ReviewCount,Price,URL)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (SearchName, Name) DO UPDATE SET
+            SearchId = excluded.SearchId,
+            Latitude = excluded.Latitude,
+            Longitude = excluded.Longitude,
+            Rating = excluded.Rating,
+            ReviewCount = excluded.ReviewCount,
+            Price = excluded.Price,
+            URL = excluded.URL
+        '''
+        cur.executemany(insertstatement,insertions)
 
 def insert_flickr_data(photos,db_name):
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
+    with timed_stage('db.insert.flickr'), get_pool(db_name).connection() as conn:
+        cur = conn.cursor()
 
-    for obj in photos:
-        checkloc = '''
-                    SELECT PhotoId,SearchName
-                    FROM FlickrImages
-                    WHERE FlickrImages.PhotoId = ? AND FlickrImages.SearchName = ?'''
-        check = cur.execute(checkloc,(obj.id, obj.searchterm)).fetchall()
-        
-        if len(check) > 0:
-            print("Already exists in FlickrImages")
-            break
-        else:
-            if obj.req == 1:
-                getkeystatement = '''
-                        SELECT Id 
-                        FROM GooglePlaces
-                        WHERE GooglePlaces.Name = ?'''
-                cur.execute(getkeystatement, [str(obj.searchterm)])
-
-                for ea in cur:
-                    SearchId = ea[0]
+        #ReqId 1: the search place lives in GooglePlaces, 2: in YelpPlaces
+        rows = record_rows(photos, ['searchterm', 'req', 'title', 'farmid', 'serverid', 'id', 'secret', 'url'])
+        google_ids = lookup_search_ids(cur, 'GooglePlaces', [ea[0] for ea in rows if ea[1] == 1])
+        yelp_ids = lookup_search_ids(cur, 'YelpPlaces', [ea[0] for ea in rows if ea[1] != 1])
+        insertions = []
+        for ea in rows:
+            if ea[1] == 1:
+                SearchId = google_ids[ea[0]]
             else:
-                getkeystatement = '''
-                        SELECT Id 
-                        FROM YelpPlaces
-                        WHERE YelpPlaces.Name = ?'''
-                cur.execute(getkeystatement, [str(obj.searchterm)])
-
-                for ea in cur:
-                    SearchId = ea[0]
-                # print(ea[0])
-
-            insertions = (SearchId, obj.searchterm, obj.req, obj.title,obj.farmid,obj.serverid, obj.id, obj.secret, obj.__str__())
-            insertstatement = '''
-            INSERT INTO 'FlickrImages' (SearchId,SearchName,ReqId,Title,FarmId,ServerId,PhotoId,Secret,URL)
-            VALUES (?,?,?,?,?,?,?,?,?)
-            ''' 
-            cur.execute(insertstatement,insertions)
-            conn.commit()
-
-    conn.close()
+                SearchId = yelp_ids[ea[0]]
+            insertions.append((SearchId,) + ea)
+        insertstatement = '''
+        INSERT INTO 'FlickrImages' (SearchId,SearchName,ReqId,Title,FarmId,ServerId,PhotoId,Secret,URL)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (SearchName, PhotoId) DO UPDATE SET
+            SearchId = excluded.SearchId,
+            ReqId = excluded.ReqId,
+            Title = excluded.Title,
+            FarmId = excluded.FarmId,
+            ServerId = excluded.ServerId,
+            Secret = excluded.Secret,
+            URL = excluded.URL
+        ''' 
+        cur.executemany(insertstatement,insertions)
+
+
+#Writes each batch as it arrives; returns the number of rows written
+def insert_stream(batches, insert_function, db_name):
+    ct = 0
+    for batch in batches:
+        insert_function(batch, db_name)
+        ct += len(batch)
+    return ct
 
 
 #--------------------------------------------------------------------------------------------
 #-----RETRIEVE DATA FROM DATABASE
 #--------------------------------------------------------------------------------------------
-def getnearby_fromdb(searchterm):
-    nearby = []
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
-
-    sql = '''SELECT Name, Latitude, Longitude, Rating, ReviewCount, Price, SearchName, URL
-            FROM YelpPlaces
-            WHERE SearchName = ?
+#k distinct random rows (tuples of columns) of table, every row equally likely, in O(k log n) whatever the size
+#of the table: rowids are drawn uniformly between the first and last rowid and looked up one at a time, and a
+#draw that lands on a gap (a deleted row) is redrawn. Ranges of at most SAMPLE_SCAN_FACTOR * k rowids are read
+#whole; after SAMPLE_MAX_DRAWS draws per row (a range that is mostly gaps) the rowids are read in one pass and
+#sampled, which is O(n). Fewer than k rows are returned only if that is all there are.
+SAMPLE_SCAN_FACTOR = 4
+SAMPLE_MAX_DRAWS = 20
+
+def sample_rows(conn, table, columns, k, rnd=random):
+    select = "SELECT rowid, {} FROM '{}'".format(', '.join(columns), table)
+    first = conn.execute(select + ' ORDER BY rowid LIMIT 1').fetchone()
+    last = conn.execute(select + ' ORDER BY rowid DESC LIMIT 1').fetchone()
+    if first is None or k <= 0:
+        return []
+    (low, high) = (first[0], last[0])
+    if high - low + 1 <= SAMPLE_SCAN_FACTOR * k:
+        rows = conn.execute(select + ' WHERE rowid BETWEEN ? AND ?', [low, high]).fetchall()
+        return [ea[1:] for ea in rnd.sample(rows, min(k, len(rows)))]
+    chosen = collections.OrderedDict()
+    draws = 0
+    while len(chosen) < k and draws < SAMPLE_MAX_DRAWS * k:
+        rowid = rnd.randint(low, high)
+        draws += 1
+        if rowid not in chosen:
+            row = conn.execute(select + ' WHERE rowid = ?', [rowid]).fetchone()
+            if row is not None:
+                chosen[rowid] = row[1:]
+    if len(chosen) < k:
+        rest = [ea[0] for ea in conn.execute("SELECT rowid FROM '{}'".format(table)) if ea[0] not in chosen]
+        for rowid in rnd.sample(rest, min(k - len(chosen), len(rest))):
+            chosen[rowid] = conn.execute(select + ' WHERE rowid = ?', [rowid]).fetchone()[1:]
+    return list(chosen.values())
+
+#The row of table with key_column = ? at ordinal_column = ? (one lookup in an index on the two columns)
+def ordinal_select(table, columns, key_column, ordinal_column):
+    return "SELECT {} FROM '{}' WHERE {} = ? AND {} = ?".format(', '.join(columns), table, key_column, ordinal_column)
+
+#k distinct random rows of table with key_column = key, every one equally likely, in O(k log n): the rows of
+#each key are numbered 0 to count - 1 in ordinal_column (kept dense by triggers, as FlickrImages.Ordinal is,
+#with count in a table such as FlickrCounts), so k distinct numbers are drawn and each row is read directly.
+def sample_key_rows(conn, table, columns, k, key_column, key, ordinal_column, count, rnd=random):
+    select = ordinal_select(table, columns, key_column, ordinal_column)
+    rows = []
+    for ordinal in rnd.sample(range(count), min(k, count)):
+        row = conn.execute(select, [key, ordinal]).fetchone()
+        if row is not None: #only if the count is behind the table
+            rows.append(row)
+    return rows
+
+#k random search places (GooglePlace objects, no repeats)
+def getrandomplaces_fromdb(k=10, db_name=DBNAME, readonly=False):
+    with timed_stage('db.sample'), get_pool(db_name, readonly).connection() as conn:
+        rows = sample_rows(conn, 'GooglePlaces', ['Name', 'Latitude', 'Longitude', 'Rating'], k)
+    return [GooglePlace(ea[0], ea[1], ea[2], ea[3]) for ea in rows]
+
+#k random photos of searchterm as [Title, SearchName, URL] lists, like getflickr_fromdb (no repeats)
+def getrandomphotos_fromdb(searchterm, k=10, db_name=DBNAME, readonly=False):
+    with timed_stage('db.sample'), get_pool(db_name, readonly).connection() as conn:
+        count = conn.execute('SELECT Photos FROM FlickrCounts WHERE SearchName = ?', [searchterm]).fetchone()
+        if count is None:
+            return []
+        rows = sample_key_rows(conn, 'FlickrImages', ['Title', 'SearchName', 'URL'], k, 'SearchName', searchterm, 'Ordinal', count[0])
+    return [list(ea) for ea in rows]
+
+#readonly=True reads through the database's read-only connection pool (for concurrent readers such as final_server.py)
+def getplace_fromdb(searchterm, db_name=DBNAME, readonly=False):
+    sql = '''SELECT Name, Latitude, Longitude, Rating
+            FROM GooglePlaces
+            WHERE Name = ?
             '''
-    result_list = cur.execute(sql,[searchterm]).fetchall()
-    for ea in result_list:
-        nearby.append(YelpPlace(ea[0],ea[1],ea[2],ea[3], ea[4], ea[5], ea[6], ea[7]))
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        result_list = conn.execute(sql,[searchterm]).fetchall()
+    return [GooglePlace(ea[0], ea[1], ea[2], ea[3]) for ea in result_list]
 
-    conn.close()
+#Names of up to limit stored search places, alphabetically from after (for paging through them)
+def getplacenames_fromdb(limit=100, after='', db_name=DBNAME, readonly=False):
+    sql = 'SELECT Name FROM GooglePlaces WHERE Name > ? ORDER BY Name LIMIT ?'
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        return [ea[0] for ea in conn.execute(sql, [after, limit])]
 
-    return nearby
+def getnearby_fromdb(searchterm, db_name=DBNAME, readonly=False):
+    return list(getnearby_columns(searchterm, db_name, readonly))
 
 
-def getflickr_fromdb(searchterm, searchlat,searchlon):
+def getflickr_fromdb(searchterm, searchlat,searchlon, db_name=DBNAME, readonly=False):
     images = []
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
-
     sql = '''SELECT Title, SearchName, URL
             FROM FlickrImages
             WHERE SearchName = ?
             '''
-    result_list = cur.execute(sql,[searchterm]).fetchall()
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        result_list = conn.execute(sql,[searchterm]).fetchall()
     for ea in result_list:
         # images.append(FlickrPhoto(ea[0],searchlat,searchlon,ea[1],ea[2],ea[3],ea[4],ea[5],ea[6]))
         images.append([ea[0],ea[1],ea[2]])
@@ -468,6 +2551,110 @@ def getflickr_fromdb(searchterm, searchlat,searchlon):
     return images
 
 
+#Nearby places for searchterm as a YelpPlaceBatch (batch.column('lat') etc. give NumPy arrays)
+def getnearby_columns(searchterm, db_name=DBNAME, readonly=False):
+    sql = '''SELECT Name, Latitude, Longitude, Rating, ReviewCount, Price, SearchName, URL
+            FROM YelpPlaces
+            WHERE SearchName = ?
+            '''
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        result_list = conn.execute(sql,[searchterm]).fetchall()
+    return YelpPlaceBatch.from_rows(result_list)
+
+#(name, rating) of each nearby place of searchterm, without the other columns
+def getnearby_ratings(searchterm, db_name=DBNAME, readonly=False):
+    sql = 'SELECT Name, Rating FROM YelpPlaces WHERE SearchName = ?'
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        return conn.execute(sql, [searchterm]).fetchall()
+
+
+#Ratings comparisons from the YelpSummary table: one indexed row per search place, whatever its number of places
+RATINGS_SUMMARY_SQL = '''
+    SELECT SearchName, Places, Rated, RatingSum, Reviews, WeightedRatingSum, Price1, Price2, Price3, Price4, PriceUnknown
+    FROM YelpSummary
+    '''
+
+def summary_from_row(row):
+    prices = dict(zip(PRICE_TIERS + ['None'], row[6:]))
+    return RatingsSummary(row[0], row[1], row[2], row[3], row[4], row[5], prices)
+
+#RatingsSummary for searchterm, or None if no nearby places are stored
+def ratings_summary(searchterm, db_name=DBNAME, readonly=False):
+    with timed_stage('db.query'), get_pool(db_name, readonly).connection() as conn:
+        row = conn.execute(RATINGS_SUMMARY_SQL + ' WHERE SearchName = ? AND Places > 0', [searchterm]).fetchone()
+    return None if row is None else summary_from_row(row)
+
+#Summaries for several search places, best review-weighted rating first (places with no data are left out)
+def compare_ratings(searchterms, db_name=DBNAME):
+    sql = RATINGS_SUMMARY_SQL + ' WHERE SearchName IN ({}) AND Places > 0'.format(','.join('?' * len(searchterms)))
+    with get_pool(db_name).connection() as conn:
+        rows = conn.execute(sql, list(searchterms)).fetchall() if len(searchterms) > 0 else []
+    summaries = [summary_from_row(ea) for ea in rows]
+    summaries.sort(key=lambda ea: -1 if ea.weighted is None else ea.weighted, reverse=True)
+    return summaries
+
+
+#Spatial lookups over every stored place, not just those found for one search term.
+#source is 'google', 'yelp' or 'all'; results are GooglePlace/YelpPlace objects.
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+def places_in_bbox(min_lat, max_lat, min_lon, max_lon, source='all', db_name=DBNAME):
+    places = []
+    google_sql = '''SELECT g.Name, g.Latitude, g.Longitude, g.Rating
+            FROM GooglePlacesRtree AS r JOIN GooglePlaces AS g ON g.Id = r.Id
+            WHERE r.MaxLat >= ? AND r.MinLat <= ? AND r.MaxLon >= ? AND r.MinLon <= ?
+                AND g.Latitude BETWEEN ? AND ? AND g.Longitude BETWEEN ? AND ?
+            '''
+    yelp_sql = '''SELECT y.Name, y.Latitude, y.Longitude, y.Rating, y.ReviewCount, y.Price, y.SearchName, y.URL
+            FROM YelpPlacesRtree AS r JOIN YelpPlaces AS y ON y.Id = r.Id
+            WHERE r.MaxLat >= ? AND r.MinLat <= ? AND r.MaxLon >= ? AND r.MinLon <= ?
+                AND y.Latitude BETWEEN ? AND ? AND y.Longitude BETWEEN ? AND ?
+            '''
+    #the rtree test finds candidates; the BETWEENs drop the ones only inside because of float32 rounding
+    params = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+    with get_pool(db_name).connection() as conn:
+        if source in ('google', 'all'):
+            for ea in conn.execute(google_sql, params):
+                places.append(GooglePlace(ea[0], ea[1], ea[2], ea[3]))
+        if source in ('yelp', 'all'):
+            for ea in conn.execute(yelp_sql, params):
+                places.append(YelpPlace(ea[0],ea[1],ea[2],ea[3], ea[4], ea[5], ea[6], ea[7]))
+    return places
+
+#[(distance in km, place), ...] within radius_km of (lat, lon), nearest first
+def places_within_radius(lat, lon, radius_km, source='all', db_name=DBNAME, limit=None):
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = max(-90.0, lat - dlat)
+    max_lat = min(90.0, lat + dlat)
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        boxes = [(-180.0, 180.0)] #circle covers a pole
+    else:
+        dlon = math.degrees(math.asin(min(1, math.sin(dlat * math.pi / 180) / math.cos(math.radians(lat)))))
+        if dlon >= 180 or lon - dlon < -180 and lon + dlon > 180:
+            boxes = [(-180.0, 180.0)]
+        elif lon - dlon < -180: #box wraps the antimeridian: split it in two
+            boxes = [(lon - dlon + 360, 180.0), (-180.0, lon + dlon)]
+        elif lon + dlon > 180:
+            boxes = [(lon - dlon, 180.0), (-180.0, lon + dlon - 360)]
+        else:
+            boxes = [(lon - dlon, lon + dlon)]
+    nearby = []
+    for (min_lon, max_lon) in boxes:
+        for place in places_in_bbox(min_lat, max_lat, min_lon, max_lon, source, db_name):
+            distance = haversine_km(lat, lon, place.lat, place.lon)
+            if distance <= radius_km:
+                nearby.append((distance, place))
+    nearby.sort(key=lambda ea: ea[0])
+    if limit is not None:
+        nearby = nearby[:limit]
+    return nearby
+
+
 #--------------------------------------------------------------------------------------------
 #-----DATA PRESENTATION:
 #--------------------------------------------------------------------------------------------
@@ -488,7 +2675,7 @@ def disp_options():
 
 def showlist(searchterm):
     num = 1
-    places = getnearby_fromdb(searchterm)
+    places = getnearby_columns(searchterm)
     for item in places:
         print('{}. {} ({}) '.format(num, item.name,item.rating))
         num += 1
@@ -498,54 +2685,122 @@ def showlist(searchterm):
 
 
 
-def getmaxmin(data_lat,data_lon):
-    
-    min_lat = 10000
-    max_lat = -10000
-    min_lon = 10000
-    max_lon = -10000
-
-    for str_v in data_lat:
-        v = float(str_v)
-        if v < min_lat:
-            min_lat = v
-        if v > max_lat:
-            max_lat = v
-    for str_v in data_lon:
-        v = float(str_v)
-        if v < min_lon:
-            min_lon = v
-        if v > max_lon:
-            max_lon = v
-
-    lat_axis = [min_lat, max_lat]
-    lon_axis = [min_lon, max_lon]
+MAP_PADDING = .50 #fraction of the larger extent added on every side of the points
+MAP_WIDTH_PX = 1000 #viewport the mapbox zoom level is fitted to
+MAP_HEIGHT_PX = 700
+MAP_MAX_ZOOM = 18
+MAP_CLUSTER_PX = 24 #nearby places closer than about this many pixels at the map's zoom share one marker
+MAP_MAX_MARKERS = 500 #the grid is coarsened until no more markers than this are left
 
+#Extents, padded axes and center of the points; takes lists or NumPy arrays (numbers or numeric strings).
+#Points on both sides of the antimeridian are measured the short way round: the longitudes are then taken
+#in 0..360, so lon_axis can run past 180 (e.g. [178, 182]) and the center is brought back into -180..180.
+def getmaxmin(data_lat,data_lon):
+    lat = np.asarray(data_lat, dtype=float)
+    lon = np.asarray(data_lon, dtype=float)
+
+    min_lat = float(np.nanmin(lat))
+    max_lat = float(np.nanmax(lat))
+    min_lon = float(np.nanmin(lon))
+    max_lon = float(np.nanmax(lon))
+    wrapped = lon % 360
+    if max_lon - min_lon > 180 and float(np.nanmax(wrapped) - np.nanmin(wrapped)) < max_lon - min_lon:
+        min_lon = float(np.nanmin(wrapped))
+        max_lon = float(np.nanmax(wrapped))
 
     max_range = max(abs(max_lat - min_lat), abs(max_lon - min_lon))
-    padding = max_range * .50
+    padding = max_range * MAP_PADDING
     lat_axis = [min_lat - padding, max_lat + padding]
     lon_axis = [min_lon - padding, max_lon + padding]
 
     center_lat = (max_lat+min_lat) / 2
     center_lon = (max_lon+min_lon) / 2
+    if center_lon >= 180:
+        center_lon -= 360
 
     return (center_lat,center_lon,lat_axis,lon_axis)
 
+#Largest Web Mercator zoom (512px tiles, as mapbox uses) at which both axes fit the viewport
+def mapbox_zoom(lat_axis, lon_axis, width_px=MAP_WIDTH_PX, height_px=MAP_HEIGHT_PX):
+    lat = np.radians(np.clip(np.asarray(lat_axis, dtype=float), -85.0511, 85.0511))
+    mercator_y = np.log(np.tan(np.pi / 4 + lat / 2))
+    lat_span = max(abs(mercator_y[1] - mercator_y[0]), 1e-9) #in radians of the projected y axis
+    lon_span = max(abs(lon_axis[1] - lon_axis[0]), 1e-9)
+    zoom_lon = np.log2(width_px * 360.0 / (512 * lon_span))
+    zoom_lat = np.log2(height_px * 2 * np.pi / (512 * lat_span))
+    return float(np.clip(min(zoom_lon, zoom_lat), 0, MAP_MAX_ZOOM))
+
+
+#Figures are written as self-contained HTML files (plotly.js embedded) under FIGURE_DIR and opened in the
+#browser; RENDER_BACKEND = 'online' uploads them to the plotly service instead, as before. A file is named
+#after a hash of the figure's data and layout, so a view whose data has not changed is reopened without
+#being rendered again.
+RENDER_BACKEND = 'offline'
+FIGURE_DIR = 'figures'
+
+def figure_path(fig, name):
+    text = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder, sort_keys=True)
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    slug = re.sub('[^A-Za-z0-9]+', '-', name).strip('-').lower()
+    return os.path.join(FIGURE_DIR, '{}-{}.html'.format(slug, digest))
+
+#Writes (unless already cached) and optionally opens fig; returns the file path, or the plotly url when online
+def render_figure(fig, name, auto_open=True):
+    if RENDER_BACKEND == 'online':
+        with timed_stage('render.online'):
+            return py.plot(fig, validate=False, filename=name, auto_open=auto_open)
+    with timed_stage('render.hash'):
+        path = figure_path(fig, name)
+    if not os.path.exists(path):
+        count_event('render.miss')
+        os.makedirs(FIGURE_DIR, exist_ok=True)
+        #renamed into place once complete, so a cached file is never half written (plotly adds .html to any other name)
+        partial = path[:-len('.html')] + '.partial.html'
+        with timed_stage('render.offline'):
+            plotly.offline.plot(fig, validate=False, filename=partial, auto_open=False, include_plotlyjs=True)
+        os.replace(partial, path)
+    else:
+        count_event('render.hit')
+    if auto_open:
+        webbrowser.open('file://' + os.path.abspath(path))
+    return path
+
+#Grid clustering of markers at a given mapbox zoom: points are projected to Web Mercator pixels (512px tiles)
+#and grouped by cell_px square cells, each group becoming one marker at its centroid. The cells double in size
+#until at most max_markers remain, so the figure stays small however many points there are.
+#Returns (lat, lon, count, text) arrays; text is the place name for a single point, else the number of places.
+def cluster_markers(data_lat, data_lon, names, zoom, cell_px=MAP_CLUSTER_PX, max_markers=MAP_MAX_MARKERS):
+    lat = np.asarray(data_lat, dtype=float)
+    lon = np.asarray(data_lon, dtype=float)
+    keep = ~(np.isnan(lat) | np.isnan(lon))
+    (lat, lon, names) = (lat[keep], lon[keep], np.asarray(names, dtype=object)[keep])
+    if len(lat) == 0:
+        return (lat, lon, np.zeros(0, dtype=int), [])
+    world_px = 512 * 2 ** zoom
+    x = (lon + 180) / 360 * world_px
+    y = (1 - np.log(np.tan(np.pi / 4 + np.radians(np.clip(lat, -85.0511, 85.0511)) / 2)) / np.pi) / 2 * world_px
+    while True:
+        cells = np.floor(x / cell_px).astype(np.int64) * (int(world_px / cell_px) + 2) + np.floor(y / cell_px).astype(np.int64)
+        (keys, first, groups, counts) = np.unique(cells, return_index=True, return_inverse=True, return_counts=True)
+        if len(keys) <= max_markers:
+            break
+        cell_px *= 2
+    center_lat = np.bincount(groups, weights=lat) / counts
+    center_lon = np.bincount(groups, weights=lon) / counts
+    text = [names[i] if count == 1 else '{} places'.format(count) for (i, count) in zip(first, counts)]
+    return (center_lat, center_lon, counts, text)
 
-def showmap(searchname, searchlat, searchlon):
-    nearbylat = []
-    nearbylon = []
-    nearbyname = []
+#Marker sizes growing with the log of the cluster size
+def cluster_sizes(counts, size):
+    return (size + 4 * np.log2(np.asarray(counts, dtype=float))).tolist()
 
-    nearbyplaces = getnearby_fromdb(searchname)
-    for ea in nearbyplaces:
-        nearbylat.append(ea.lat)
-        nearbylon.append(ea.lon)
-        nearbyname.append(ea.name)
 
+def map_figure(searchname, searchlat, searchlon, db_name=DBNAME):
+    nearby = getnearby_columns(searchname, db_name)
 
-    (center_lat, center_lon, lat_axis, lon_axis) = getmaxmin(nearbylat,nearbylon)
+    #the search place is included so the map is never empty
+    (center_lat, center_lon, lat_axis, lon_axis) = getmaxmin(np.append(nearby.column('lat'), searchlat), np.append(nearby.column('lon'), searchlon))
+    (nearbylat, nearbylon, counts, nearbyname) = cluster_markers(nearby.column('lat'), nearby.column('lon'), nearby.values('name'), mapbox_zoom(lat_axis, lon_axis))
     
     Place = dict(
         type = 'scattergeo',
@@ -564,12 +2819,12 @@ def showmap(searchname, searchlat, searchlon):
     Nearby = dict(
         type = 'scattergeo',
         locationmode = 'USA-states',
-        lon = nearbylon,
-        lat = nearbylat,
+        lon = nearbylon.tolist(),
+        lat = nearbylat.tolist(),
         text = nearbyname,
         mode = 'markers',
         marker = dict(
-            size = 6,
+            size = cluster_sizes(counts, 6),
             symbol = 'circle',
             color = 'blue',
         name = 'Nearby Places'
@@ -595,22 +2850,20 @@ def showmap(searchname, searchlat, searchlon):
     )
     
     fig1 = dict(data=data, layout=layout1 )
-    py.plot(fig1, validate=False, filename='Nearby Places' )
+    return fig1
 
+def showmap(searchname, searchlat, searchlon):
+    with timed_stage('figure.build'):
+        fig = map_figure(searchname, searchlat, searchlon)
+    render_figure(fig, 'Nearby Places')
 
-def showmap_mapbox(searchname, searchlat, searchlon):
-    nearbylat = []
-    nearbylon = []
-    nearbyname = []
-
-    nearbyplaces = getnearby_fromdb(searchname)
-    for ea in nearbyplaces:
-        nearbylat.append(ea.lat)
-        nearbylon.append(ea.lon)
-        nearbyname.append(ea.name)
 
+def mapbox_figure(searchname, searchlat, searchlon, db_name=DBNAME):
+    nearby = getnearby_columns(searchname, db_name)
 
-    (center_lat, center_lon, lat_axis, lon_axis) = getmaxmin(nearbylat,nearbylon)
+    (center_lat, center_lon, lat_axis, lon_axis) = getmaxmin(np.append(nearby.column('lat'), searchlat), np.append(nearby.column('lon'), searchlon))
+    zoom = mapbox_zoom(lat_axis, lon_axis)
+    (nearbylat, nearbylon, counts, nearbyname) = cluster_markers(nearby.column('lat'), nearby.column('lon'), nearby.values('name'), zoom)
     
     data = Data([
     Scattermapbox(
@@ -626,11 +2879,11 @@ def showmap_mapbox(searchname, searchlat, searchlon):
         hoverinfo = 'text'
             ),
         Scattermapbox(
-        lat=nearbylat,
-        lon=nearbylon,
+        lat=nearbylat.tolist(),
+        lon=nearbylon.tolist(),
         mode='markers',
         marker=Marker(
-            size=8,
+            size=cluster_sizes(counts, 8),
             color = 'rgb(0, 0, 255)'
         ),
         text=nearbyname,
@@ -649,22 +2902,27 @@ def showmap_mapbox(searchname, searchlat, searchlon):
             lon=center_lon
         ),
         pitch=0,
-        zoom=12
+        zoom=zoom
         ),
     )
 
             
     fig1 = dict(data=data, layout=layout )
-    py.plot(fig1, validate=False, filename='Nearby Places' )
+    return fig1
+
+def showmap_mapbox(searchname, searchlat, searchlon):
+    with timed_stage('figure.build'):
+        fig = mapbox_figure(searchname, searchlat, searchlon)
+    render_figure(fig, 'Nearby Places Mapbox')
 
 
-def showratings(searchterm):
-    nearby = getnearby_fromdb(searchterm)
-    places = []
-    ratings = []
-    for ea in nearby:
-        places.append(ea.name)
-        ratings.append(ea.rating)
+#A bar for the rating of each nearby place, then the average and review-weighted rating of them all. The
+#averages and counts come from the place's YelpSummary row; the per-place bars are what the chart compares, so
+#they still take one read of its YelpPlaces rows (names and ratings only), which no aggregate can replace.
+def ratings_figure(searchterm, db_name=DBNAME):
+    nearby = getnearby_ratings(searchterm, db_name)
+    places = [ea[0] for ea in nearby]
+    ratings = [ea[1] for ea in nearby]
 
 
     trace0 = go.Bar(
@@ -681,98 +2939,424 @@ def showratings(searchterm):
     )
 
     data = [trace0]
+    summary = ratings_summary(searchterm, db_name)
+    title = 'Nearby Ratings'
+    if summary is not None and summary.average is not None:
+        trace1 = go.Bar(
+        y = ['Average of {}'.format(summary.rated), 'Review-weighted ({} reviews)'.format(summary.reviews)],
+        x = [summary.average, summary.weighted],
+        orientation = 'h',
+        marker=dict(color='rgb(255, 127, 14)'),
+        )
+        data.append(trace1)
+        title = 'Nearby Ratings (average {:.2f}, review-weighted {:.2f})'.format(summary.average, summary.weighted)
     layout2 = go.Layout(
-    title='Nearby Ratings',
+    title=title,
     )
 
     fig2 = dict(data=data, layout=layout2)
-    py.plot(fig2, filename='Nearby Ratings')
+    return fig2
+
+def showratings(searchterm):
+    with timed_stage('figure.build'):
+        fig = ratings_figure(searchterm)
+    render_figure(fig, 'Nearby Ratings')
+
+
+FIGURE_BUILDERS = {
+    'map': (map_figure, 'Nearby Places'),
+    'mapbox': (mapbox_figure, 'Nearby Places Mapbox'),
+    'ratings': (lambda searchname, searchlat, searchlon, db_name: ratings_figure(searchname, db_name), 'Nearby Ratings'),
+}
+
+#Renders the given kinds of figure for every stored search place in searchterms without opening them;
+#returns {searchterm: {kind: path}}. Search terms that are not in the database are skipped.
+def export_figures(searchterms, kinds=('map', 'mapbox', 'ratings'), db_name=DBNAME):
+    sql = 'SELECT Name, Latitude, Longitude FROM GooglePlaces WHERE Name = ?'
+    paths = {}
+    for searchterm in searchterms:
+        with get_pool(db_name).connection() as conn:
+            place = conn.execute(sql, [searchterm]).fetchone()
+        if place is None:
+            print("Skipping '{}': not in the database".format(searchterm))
+            continue
+        paths[searchterm] = {}
+        for kind in kinds:
+            (builder, name) = FIGURE_BUILDERS[kind]
+            fig = builder(place[0], place[1], place[2], db_name)
+            paths[searchterm][kind] = render_figure(fig, '{} {}'.format(name, searchterm), auto_open=False)
+    return paths
+
+def export_main(args):
+    parser = argparse.ArgumentParser(prog='final.py export', description='Write map and ratings figures as HTML files')
+    parser.add_argument('terms', help='file with one search term per line, or - for stdin')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--kinds', default='map,mapbox,ratings', help='comma separated: ' + ', '.join(sorted(FIGURE_BUILDERS)))
+    options = parser.parse_args(args)
+    paths = export_figures(read_search_terms(options.terms), options.kinds.split(','), options.db)
+    print("Wrote {} figures to {}".format(sum(len(ea) for ea in paths.values()), FIGURE_DIR))
 
 
 
 def showimage(searchterm, searchlat,searchlon):
-    images = getflickr_fromdb(searchterm,searchlat,searchlon)
-    rand_num = []
-    selectimages = []
-    ct = 0
+    selectimages = getrandomphotos_fromdb(searchterm, 10)
+    if len(selectimages) == 0:
+        print("No images found near {}".format(searchterm))
+        return
     sel = 1
-    while ct < 10:
-        rand_num.append(random.randint(0,199))
-        ct += 1
-    for num in rand_num:
-        print("{}. {}".format(sel,images[num][0]))
+    for image in selectimages:
+        print("{}. {}".format(sel,image[0]))
         sel += 1
-        selectimages.append([images[num][0],images[num][1],images[num][2]])
 
     select = input("Which image do you want to see? ")
     webbrowser.open(selectimages[int(select)-1][2])
 
 
+#--------------------------------------------------------------------------------------------
+#-----BATCH INGESTION
+#--------------------------------------------------------------------------------------------
+#Headless population of the database from a list of search terms: "python3 final.py ingest terms.txt".
+#Each term passes through the stages google -> yelp -> flickr -> write, which run on their own threads
+#connected by bounded queues, so a slow stage holds back the ones before it instead of piling up work.
+#Only the write stage touches the database; it records each finished term in a checkpoint file, and a
+#rerun skips the terms listed there (the inserts are upserts, so a term cut off half way is safe to redo).
+INGEST_CHECKPOINT_FNAME = 'ingest_checkpoint.txt'
+INGEST_QUEUE_SIZE = 16 #items waiting between two stages
+INGEST_WORKERS = 4 #threads per network stage
+INGEST_REPORT_EVERY = 100 #terms between progress lines
+INGEST_STOP = object() #end-of-input marker passed down the queues
+
+
+#A pool of threads applying work(item) to the items in inbox and putting the results in outbox.
+#Items that raise are counted and dropped; the last worker to finish passes INGEST_STOP on.
+class IngestStage():
+    def __init__(self, name, work, inbox, outbox, workers=1):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.workers = workers
+        self.running = workers
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for ct in range(self.workers):
+            thread = threading.Thread(target=self.run, name='ingest-{}-{}'.format(self.name, ct), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is INGEST_STOP:
+                self.inbox.put(INGEST_STOP) #for the other workers of this stage
+                break
+            start = time.time()
+            try:
+                result = self.work(item)
+            except Exception as e:
+                result = None
+                with self.lock:
+                    self.failed += 1
+                print("{} failed for '{}': {}: {}".format(self.name, item[0], type(e).__name__, e))
+            with self.lock:
+                self.items += 1
+                self.busy += time.time() - start
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.outbox is not None:
+            self.outbox.put(INGEST_STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    #items/second of wall time and per busy worker second
+    def report(self, elapsed):
+        with self.lock:
+            return {'stage': self.name, 'items': self.items, 'failed': self.failed,
+                'per_sec': self.items / max(elapsed, 1e-9), 'per_busy_sec': self.items / max(self.busy, 1e-9)}
+
+
+def read_search_terms(fname):
+    f = sys.stdin if fname == '-' else open(fname)
+    try:
+        terms = []
+        seen = set()
+        for line in f:
+            term = line.strip()
+            if term != '' and term not in seen:
+                seen.add(term)
+                terms.append(term)
+        return terms
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def read_checkpoint(fname):
+    if not os.path.exists(fname):
+        return set()
+    with open(fname) as f:
+        return set(line.rstrip('\n') for line in f if line.strip() != '')
+
+def ingest_places(item, max_pages):
+    (term, ) = item
+    places = GooglePlaceBatch()
+    for batch in iter_place_batches(term, max_pages):
+        for ea in batch:
+            places.append(ea.name, ea.lat, ea.lon, ea.rating)
+    return (term, places)
+
+def ingest_yelp(item, max_pages):
+    (term, places) = item
+    yelpplaces = [list(iter_yelp_batches(ea.lat, ea.lon, ea.name, max_pages)) for ea in places]
+    return (term, places, yelpplaces)
+
+def ingest_flickr(item, max_pages):
+    (term, places, yelpplaces) = item
+    photos = [list(iter_flickr_batches(ea.lat, ea.lon, ea.name, "Google", max_pages)) for ea in places]
+    return (term, places, yelpplaces, photos)
+
+#Places first: the Yelp and Flickr rows look up their SearchId by place name
+def ingest_write(item, db_name, checkpoint):
+    (term, places, yelpplaces, photos) = item
+    insert_google_data(places, db_name)
+    for (yelp_batches, photo_batches) in zip(yelpplaces, photos):
+        insert_stream(yelp_batches, insert_yelp_data, db_name)
+        insert_stream(photo_batches, insert_flickr_data, db_name)
+    checkpoint.write(term + '\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+#The thread pipeline: network-bound work overlaps, but parsing shares one core
+def ingest_in_threads(todo, db_name, checkpoint, workers, max_pages, queue_size, start):
+    queues = [queue.Queue(queue_size) for ct in range(4)]
+    stages = [
+        IngestStage('google', lambda item: ingest_places(item, max_pages), queues[0], queues[1], workers),
+        IngestStage('yelp', lambda item: ingest_yelp(item, max_pages), queues[1], queues[2], workers),
+        IngestStage('flickr', lambda item: ingest_flickr(item, max_pages), queues[2], queues[3], workers),
+        IngestStage('write', lambda item: ingest_write(item, db_name, checkpoint), queues[3], None, 1),
+    ]
+    for stage in stages:
+        stage.start()
+    for ct, term in enumerate(todo):
+        queues[0].put((term, ))
+        if ct > 0 and ct % INGEST_REPORT_EVERY == 0:
+            print("{} terms queued, {} written, {:.1f}s".format(ct, stages[-1].items, time.time() - start))
+    queues[0].put(INGEST_STOP)
+    for stage in stages:
+        stage.join()
+    elapsed = time.time() - start
+    return [stage.report(elapsed) for stage in stages]
+
+
+#Process mode, for re-ingesting a warm cache: worker processes parse shards of INGEST_SHARD_TERMS consecutive
+#terms from the cache and send the batches back; this process is the only writer and writes the shards in
+#input order, so the same terms always give the same database. At most INGEST_SHARD_WINDOW shards per
+#worker are in flight. Workers open the cache read-only and replay it as --offline does (CacheLayer.get leaves
+#expired and unreadable entries in place), so requests that are not cached fail as CacheMiss and only this
+#process ever changes the cache files.
+INGEST_SHARD_TERMS = 8
+INGEST_SHARD_WINDOW = 2
+
+def ingest_worker_init():
+    global REQUEST_LOG, CACHE_ONLY, CACHE_DICTION
+    REQUEST_LOG = False
+    CACHE_ONLY = True
+    CACHE_DICTION = CacheLayer(LazyCache(readonly=True))
+
+#Runs in a worker process; returns (term, places, yelp batches, photo batches), or (term, error) for a failed term
+def ingest_parse_shard(terms, max_pages):
+    results = []
+    for term in terms:
+        try:
+            results.append(ingest_flickr(ingest_yelp(ingest_places((term, ), max_pages), max_pages), max_pages))
+        except Exception as e:
+            results.append((term, '{}: {}'.format(type(e).__name__, e)))
+    return results
+
+def ingest_in_processes(todo, db_name, checkpoint, processes, max_pages, start):
+    shards = [todo[ct:ct + INGEST_SHARD_TERMS] for ct in range(0, len(todo), INGEST_SHARD_TERMS)]
+    counts = {'parse': [0, 0, 0.0], 'write': [0, 0, 0.0]} #items, failed, busy seconds
+    next_report = INGEST_REPORT_EVERY
+    context = multiprocessing.get_context('spawn') #a fresh interpreter: no inherited locks, connections or cache handles
+    with context.Pool(processes, initializer=ingest_worker_init) as pool:
+        pending = collections.deque()
+        shard_iter = iter(shards)
+        for shard in itertools.islice(shard_iter, processes * INGEST_SHARD_WINDOW):
+            pending.append(pool.apply_async(ingest_parse_shard, (shard, max_pages)))
+        while len(pending) > 0:
+            wait = time.time()
+            results = pending.popleft().get()
+            counts['parse'][2] += time.time() - wait
+            for shard in itertools.islice(shard_iter, 1):
+                pending.append(pool.apply_async(ingest_parse_shard, (shard, max_pages)))
+            for item in results:
+                counts['parse'][0] += 1
+                if len(item) == 2:
+                    counts['parse'][1] += 1
+                    print("parse failed for '{}': {}".format(item[0], item[1]))
+                    continue
+                wait = time.time()
+                try:
+                    ingest_write(item, db_name, checkpoint)
+                except Exception as e:
+                    counts['write'][1] += 1
+                    print("write failed for '{}': {}: {}".format(item[0], type(e).__name__, e))
+                counts['write'][0] += 1
+                counts['write'][2] += time.time() - wait
+            if counts['parse'][0] >= next_report:
+                print("{} terms parsed, {} written, {:.1f}s".format(counts['parse'][0], counts['write'][0], time.time() - start))
+                next_report += INGEST_REPORT_EVERY
+    elapsed = time.time() - start
+    #parse busy time is this process waiting on the workers, so per_busy_sec is per worker process
+    return [{'stage': name, 'items': items, 'failed': failed, 'per_sec': items / max(elapsed, 1e-9),
+        'per_busy_sec': items / max(busy * (processes if name == 'parse' else 1), 1e-9)}
+        for (name, (items, failed, busy)) in [('parse', counts['parse']), ('write', counts['write'])]]
+
+#Runs every term not yet in the checkpoint through the pipeline; returns the per-stage reports.
+#offline=True replays responses from the cache and fails the terms that would need the network.
+#processes > 1 parses in that many worker processes (cache only) with this process as the single writer.
+def ingest(terms, db_name=DBNAME, checkpoint_fname=INGEST_CHECKPOINT_FNAME, workers=INGEST_WORKERS,
+        max_pages=1, offline=False, queue_size=INGEST_QUEUE_SIZE, processes=1):
+    global REQUEST_LOG, CACHE_ONLY
+    done = read_checkpoint(checkpoint_fname)
+    todo = [term for term in terms if term not in done]
+    print("Ingesting {} search terms ({} already done)".format(len(todo), len(terms) - len(todo)))
+    init_db(db_name)
+    (request_log, cache_only) = (REQUEST_LOG, CACHE_ONLY)
+    REQUEST_LOG = False
+    CACHE_ONLY = offline
+    checkpoint = open(checkpoint_fname, 'a')
+    start = time.time()
+    try:
+        if processes > 1:
+            reports = ingest_in_processes(todo, db_name, checkpoint, processes, max_pages, start)
+        else:
+            reports = ingest_in_threads(todo, db_name, checkpoint, workers, max_pages, queue_size, start)
+    finally:
+        checkpoint.close()
+        (REQUEST_LOG, CACHE_ONLY) = (request_log, cache_only)
+    written = reports[-1]
+    print("Ingested {} of {} search terms in {:.1f}s".format(written['items'] - written['failed'], len(todo), time.time() - start))
+    for ea in reports:
+        print("{:8} {:6} items {:4} failed {:10.1f}/s {:10.1f}/s per worker".format(
+            ea['stage'], ea['items'], ea['failed'], ea['per_sec'], ea['per_busy_sec']))
+    return reports
+
+def ingest_main(args):
+    parser = argparse.ArgumentParser(prog='final.py ingest', description='Populate the database from a list of search terms')
+    parser.add_argument('terms', help='file with one search term per line, or - for stdin')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--checkpoint', default=INGEST_CHECKPOINT_FNAME)
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help='threads per network stage')
+    parser.add_argument('--max-pages', type=int, default=1, help='result pages per request (0 = all)')
+    parser.add_argument('--offline', action='store_true', help='replay cached responses only')
+    parser.add_argument('--processes', type=int, default=1, help='parse a warm cache in this many processes')
+    parser.add_argument('--fixtures', metavar='DIR', help='replay responses from the fixtures in DIR instead of the network')
+    parser.add_argument('--record', action='store_true', help='with --fixtures, record the responses into DIR')
+    options = parser.parse_args(args)
+    if options.fixtures is not None:
+        use_fixtures(options.fixtures, 'record' if options.record else 'replay', 0.0)
+    ingest(read_search_terms(options.terms), options.db, options.checkpoint, options.workers,
+        options.max_pages or None, options.offline, processes=options.processes)
+
+
+#"python3 final.py migrate [--rebuild] [db]": create or upgrade the database without prompts
+def migrate_main(args):
+    parser = argparse.ArgumentParser(prog='final.py migrate', description='Create or upgrade the database schema')
+    parser.add_argument('db', nargs='?', default=DBNAME)
+    parser.add_argument('--rebuild', action='store_true', help='rewrite into a new file and copy it back in one transaction')
+    options = parser.parse_args(args)
+    if options.rebuild:
+        rebuild_db(options.db)
+    else:
+        init_db(options.db)
+    conn = sqlite3.connect(options.db)
+    print("{} is at schema version {}".format(options.db, schema_version(conn.cursor())))
+    conn.close()
+
+#"python3 final.py metrics [metrics.jsonl]": where the time of all measured searches (or displays) went
+def metrics_main(args):
+    parser = argparse.ArgumentParser(prog='final.py metrics', description='Aggregate the per-search metrics log')
+    parser.add_argument('fname', nargs='?', default=METRICS_FNAME)
+    parser.add_argument('--kind', default='search', choices=['search', 'display'])
+    options = parser.parse_args(args)
+    totals = aggregate_metrics(options.fname, options.kind)
+    if totals is None:
+        print("No {} metrics in {}".format(options.kind, options.fname))
+        return
+    label = "{} {} runs (p50 {:.2f}s, p95 {:.2f}s)".format(totals['runs'], options.kind, totals['wall_p50'], totals['wall_p95'])
+    print_metrics(label, totals['wall'], totals['stages'], totals['counters'])
+
+#"python3 final.py rekey [--json cache.json]": move cached responses to the canonical cache keys
+def rekey_main(args):
+    parser = argparse.ArgumentParser(prog='final.py rekey', description='Move cached responses to canonical cache keys')
+    parser.add_argument('--json', metavar='FILE', help='rekey this cache.json file instead of the {} store'.format(CACHE_BACKEND))
+    parser.add_argument('--coord-decimals', type=int, default=CACHE_COORD_DECIMALS, help='decimal places kept in coordinates')
+    options = parser.parse_args(args)
+    report = rekey_cache(options.json, options.coord_decimals)
+    CACHE_DICTION.close()
+    print("Rekeyed {} of {} entries, {} merged, {} entries left".format(
+        report['rekeyed'], report['entries_before'], report['merged'], report['entries_after']))
+    print("{:.1%} of the rekeyed entries were merged into an entry they now share a key with".format(report['merge_rate']))
+
+
 #--------------------------------------------------------------------------------------------
 #-----USER INTERFACE:
 #--------------------------------------------------------------------------------------------
 #Select from a random list of places - display a list of places with identifiers
 #Enter a search term
-def user_search(searchterm):
-    DBNAME = 'final.db'
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
-
-    selectsearchstatement = '''
-                SELECT Name,Latitude,Longitude,Rating
-                FROM GooglePlaces
-                WHERE GooglePlaces.Name = ?
-                '''
-    searchresult = cur.execute(selectsearchstatement,[searchterm]).fetchall()
-
-    if len(searchresult) > 0:
-        # print(type(searchresult))
-        # print(len(searchresult))
-        places = []
-        for ea in searchresult:
-            places.append(GooglePlace(ea[0], ea[1], ea[2], ea[3]))
-        # for ea in searchresult:
-        #   print(ea[0],ea[1],ea[2],ea[3])
-    else:
-        print("No results in existing database - New search initiated")
-        places = get_place_info(searchterm)
+SEARCH_CONCURRENCY = 8 #max Yelp/Flickr calls in flight during a new search (1 = one after another)
+
+def user_search(searchterm, concurrency=None, db_name=DBNAME):
+    if concurrency is None:
+        concurrency = SEARCH_CONCURRENCY
+    with measure('search', searchterm=searchterm): #prints the time spent in each stage
+        selectsearchstatement = '''
+                    SELECT Name,Latitude,Longitude,Rating
+                    FROM GooglePlaces
+                    WHERE GooglePlaces.Name = ?
+                    '''
+        with timed_stage('db.query'), get_pool(db_name).connection() as conn: #not held while waiting on the network
+            searchresult = conn.execute(selectsearchstatement,[searchterm]).fetchall()
+
+        if len(searchresult) > 0:
+            places = []
+            for ea in searchresult:
+                places.append(GooglePlace(ea[0], ea[1], ea[2], ea[3]))
+        else:
+            print("No results in existing database - New search initiated")
+            places = get_place_info(searchterm)
         
-        insert_google_data(places,DBNAME)
+            insert_google_data(places,db_name)
         
-        for ea,val in enumerate(places):
-            yelpplaces = get_yelp_info(places[ea].lat,places[ea].lon, places[ea].name)
-            photos = get_flickr_photos(places[ea].lat,places[ea].lon, places[ea].name, "Google")
-
-            insert_yelp_data(yelpplaces,DBNAME)
-            insert_flickr_data(photos,DBNAME)
+            if concurrency <= 1:
+                #one call at a time: stream each response's records straight into the database
+                for ea,val in enumerate(places):
+                    insert_stream(stream_yelp_batches(places[ea].lat,places[ea].lon, places[ea].name), insert_yelp_data, db_name)
+                    insert_stream(stream_flickr_batches(places[ea].lat,places[ea].lon, places[ea].name, "Google"), insert_flickr_data, db_name)
+            else:
+                #provider calls run on the pool; inserts stay on this thread, in the order of places
+                with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    yelp_futures = [executor.submit(get_yelp_batch, ea.lat, ea.lon, ea.name) for ea in places]
+                    flickr_futures = [executor.submit(get_flickr_batch, ea.lat, ea.lon, ea.name, "Google") for ea in places]
+                    for yelp_future, flickr_future in zip(yelp_futures, flickr_futures):
+                        insert_yelp_data(yelp_future.result(),db_name)
+                        insert_flickr_data(flickr_future.result(),db_name)
 
-    conn.close()
     return places
 
-def generate_userlist():
+def generate_userlist(db_name=DBNAME):
     #select 10 places form googleplaces to display
-    rand_num = []
-    placelist = []
-    ct = 0
-    while ct < 10:
-        rand_num.append(random.randint(0,99))
-        # rand_num.append(random.randint(0,3))
-        ct += 1
-    # print(rand_num)
-
-    DBNAME = 'final.db'
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
-
-    sql = '''SELECT Name, Latitude, Longitude, Rating
-            FROM GooglePlaces'''
-    results = cur.execute(sql).fetchall()
-
-    for num in rand_num:
-        placelist.append(GooglePlace(results[num][0],results[num][1],results[num][2],results[num][3]))
-    
-    conn.close()
-    return placelist
+    return getrandomplaces_fromdb(10, db_name)
 
 def load_helpfile():
     with open('help.txt') as f:
@@ -805,23 +3389,24 @@ def user_interface():
                 print(disp_options())
                 pres = 1
                 presentationchoice = input('What would you like to see? ')
-                if int(presentationchoice) == 1:
-                    showlist(places[int(response)-1].name)
+                with measure('display', searchterm=places[int(response)-1].name, choice=presentationchoice):
+                    if int(presentationchoice) == 1:
+                        showlist(places[int(response)-1].name)
 
-                elif int(presentationchoice) == 2:
-                    # showmap(places[int(response)-1].name, places[int(response)-1].lat, places[int(response)-1].lon)
-                    showmap_mapbox(places[int(response)-1].name, places[int(response)-1].lat, places[int(response)-1].lon)
-                elif int(presentationchoice) == 3:
-                    showratings(places[int(response)-1].name)
+                    elif int(presentationchoice) == 2:
+                        # showmap(places[int(response)-1].name, places[int(response)-1].lat, places[int(response)-1].lon)
+                        showmap_mapbox(places[int(response)-1].name, places[int(response)-1].lat, places[int(response)-1].lon)
+                    elif int(presentationchoice) == 3:
+                        showratings(places[int(response)-1].name)
 
-                elif int(presentationchoice) == 4:
-                    showimage(places[int(response)-1].name,places[int(response)-1].lat, places[int(response)-1].lon)
+                    elif int(presentationchoice) == 4:
+                        showimage(places[int(response)-1].name,places[int(response)-1].lat, places[int(response)-1].lon)
 
-                elif int(presentationchoice) == 5:
-                    continue
+                    elif int(presentationchoice) == 5:
+                        continue
 
-                else:
-                    print("Unknown Command")
+                    else:
+                        print("Unknown Command")
 
             elif len(response) > 2:
                 num2 = 1
@@ -840,24 +3425,25 @@ def user_interface():
                     print(disp_options())
                     pres = 1
                     presentationchoice = input('What would you like to see? ')
-                    if int(presentationchoice) == 1:
-                        showlist(result.name)
+                    with measure('display', searchterm=result.name, choice=presentationchoice):
+                        if int(presentationchoice) == 1:
+                            showlist(result.name)
 
-                    elif int(presentationchoice) == 2:
-                        # showmap(result.name, result.lat, result.lon)
-                        showmap_mapbox(result.name, result.lat, result.lon)
+                        elif int(presentationchoice) == 2:
+                            # showmap(result.name, result.lat, result.lon)
+                            showmap_mapbox(result.name, result.lat, result.lon)
 
-                    elif int(presentationchoice) == 3:
-                        showratings(result.name)
+                        elif int(presentationchoice) == 3:
+                            showratings(result.name)
 
-                    elif int(presentationchoice) == 4:
-                        showimage(result.name,result.lat, result.lon)
+                        elif int(presentationchoice) == 4:
+                            showimage(result.name,result.lat, result.lon)
 
-                    elif int(presentationchoice) == 5:
-                        continue
+                        elif int(presentationchoice) == 5:
+                            continue
                     
-                    else:
-                        print("Unknown Command")
+                        else:
+                            print("Unknown Command")
                 else:
                     print("Unable to find in Google Place Search")
 
@@ -868,7 +3454,21 @@ def user_interface():
 #--------------------------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    user_interface()
+    if len(sys.argv) > 1 and sys.argv[1] == 'ingest':
+        ingest_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        migrate_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'export':
+        export_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'rekey':
+        rekey_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'metrics':
+        metrics_main(sys.argv[2:])
+    else:
+        PROFILE = '--profile' in sys.argv[1:]
+        if PROFILE:
+            atexit.register(dump_cache_stats)
+        user_interface()
 
 
     # init_db(DBNAME2)
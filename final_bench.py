@@ -0,0 +1,332 @@
+#Benchmarks for final.py that run without API keys or network access.
+#Type "python3 final_bench.py" for every benchmark, or name some: "python3 final_bench.py stages"
+
+import tempfile
+import time
+import io
+from final import *
+
+#--------------------------------------------------------------------------------------------
+#-----SAMPLE DATA
+#--------------------------------------------------------------------------------------------
+def sample_places(n_places, n_yelp, n_photos):
+    rnd = random.Random(507)
+    places = []
+    yelpplaces = []
+    photos = []
+    for ct in range(n_places):
+        name = 'Place {}'.format(ct)
+        lat = 42 + rnd.random()
+        lon = -83 + rnd.random()
+        places.append(GooglePlace(name, lat, lon, 4.5))
+        for ct2 in range(n_yelp):
+            yelpplaces.append(YelpPlace('Business {}'.format(ct2), lat + rnd.random() / 100, lon + rnd.random() / 100,
+                rnd.choice([3, 3.5, 4, 4.5]), rnd.randint(1, 500), '$$', name, 'https://www.yelp.com/biz/{}'.format(ct2)))
+        for ct2 in range(n_photos):
+            photos.append(FlickrPhoto('Photo {}'.format(ct2), lat, lon, 1, '123', str(ct * 100000 + ct2), 'abc', 1, name))
+    return (places, yelpplaces, photos)
+
+
+#--------------------------------------------------------------------------------------------
+#-----PER-ROW INSERTS (the path the bulk upserts replaced: a SELECT and a commit per row)
+#--------------------------------------------------------------------------------------------
+def rowwise_insert_google_data(places,db_name):
+    conn = sqlite3.connect(db_name)
+    cur = conn.cursor()
+    for obj in places:
+        check = cur.execute('SELECT Name FROM GooglePlaces WHERE Name = ?',[obj.name]).fetchall()
+        if len(check) > 0:
+            break
+        cur.execute("INSERT INTO 'GooglePlaces' (Name,Latitude,Longitude,Rating) VALUES (?,?,?,?)", (obj.name, obj.lat, obj.lon, obj.rating))
+        conn.commit()
+    conn.close()
+
+def rowwise_insert_yelp_data(yelpplaces,db_name):
+    conn = sqlite3.connect(db_name)
+    cur = conn.cursor()
+    for obj in yelpplaces:
+        check = cur.execute('SELECT Name FROM YelpPlaces WHERE Name = ? AND SearchName = ?',(obj.name, obj.searchterm)).fetchall()
+        if len(check) > 0:
+            break
+        SearchId = cur.execute('SELECT Id FROM GooglePlaces WHERE Name = ?', [obj.searchterm]).fetchall()[-1][0]
+        cur.execute('''INSERT INTO 'YelpPlaces' (SearchId,SearchName,Name,Latitude,Longitude,Rating,ReviewCount,Price,URL)
+            VALUES (?,?,?,?,?,?,?,?,?)''', (SearchId, obj.searchterm, obj.name, obj.lat, obj.lon, obj.rating, obj.review_count, obj.price, obj.url))
+        conn.commit()
+    conn.close()
+
+def rowwise_insert_flickr_data(photos,db_name):
+    conn = sqlite3.connect(db_name)
+    cur = conn.cursor()
+    for obj in photos:
+        check = cur.execute('SELECT PhotoId FROM FlickrImages WHERE PhotoId = ? AND SearchName = ?',(obj.id, obj.searchterm)).fetchall()
+        if len(check) > 0:
+            break
+        SearchId = cur.execute('SELECT Id FROM GooglePlaces WHERE Name = ?', [obj.searchterm]).fetchall()[-1][0]
+        cur.execute('''INSERT INTO 'FlickrImages' (SearchId,SearchName,ReqId,Title,FarmId,ServerId,PhotoId,Secret,URL)
+            VALUES (?,?,?,?,?,?,?,?,?)''', (SearchId, obj.searchterm, obj.req, obj.title, obj.farmid, obj.serverid, obj.id, obj.secret, obj.__str__()))
+        conn.commit()
+    conn.close()
+
+
+#--------------------------------------------------------------------------------------------
+#-----BENCHMARKS
+#--------------------------------------------------------------------------------------------
+def fresh_db():
+    db_name = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    init_db(db_name)
+    return db_name
+
+def time_inserts(insert_google, insert_yelp, insert_flickr, places, yelpplaces, photos):
+    db_name = fresh_db()
+    results = {}
+    for table, insert, rows in [('GooglePlaces', insert_google, places), ('YelpPlaces', insert_yelp, yelpplaces), ('FlickrImages', insert_flickr, photos)]:
+        start = time.time()
+        insert(rows, db_name)
+        results[table] = len(rows) / max(time.time() - start, 1e-9)
+    return results
+
+def bench_inserts(n_places=20, n_yelp=20, n_photos=250):
+    (places, yelpplaces, photos) = sample_places(n_places, n_yelp, n_photos)
+    print('-----------------')
+    print("Inserts: {} places, {} yelp places, {} photos (rows/sec)".format(len(places), len(yelpplaces), len(photos)))
+    rowwise = time_inserts(rowwise_insert_google_data, rowwise_insert_yelp_data, rowwise_insert_flickr_data, places, yelpplaces, photos)
+    bulk = time_inserts(insert_google_data, insert_yelp_data, insert_flickr_data, places, yelpplaces, photos)
+    for table in ['GooglePlaces', 'YelpPlaces', 'FlickrImages']:
+        print("{:14} per-row {:10.0f}   bulk {:10.0f}   x{:.1f}".format(table, rowwise[table], bulk[table], bulk[table] / rowwise[table]))
+    return (rowwise, bulk)
+
+
+#The lookups behind user_search, getnearby_fromdb, getflickr_fromdb and the insert functions
+HOT_QUERIES = [
+    ('user_search', 'SELECT Name,Latitude,Longitude,Rating FROM GooglePlaces WHERE GooglePlaces.Name = ?', 'Place 7'),
+    ('getnearby_fromdb', 'SELECT Name, Latitude, Longitude, Rating, ReviewCount, Price, SearchName, URL FROM YelpPlaces WHERE SearchName = ?', 'Place 7'),
+    ('getflickr_fromdb', 'SELECT Title, SearchName, URL FROM FlickrImages WHERE SearchName = ?', 'Place 7'),
+    ('yelp search id', 'SELECT MAX(Id) FROM YelpPlaces WHERE Name = ?', 'Business 7'),
+    ('flickr photo id', 'SELECT SearchName FROM FlickrImages WHERE PhotoId = ?', '700007'),
+]
+
+#Copy of db_name with every secondary index dropped, i.e. the table layout before the schema migrations
+def unindexed_copy(db_name):
+    copy_name = db_name + '.unindexed'
+    src = sqlite3.connect(db_name)
+    dst = sqlite3.connect(copy_name)
+    src.backup(dst)
+    src.close()
+    indexes = dst.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    for ea in indexes:
+        dst.execute("DROP INDEX '{}'".format(ea[0]))
+    dst.commit()
+    dst.close()
+    return copy_name
+
+def time_query(db_name, sql, param, repeat):
+    conn = sqlite3.connect(db_name)
+    plan = ' / '.join(ea[3] for ea in conn.execute('EXPLAIN QUERY PLAN ' + sql, [param]))
+    start = time.time()
+    for ct in range(repeat):
+        conn.execute(sql, [param]).fetchall()
+    elapsed = (time.time() - start) / repeat
+    conn.close()
+    return (plan, elapsed)
+
+def bench_queries(n_places=200, n_yelp=20, n_photos=250, repeat=50):
+    (places, yelpplaces, photos) = sample_places(n_places, n_yelp, n_photos)
+    db_name = fresh_db()
+    insert_google_data(places, db_name)
+    insert_yelp_data(yelpplaces, db_name)
+    insert_flickr_data(photos, db_name)
+    before = unindexed_copy(db_name)
+    print('-----------------')
+    print("Queries: {} places, {} yelp places, {} photos (ms/query)".format(len(places), len(yelpplaces), len(photos)))
+    results = {}
+    for (name, sql, param) in HOT_QUERIES:
+        (plan_before, time_before) = time_query(before, sql, param, repeat)
+        (plan_after, time_after) = time_query(db_name, sql, param, repeat)
+        results[name] = (time_before, time_after)
+        print("{:18} before {:8.3f}  after {:8.3f}  x{:.0f}".format(name, time_before * 1000, time_after * 1000, time_before / max(time_after, 1e-9)))
+        print("    before: {}".format(plan_before))
+        print("    after:  {}".format(plan_after))
+    return results
+
+
+#Radius lookups against n_points Yelp places scattered over the continental US
+def bench_spatial(n_points=1000000, radius_km=2, repeat=200):
+    rnd = random.Random(507)
+    db_name = fresh_db()
+    insert_google_data([GooglePlace('Center', 39.5, -98.35, 4.0)], db_name)
+    batch = []
+    for ct in range(n_points):
+        batch.append(YelpPlace('Business {}'.format(ct), rnd.uniform(25, 49), rnd.uniform(-124, -67), 4.0, 10, '$', 'Center', ''))
+        if len(batch) == 100000:
+            insert_yelp_data(batch, db_name)
+            batch = []
+    insert_yelp_data(batch, db_name)
+    centers = [(rnd.uniform(25, 49), rnd.uniform(-124, -67)) for ct in range(repeat)]
+    found = 0
+    start = time.time()
+    for (lat, lon) in centers:
+        found += len(places_within_radius(lat, lon, radius_km, source='yelp', db_name=db_name))
+    elapsed = (time.time() - start) / repeat
+    print('-----------------')
+    print("Spatial: {} places, {} km radius: {:.3f} ms/query ({:.1f} places found per query)".format(n_points, radius_km, elapsed * 1000, found / float(repeat)))
+    return elapsed
+
+
+#--------------------------------------------------------------------------------------------
+#-----STAGE BENCHMARKS (provider responses replayed from fixtures, see use_fixtures)
+#--------------------------------------------------------------------------------------------
+BENCH_STAGES = ['request', 'cached', 'parse', 'insert', 'figure']
+BENCH_HISTORY_FNAME = 'bench_history.json' #one JSON object per run
+#A stage regresses when its throughput drops or a latency grows by more than this fraction (p99 is the
+#noisiest with few calls)...
+BENCH_TOLERANCE = {'per_sec': 0.3, 'p50_ms': 0.3, 'p99_ms': 0.5}
+BENCH_MIN_DELTA_MS = 2.0 #...and the mean time per call or the latency by more than this, so millisecond noise is not flagged
+BENCH_BASELINE_RUNS = 5 #a run is compared with the median of up to this many earlier runs of the same configuration
+BENCH_MIN_P99_CALLS = 100 #with fewer calls p99 is just the slowest call, so it is not compared
+
+#Google, Yelp and Flickr fixtures for each term, shaped like the real responses
+def sample_fixtures(fixture_dir, terms, n_yelp=20, n_photos=250):
+    rnd = random.Random(507)
+    for term in terms:
+        lat = 42 + rnd.random()
+        lon = -83 + rnd.random()
+        (url, params, headers) = google_request(term)
+        result = {'name': term, 'geometry': {'location': {'lat': lat, 'lng': lon}}, 'rating': 4.5}
+        write_fixture(url, params, 200, {'Content-Type': 'application/json'},
+            json.dumps({'results': [result], 'status': 'OK'}), fixture_dir)
+        (url, params, headers) = yelp_request(lat, lon)
+        businesses = [{'name': 'Business {}'.format(ct), 'rating': rnd.choice([3, 3.5, 4, 4.5]), 'review_count': rnd.randint(1, 500),
+            'coordinates': {'latitude': lat + rnd.random() / 100, 'longitude': lon + rnd.random() / 100},
+            'price': rnd.choice(['$', '$$', '$$$']), 'url': 'https://www.yelp.com/biz/{}'.format(ct)} for ct in range(n_yelp)]
+        write_fixture(url, params, 200, {'Content-Type': 'application/json'},
+            json.dumps({'businesses': businesses, 'total': n_yelp}), fixture_dir)
+        (url, params, headers) = flickr_request(lat, lon)
+        photos = [{'id': str(rnd.randint(1, 10 ** 10)), 'owner': '1@N01', 'secret': 'abc', 'server': '123', 'farm': 1,
+            'title': 'Photo {}'.format(ct)} for ct in range(n_photos)]
+        envelope = {'photos': {'page': 1, 'pages': 1, 'perpage': n_photos, 'total': n_photos, 'photo': photos}, 'stat': 'ok'}
+        write_fixture(url, params, 200, {'Content-Type': 'application/javascript'},
+            'jsonFlickrApi(' + json.dumps(envelope) + ')', fixture_dir)
+
+def timed(samples, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+def stage_report(samples):
+    return {
+        'calls': len(samples),
+        'per_sec': len(samples) / max(sum(samples), 1e-9),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+
+#Per stage, the median of each metric over the stage reports of earlier runs
+def baseline(runs):
+    medians = {}
+    for stage in set(itertools.chain.from_iterable(runs)):
+        reports = [run[stage] for run in runs if stage in run]
+        medians[stage] = dict((metric, percentile([ea[metric] for ea in reports], 50)) for metric in ['calls', 'per_sec', 'p50_ms', 'p99_ms'])
+    return medians
+
+#{stage: [reasons]} for the stages of results that are worse than in previous (see baseline)
+def regressions(results, previous, tolerance=BENCH_TOLERANCE):
+    flags = {}
+    for stage in results:
+        if stage not in previous:
+            continue
+        (new, old) = (results[stage], previous[stage])
+        reasons = []
+        #per_sec is calls over their total time, so 1000 / per_sec is the mean ms per call
+        if new['per_sec'] < old['per_sec'] * (1 - tolerance['per_sec']) and 1000 / new['per_sec'] - 1000 / old['per_sec'] > BENCH_MIN_DELTA_MS:
+            reasons.append('throughput')
+        for metric in ['p50_ms', 'p99_ms']:
+            if metric == 'p99_ms' and min(new['calls'], old['calls']) < BENCH_MIN_P99_CALLS:
+                continue
+            if new[metric] > old[metric] * (1 + tolerance[metric]) and new[metric] - old[metric] > BENCH_MIN_DELTA_MS:
+                reasons.append(metric.split('_')[0])
+        if len(reasons) > 0:
+            flags[stage] = reasons
+    return flags
+
+#The stages of a search for each of n_terms places: requests on a cold cache (through fixtures with simulated
+#latency), the same requests on a warm cache, get_*_info parsing, the insert_* writers and the figure builders.
+#Each run is appended to history_fname and compared with the median of the last BENCH_BASELINE_RUNS runs of the
+#same configuration.
+def bench_stages(n_terms=50, latency=None, jitter=0.0, history_fname=BENCH_HISTORY_FNAME):
+    tmpdir = tempfile.mkdtemp()
+    fixture_dir = os.path.join(tmpdir, 'fixtures')
+    terms = ['Bench Place {}'.format(ct) for ct in range(n_terms)]
+    sample_fixtures(fixture_dir, terms)
+    db_name = fresh_db()
+    samples = collections.OrderedDict((stage, []) for stage in BENCH_STAGES)
+    CACHE_DICTION.close()
+    CACHE_DICTION.store.store = AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+    use_fixtures(fixture_dir, latency=latency, jitter=jitter)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            points = []
+            for term in terms:
+                data = timed(samples['request'], make_request_using_cache, *google_request(term))
+                location = data['results'][0]['geometry']['location']
+                points.append((term, location['lat'], location['lng']))
+                timed(samples['request'], make_request_using_cache, *yelp_request(location['lat'], location['lng']))
+                timed(samples['request'], make_request_using_cache, *flickr_request(location['lat'], location['lng']))
+            for (term, lat, lon) in points:
+                for request in [google_request(term), yelp_request(lat, lon), flickr_request(lat, lon)]:
+                    timed(samples['cached'], make_request_using_cache, *request)
+            for (term, lat, lon) in points:
+                places = timed(samples['parse'], get_place_info, term)
+                yelpplaces = timed(samples['parse'], get_yelp_info, lat, lon, term)
+                photos = timed(samples['parse'], get_flickr_photos, lat, lon, term, 'Google')
+                timed(samples['insert'], insert_google_data, places, db_name)
+                timed(samples['insert'], insert_yelp_data, yelpplaces, db_name)
+                timed(samples['insert'], insert_flickr_data, photos, db_name)
+            for (term, lat, lon) in points:
+                timed(samples['figure'], map_figure, term, lat, lon, db_name)
+                timed(samples['figure'], mapbox_figure, term, lat, lon, db_name)
+                timed(samples['figure'], ratings_figure, term, db_name)
+    finally:
+        use_network()
+        CACHE_DICTION.close()
+        CACHE_DICTION.stats.clear() #not this project's cache: keep it out of cache_stats.json
+        close_pools(db_name)
+    results = collections.OrderedDict((stage, stage_report(samples[stage])) for stage in BENCH_STAGES)
+    config = {'terms': n_terms, 'latency': FIXTURE_LATENCY if latency is None else latency, 'jitter': jitter}
+    previous = []
+    if os.path.exists(history_fname):
+        with open(history_fname) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['config'] == config:
+                    previous.append(run['results'])
+    previous = previous[-BENCH_BASELINE_RUNS:]
+    flags = regressions(results, baseline(previous)) if len(previous) > 0 else {}
+    print('-----------------')
+    print("Stages: {} places, fixtures with {} latency (per call)".format(n_terms, 'default' if latency is None else latency))
+    for stage in results:
+        r = results[stage]
+        flag = 'REGRESSION ({})'.format(', '.join(flags[stage])) if stage in flags else ''
+        print("{:8} {:5} calls {:10.1f}/s   p50 {:8.2f} ms   p99 {:8.2f} ms   {}".format(
+            stage, r['calls'], r['per_sec'], r['p50_ms'], r['p99_ms'], flag))
+    if len(previous) == 0:
+        print("(no earlier run with this configuration in {})".format(history_fname))
+    with open(history_fname, 'a') as f:
+        f.write(json.dumps({'time': time.time(), 'config': config, 'results': results}) + '\n')
+    return (results, flags)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('inserts', bench_inserts),
+    ('queries', bench_queries),
+    ('spatial', bench_spatial),
+    ('stages', bench_stages),
+])
+
+if __name__ == "__main__":
+    flagged = False
+    for name in sys.argv[1:] or BENCHMARKS:
+        result = BENCHMARKS[name]()
+        if name == 'stages' and len(result[1]) > 0:
+            flagged = True
+    sys.exit(1 if flagged else 0)
@@ -0,0 +1,149 @@
+#Load test for final_server.py: "python3 final_loadtest.py [--url http://127.0.0.1:8000] [--clients 50] [--duration 10]"
+#Without --url, a server for --db is started in a separate process on a free port and stopped at the end.
+#Each client keeps one keep-alive connection and requests the endpoints of the stored search places in turn;
+#with --revalidate it sends If-None-Match with the ETag it last got for a path, as a browser would.
+#Prints requests/sec, latency percentiles and the status codes seen.
+
+import asyncio
+import subprocess
+import urllib.parse
+from final import *
+
+LOADTEST_HOST = '127.0.0.1' #where a spawned server listens
+LOADTEST_CLIENTS = 50
+LOADTEST_DURATION = 10 #seconds
+LOADTEST_PLACES = 100 #search places whose endpoints are requested
+LOADTEST_ENDPOINTS = ['', '/nearby', '/ratings', '/photos']
+SERVER_START_TIMEOUT = 30 #seconds to wait for a spawned server to accept connections
+
+class LoadClient():
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+
+    #(status, headers, body); reconnects if the server closed the connection
+    async def get(self, path, headers=None):
+        if self.writer is None:
+            await self.connect()
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}:{}'.format(self.host, self.port)]
+        for (name, value) in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            self.close()
+            raise ConnectionError('server closed the connection')
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (name, sep, value) = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(int(response_headers.get('content-length', 0)))
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return (int(status_line.split()[1]), response_headers, body)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        (self.reader, self.writer) = (None, None)
+
+async def run_client(client, paths, offset, deadline, revalidate, latencies, statuses):
+    etags = {}
+    ct = offset
+    while time.perf_counter() < deadline:
+        path = paths[ct % len(paths)]
+        ct += 1
+        headers = {'If-None-Match': etags[path]} if revalidate and path in etags else None
+        start = time.perf_counter()
+        try:
+            (status, response_headers, body) = await client.get(path, headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            client.close()
+            statuses['error'] = statuses.get('error', 0) + 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        if 'etag' in response_headers:
+            etags[path] = response_headers['etag']
+    client.close()
+
+async def load_test(host, port, clients=LOADTEST_CLIENTS, duration=LOADTEST_DURATION, places=LOADTEST_PLACES, revalidate=False):
+    probe = LoadClient(host, port)
+    (status, headers, body) = await probe.get('/places?limit={}'.format(places))
+    probe.close()
+    names = json.loads(body.decode('utf-8'))['places']
+    if len(names) == 0:
+        raise ValueError('the server has no stored places to request')
+    paths = ['/places/' + urllib.parse.quote(name, safe='') + endpoint for name in names for endpoint in LOADTEST_ENDPOINTS]
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[run_client(LoadClient(host, port), paths, ct * len(paths) // clients, deadline,
+        revalidate, latencies, statuses) for ct in range(clients)])
+    elapsed = time.perf_counter() - start
+    return {
+        'clients': clients,
+        'paths': len(paths),
+        'requests': len(latencies),
+        'per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'max_ms': max(latencies) * 1000 if latencies else None,
+        'statuses': statuses,
+    }
+
+#Starts final_server.py on a free port; returns (process, port)
+def spawn_server(db_name):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'final_server.py')
+    process = subprocess.Popen([sys.executable, script, '--db', db_name, '--port', '0', '--no-fetch'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    for line in process.stdout: #migration lines come first, then "Serving ... on http://host:port/"
+        if line.startswith('Serving'):
+            return (process, int(line.rstrip().rstrip('/').rsplit(':', 1)[1]))
+        if time.time() > deadline:
+            break
+    process.kill()
+    raise RuntimeError('final_server.py did not start')
+
+def loadtest_main(args):
+    parser = argparse.ArgumentParser(prog='final_loadtest.py', description='Requests/sec of final_server.py')
+    parser.add_argument('--url', help='a running server (default: start one for --db)')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--clients', type=int, default=LOADTEST_CLIENTS, help='concurrent keep-alive connections')
+    parser.add_argument('--duration', type=float, default=LOADTEST_DURATION, help='seconds')
+    parser.add_argument('--places', type=int, default=LOADTEST_PLACES, help='search places to request')
+    parser.add_argument('--revalidate', action='store_true', help='send If-None-Match with the last ETag')
+    options = parser.parse_args(args)
+    process = None
+    if options.url is None:
+        (process, port) = spawn_server(options.db)
+        host = LOADTEST_HOST
+    else:
+        url = urllib.parse.urlsplit(options.url)
+        (host, port) = (url.hostname, url.port or 80)
+    try:
+        result = asyncio.run(load_test(host, port, options.clients, options.duration, options.places, options.revalidate))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print("{} requests from {} clients over {} paths: {:.0f} requests/sec".format(
+        result['requests'], result['clients'], result['paths'], result['per_sec']))
+    print("latency p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(result['p50_ms'], result['p99_ms'], result['max_ms']))
+    print("status codes: " + ", ".join('{} x{}'.format(status, n) for (status, n) in sorted(result['statuses'].items(), key=str)))
+    return result
+
+
+if __name__ == "__main__":
+    loadtest_main(sys.argv[1:])
@@ -0,0 +1,360 @@
+#Local HTTP query API over the database: "python3 final_server.py [--port 8000] [--db final.db]"
+#Built on asyncio from the standard library: one event loop accepts keep-alive connections and answers from
+#the response cache; database reads run on a thread pool over the read-only connection pool, and nothing
+#that touches the database or waits on a search runs on the event loop itself.
+#
+#GET /places?limit=&after=          names of the stored search places
+#GET /search?q=                     the place (from the database, else a new search through user_search)
+#GET /places/<name>                 one search place
+#GET /places/<name>/nearby          its Yelp places
+#GET /places/<name>/ratings         its ratings summary and the rating of each Yelp place
+#GET /places/<name>/photos?limit=   its Flickr photos
+#GET /health                        server and response cache counters
+#
+#Every 200 response carries an ETag (a hash of the body); a request whose If-None-Match matches gets 304 with
+#no body. Responses are cached by request path and reused until a write to the database is committed.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+import urllib.parse
+import final
+from final import (DBNAME, DB_POOL_SIZE, connect_db, init_db, user_search, getplace_fromdb, getplacenames_fromdb,
+    getnearby_fromdb, getnearby_columns, getflickr_fromdb, ratings_summary)
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+SERVER_THREADS = DB_POOL_SIZE #reads in flight at once, one read-only connection each
+RESPONSE_CACHE_SIZE = 1024 #encoded responses kept, least recently used dropped first
+KEEPALIVE_TIMEOUT = 15 #seconds an idle connection is kept open
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 65536 #request bodies are read and ignored
+PLACE_LIMIT = 100 #default and
+MAX_PLACE_LIMIT = 1000 #largest page of /places
+PHOTO_LIMIT = 50 #default and
+MAX_PHOTO_LIMIT = 500 #largest number of photos returned
+
+STATUS_TEXT = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+#Changes whenever a write to the database is committed, by any connection or process: PRAGMA data_version on
+#a read-only connection kept for the purpose (file times can miss a write within one clock tick), paired with
+#the file's inode so that a database swapped in by rebuild_db is noticed and reopened. Called from threads.
+class DbGeneration():
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.conn = None
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        try:
+            inode = os.stat(self.db_name).st_ino
+        except FileNotFoundError:
+            inode = None
+        with self.lock:
+            if inode != self.inode:
+                self.close_conn()
+                if inode is not None:
+                    self.conn = connect_db(self.db_name, readonly=True)
+                self.inode = inode
+            if self.conn is None:
+                return (None, None)
+            return (inode, self.conn.execute('PRAGMA data_version').fetchone()[0])
+
+    def close_conn(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def close(self):
+        with self.lock:
+            self.close_conn()
+
+def int_param(query, name, default, largest):
+    try:
+        value = int(query.get(name, [default])[0])
+    except ValueError:
+        raise HttpError(400, '{} must be a number'.format(name))
+    return max(1, min(value, largest))
+
+#Missing numbers are NaN in record batches, which JSON cannot carry
+def number(value):
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+def place_json(place):
+    return {'name': place.name, 'lat': number(place.lat), 'lon': number(place.lon), 'rating': number(place.rating)}
+
+
+class QueryServer():
+    #fetch: a /search for a place that is not stored runs user_search, which writes the results to db_name
+    def __init__(self, db_name=DBNAME, fetch=True, threads=SERVER_THREADS, cache_size=RESPONSE_CACHE_SIZE, log=False):
+        self.db_name = db_name
+        self.fetch = fetch
+        self.readers = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.searcher = concurrent.futures.ThreadPoolExecutor(max_workers=1) #new searches write: one at a time
+        self.checker = concurrent.futures.ThreadPoolExecutor(max_workers=1) #generation checks, never queued behind reads
+        self.generation = DbGeneration(db_name)
+        self.next_check = None #generation check that has not started yet, shared by the requests arriving meanwhile
+        self.last_check = None
+        self.cache = collections.OrderedDict() #target -> (generation, etag, body)
+        self.cache_size = cache_size
+        self.pending = {} #(target, generation) -> future of a response being built
+        self.log = log
+        self.handlers = set() #tasks serving open connections
+        self.stats = {'requests': 0, 'cache_hits': 0, 'not_modified': 0, 'errors': 0}
+
+    #-----Endpoints (run on the thread pool, but for get_search; return an object to send as JSON or raise HttpError)
+    def stored_place(self, name):
+        places = getplace_fromdb(name, self.db_name, readonly=True)
+        if len(places) == 0:
+            raise HttpError(404, 'no stored place named {!r}'.format(name))
+        return places[0]
+
+    def get_places(self, query):
+        limit = int_param(query, 'limit', PLACE_LIMIT, MAX_PLACE_LIMIT)
+        after = query.get('after', [''])[0]
+        return {'places': getplacenames_fromdb(limit, after, self.db_name, readonly=True)}
+
+    #A coroutine: the lookup runs on a reader, and a new search waits for the searcher without holding one
+    async def get_search(self, query):
+        if 'q' not in query or query['q'][0].strip() == '':
+            raise HttpError(400, 'missing search term q')
+        searchterm = query['q'][0].strip()
+        loop = asyncio.get_running_loop()
+        places = await loop.run_in_executor(self.readers, getplace_fromdb, searchterm, self.db_name, True)
+        if len(places) == 0 and self.fetch:
+            places = await loop.run_in_executor(self.searcher, lambda: user_search(searchterm, db_name=self.db_name))
+        return {'searchterm': searchterm, 'places': [place_json(ea) for ea in places]}
+
+    def get_place(self, name, query):
+        return place_json(self.stored_place(name))
+
+    def get_nearby(self, name, query):
+        self.stored_place(name)
+        nearby = getnearby_fromdb(name, self.db_name, readonly=True)
+        return {'searchterm': name, 'places': [{'name': ea.name, 'lat': number(ea.lat), 'lon': number(ea.lon),
+            'rating': number(ea.rating), 'review_count': ea.review_count, 'price': ea.price, 'url': ea.url} for ea in nearby]}
+
+    def get_ratings(self, name, query):
+        summary = ratings_summary(name, self.db_name, readonly=True)
+        if summary is None:
+            raise HttpError(404, 'no nearby places stored for {!r}'.format(name))
+        nearby = getnearby_columns(name, self.db_name, readonly=True)
+        return {'searchterm': name, 'places': summary.places, 'rated': summary.rated, 'average': summary.average,
+            'weighted': summary.weighted, 'reviews': summary.reviews, 'prices': summary.prices,
+            'ratings': [{'name': ea.name, 'rating': number(ea.rating), 'review_count': ea.review_count} for ea in nearby]}
+
+    def get_photos(self, name, query):
+        limit = int_param(query, 'limit', PHOTO_LIMIT, MAX_PHOTO_LIMIT)
+        place = self.stored_place(name)
+        images = getflickr_fromdb(name, place.lat, place.lon, self.db_name, readonly=True)
+        return {'searchterm': name, 'photos': [{'title': ea[0], 'url': ea[2]} for ea in images[:limit]]}
+
+    def get_health(self, query):
+        stats = dict(self.stats)
+        stats['cached_responses'] = len(self.cache)
+        return stats
+
+    def dispatch(self, path, query):
+        parts = [urllib.parse.unquote(ea) for ea in path.strip('/').split('/')]
+        if parts == ['places']:
+            return self.get_places(query)
+        if parts == ['health']:
+            return self.get_health(query)
+        if len(parts) == 2 and parts[0] == 'places':
+            return self.get_place(parts[1], query)
+        if len(parts) == 3 and parts[0] == 'places':
+            endpoint = {'nearby': self.get_nearby, 'ratings': self.get_ratings, 'photos': self.get_photos}.get(parts[2])
+            if endpoint is not None:
+                return endpoint(parts[1], query)
+        raise HttpError(404, 'no such endpoint')
+
+    async def build(self, target):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path.strip('/') == 'search':
+                result = await self.get_search(query)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(self.readers, self.dispatch, url.path, query)
+            return (200, json.dumps(result).encode('utf-8'))
+        except HttpError as e:
+            return (e.status, json.dumps({'error': str(e)}).encode('utf-8'))
+        except Exception as e:
+            print("{} failed: {}: {}".format(target, type(e).__name__, e))
+            return (500, json.dumps({'error': 'internal error'}).encode('utf-8'))
+
+    #-----Response cache: one build per target and database generation, shared by the requests waiting on it
+    #The generation a request is answered for is read by a check that starts after the request arrived. Checks
+    #run one at a time off the event loop, and every request arriving while one runs shares the next.
+    async def check_generation(self, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        self.next_check = None
+        return await asyncio.get_running_loop().run_in_executor(self.checker, self.generation)
+
+    async def current_generation(self):
+        if self.next_check is None:
+            self.next_check = asyncio.ensure_future(self.check_generation(self.last_check))
+            self.last_check = self.next_check
+        return await asyncio.shield(self.next_check)
+
+    async def response(self, target):
+        if target == '/health':
+            return (200, None, json.dumps(self.get_health({})).encode('utf-8'))
+        generation = await self.current_generation()
+        entry = self.cache.get(target)
+        if entry is not None and entry[0] == generation:
+            self.cache.move_to_end(target)
+            self.stats['cache_hits'] += 1
+            return (200, entry[1], entry[2])
+        key = (target, generation)
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.build(target))
+        future = self.pending[key]
+        try:
+            (status, body) = await asyncio.shield(future)
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if status != 200:
+            self.stats['errors'] += 1
+            return (status, None, body)
+        etag = '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+        #generation was read before the build, so a write during it only makes the next request rebuild
+        self.cache[target] = (generation, etag, body)
+        self.cache.move_to_end(target)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return (200, etag, body)
+
+    #-----HTTP/1.1 over one connection, with keep-alive
+    async def handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                headers = {}
+                size = len(request_line)
+                while True:
+                    line = await reader.readline()
+                    size += len(line)
+                    if line in (b'\r\n', b'\n', b'') or size > MAX_HEADER_BYTES:
+                        break
+                    (name, sep, value) = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                body_bytes = int(headers.get('content-length', 0)) if headers.get('content-length', '0').isdigit() else -1
+                if size > MAX_HEADER_BYTES or len(parts) != 3 or not 0 <= body_bytes <= MAX_BODY_BYTES:
+                    await self.send(writer, 431 if size > MAX_HEADER_BYTES else 400, None, b'', False, True)
+                    break
+                (method, target, version) = parts
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                await reader.readexactly(body_bytes) #GET and HEAD take no body: skip any that was sent
+                self.stats['requests'] += 1
+                if method not in ('GET', 'HEAD'):
+                    (status, etag, body) = (405, None, json.dumps({'error': 'only GET and HEAD'}).encode('utf-8'))
+                else:
+                    (status, etag, body) = await self.response(target)
+                if etag is not None and etag in [ea.strip() for ea in headers.get('if-none-match', '').split(',')]:
+                    self.stats['not_modified'] += 1
+                    (status, body) = (304, b'')
+                if self.log:
+                    print('{} {} {}'.format(method, target, status))
+                await self.send(writer, status, etag, body, keep_alive, method == 'HEAD')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass #stop() dropping the connection; ending normally keeps asyncio from logging the cancellation
+        finally:
+            writer.close()
+            self.handlers.discard(asyncio.current_task())
+
+    async def send(self, writer, status, etag, body, keep_alive, head_only):
+        lines = ['HTTP/1.1 {} {}'.format(status, STATUS_TEXT.get(status, '')),
+            'Content-Type: application/json',
+            'Content-Length: {}'.format(len(body)),
+            'Cache-Control: no-cache', #clients may keep a response but must revalidate it with If-None-Match
+            'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+        if etag is not None:
+            lines.append('ETag: {}'.format(etag))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def start(self, host=SERVER_HOST, port=SERVER_PORT):
+        self.server = await asyncio.start_server(self.handle, host, port, reuse_address=True, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    #Stops accepting, then drops the open (idle keep-alive) connections
+    async def stop(self):
+        self.server.close()
+        for task in list(self.handlers):
+            task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def close(self):
+        self.readers.shutdown(wait=False)
+        self.searcher.shutdown(wait=False)
+        self.checker.shutdown(wait=False)
+        self.generation.close()
+
+
+async def serve(server, host, port):
+    port = await server.start(host, port)
+    print("Serving {} on http://{}:{}/".format(server.db_name, host, port), flush=True)
+    async with server.server:
+        await server.server.serve_forever()
+
+def server_main(args):
+    parser = argparse.ArgumentParser(prog='final_server.py', description='JSON query API over the database')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='0 picks a free port')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS, help='database reads in flight at once')
+    parser.add_argument('--no-fetch', action='store_true', help='answer /search from the database only')
+    parser.add_argument('--log', action='store_true', help='print a line per request')
+    options = parser.parse_args(args)
+    final.METRICS = False #user_search would otherwise reset the shared timers, print and append to metrics.jsonl
+    init_db(options.db) #read-only connections neither create the file nor migrate it
+    server = QueryServer(options.db, not options.no_fetch, options.threads, log=options.log)
+    try:
+        asyncio.run(serve(server, options.host, options.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    server_main(sys.argv[1:])
@@ -5,6 +5,9 @@
 	#that your data processing produces the results and data structures you need for presentation
 
 import unittest
+import tempfile
+import asyncio
+import final
 from final import *
 
 class TestDatabase(unittest.TestCase):
@@ -141,7 +144,929 @@ class TestPresentationStructure(unittest.TestCase):
 		except:
 			self.fail()
 
+class TestCacheStore(unittest.TestCase):
 
+	def test_appendlog_migration(self):
+		tmpdir = tempfile.mkdtemp()
+		json_fname = os.path.join(tmpdir, 'cache.json')
+		with open(json_fname, 'w') as f:
+			f.write(json.dumps({'key1': {'results': [1, 2]}, 'key2': 'text'}))
 
+		store = AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+		self.assertEqual(migrate_json_cache(store, json_fname), 2)
+		store['key3'] = {'photos': {'photo': []}}
+		store.close()
 
-unittest.main()
\ No newline at end of file
+		store = AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+		self.assertEqual(len(store), 3)
+		self.assertEqual(store['key1'], {'results': [1, 2]})
+		self.assertEqual(store['key2'], 'text')
+		self.assertIn('key3', store)
+		store.close()
+
+	def test_appendlog_remap(self):
+		tmpdir = tempfile.mkdtemp()
+		store = AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+		store['key1'] = [1]
+		self.assertEqual(store['key1'], [1])
+		store['key2'] = {'results': ['x'] * 1000}  # appended after the log was first mapped
+		self.assertEqual(len(store['key2']['results']), 1000)
+		self.assertEqual(store['key1'], [1])
+		store.close()
+
+	def test_appendlog_readonly(self):
+		tmpdir = tempfile.mkdtemp()
+		names = (os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+		store = AppendLogCache(*names)
+		store['key1'] = [1]
+		store['key2'] = [2]
+		reader = AppendLogCache(*(names + (True, )))
+		store.delete('key2')
+		store.compact()
+		self.assertEqual((reader['key1'], reader['key2']), ([1], [2]))
+		self.assertRaises(PermissionError, reader.set_raw, 'key3', [b'3'])
+		self.assertRaises(PermissionError, reader.delete, 'key1')
+		reader.close()
+		store.close()
+		self.assertEqual(AppendLogCache(*(names + (True, ))).keys(), ['key1'])
+
+	def test_lazy_open(self):
+		cache = LazyCache('json')
+		self.assertIsNone(cache.store)
+		cache.get_store()
+		self.assertIsInstance(cache.store, JsonFileCache)
+		cache.close()
+		self.assertIsNone(cache.store)
+
+	def test_sqlite_store(self):
+		tmpdir = tempfile.mkdtemp()
+		store = SqliteCache(os.path.join(tmpdir, 'cache.db'))
+		store['key1'] = {'businesses': []}
+		self.assertIn('key1', store)
+		self.assertNotIn('key2', store)
+		self.assertEqual(store['key1'], {'businesses': []})
+		store.close()
+
+class TestCacheLayer(unittest.TestCase):
+
+	def make_layer(self, max_bytes, policy='lru'):
+		tmpdir = tempfile.mkdtemp()
+		store = AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx'))
+		return CacheLayer(store, max_bytes=max_bytes, policy=policy)
+
+	def test_ttl(self):
+		layer = self.make_layer(10000)
+		key = YELP_SEARCH_URL + 'latitude-1_longitude-2'
+		layer[key] = {'businesses': []}
+		self.assertEqual(layer.get(key), {'businesses': []})
+		layer.store.index[key] = (0, layer.store.index[key][1], time.time() - CACHE_TTLS['yelp'] - 1)
+		self.assertNotIn(key, layer)
+		self.assertIsNone(layer.get(key))
+		self.assertEqual(layer.stats['yelp']['expired'], 1)
+		self.assertEqual(layer.stats['yelp']['hits'], 1)
+		layer.close()
+
+	def test_lru_eviction(self):
+		layer = self.make_layer(50)
+		layer['a'] = 'x' * 20
+		layer['b'] = 'y' * 20
+		layer.get('a') # b is now least recently used
+		layer['c'] = 'z' * 20
+		self.assertNotIn('b', layer)
+		self.assertIn('a', layer)
+		self.assertIn('c', layer)
+		self.assertLessEqual(layer.total_bytes, 50)
+		self.assertEqual(layer.stats['other']['evictions'], 1)
+		layer.close()
+
+	def test_lfu_eviction(self):
+		layer = self.make_layer(70, policy='lfu')
+		layer['a'] = 'x' * 20
+		layer['b'] = 'y' * 20
+		layer['c'] = 'z' * 20
+		for ct in range(200): #rebuilds the heap along the way
+			layer.get('a')
+		layer.get('c')
+		layer['d'] = 'w' * 20 # b is the least used
+		self.assertNotIn('b', layer)
+		layer['e'] = 'v' * 20 # d has only been written, c was also read
+		self.assertEqual(sorted(layer.keys()), ['a', 'c', 'e'])
+		self.assertLessEqual(len(layer.heap), 2 * len(layer.usage) + 64)
+		self.assertEqual(layer.stats['other']['evictions'], 2)
+		layer.close()
+
+class TestCacheKeys(unittest.TestCase):
+
+	def test_canonical_key(self):
+		key = cache_key(FLICKR_REST_URL, {'lat': 42.28081, 'lon': '-83.7430', 'api_key': 'a', 'format': 'json'})
+		self.assertEqual(key, cache_key(FLICKR_REST_URL, {'format': 'json', 'lon': -83.743, 'lat': ' 42.28079', 'api_key': 'b'}))
+		self.assertEqual(cache_key(YELP_SEARCH_URL, {'limit': '20', 'offset': 0.0}), cache_key(YELP_SEARCH_URL, {'limit': 20, 'offset': '0'}))
+		#free text is kept as given: whitespace and numbers in it still tell two searches apart
+		self.assertNotEqual(cache_key(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake  Tahoe'}), cache_key(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake Tahoe'}))
+		self.assertNotEqual(cache_key(GOOGLE_TEXTSEARCH_URL, {'query': '007'}), cache_key(GOOGLE_TEXTSEARCH_URL, {'query': '7'}))
+		self.assertNotEqual(key, cache_key(FLICKR_REST_URL, {'lat': 42.2812, 'lon': -83.743, 'format': 'json'}))
+		self.assertEqual(cache_key(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake Tahoe', 'key': 'secret'}),
+			cache_key(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake Tahoe', 'key': 'other'}))
+		self.assertEqual(len(key), len('flickr:') + 2 * CACHE_KEY_BYTES)
+		self.assertEqual(provider_for_key(key), 'flickr')
+
+	def test_rekey_json(self):
+		json_fname = os.path.join(tempfile.mkdtemp(), 'cache.json')
+		old_keys = [
+			params_unique_combination(YELP_SEARCH_URL, {'latitude': 42.280812, 'longitude': -83.74301}),
+			params_unique_combination(YELP_SEARCH_URL, {'latitude': 42.280798, 'longitude': -83.74299}),
+			params_unique_combination(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake_Tahoe key-lime', 'key': 'secret'}),
+			'other',
+		]
+		with open(json_fname, 'w') as f:
+			f.write(json.dumps(dict((key, ct) for (ct, key) in enumerate(old_keys))))
+		report = rekey_cache(json_fname)
+		self.assertEqual((report['entries_before'], report['entries_after'], report['rekeyed']), (4, 3, 3))
+		self.assertAlmostEqual(report['merge_rate'], 1 / 3.0)
+		with open(json_fname) as f:
+			new_cache = json.loads(f.read())
+		self.assertEqual(new_cache[cache_key(GOOGLE_TEXTSEARCH_URL, {'query': 'Lake_Tahoe key-lime'})], 2)
+		self.assertEqual(new_cache[cache_key(YELP_SEARCH_URL, {'latitude': 42.2808, 'longitude': -83.743})], 1)
+		self.assertEqual(new_cache['other'], 3)
+
+#Points final.CACHE_DICTION at an empty store for the rest of the test
+def use_temp_cache(test):
+	tmpdir = tempfile.mkdtemp()
+	layer = CacheLayer(AppendLogCache(os.path.join(tmpdir, 'cache.log'), os.path.join(tmpdir, 'cache.idx')))
+	(saved, final.CACHE_DICTION) = (final.CACHE_DICTION, layer)
+	test.addCleanup(setattr, final, 'CACHE_DICTION', saved)
+	test.addCleanup(layer.close)
+	return layer
+
+class TestHttp(unittest.TestCase):
+
+	class FakeResponse():
+		def __init__(self, status_code, text=''):
+			self.status_code = status_code
+			self.headers = {'Retry-After': '0'}
+			self.text = text
+
+		def iter_content(self, chunk_size=1):
+			yield self.text.encode('utf-8')
+
+		def raise_for_status(self):
+			if self.status_code >= 400:
+				raise requests.HTTPError(str(self.status_code), response=self)
+
+		def close(self):
+			pass
+
+	class FakeSession():
+		def __init__(self, statuses, text=''):
+			self.statuses = statuses
+			self.text = text
+			self.calls = 0
+
+		def get(self, url, params=None, headers=None, timeout=None, stream=False):
+			self.calls += 1
+			self.params = params
+			return TestHttp.FakeResponse(self.statuses.pop(0), self.text)
+
+	def test_retry_on_503(self):
+		session = self.FakeSession([503, 429, 200])
+		HTTP_SESSIONS['other'] = session
+		self.addCleanup(HTTP_SESSIONS.pop, 'other')
+		resp = http_get('http://localhost/test')
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(session.calls, 3)
+
+	def test_over_query_limit(self):
+		layer = use_temp_cache(self)
+		session = self.FakeSession([200] * 6, '{"results": [], "status": "OVER_QUERY_LIMIT"}')
+		HTTP_SESSIONS['google'] = session
+		self.addCleanup(HTTP_SESSIONS.pop, 'google')
+		(url, params, headers) = google_request('Michigan League')
+		self.assertRaises(requests.HTTPError, make_request_using_cache, url, params, headers)
+		self.assertEqual(session.calls, 1 + PROVIDER_SETTINGS['google']['retries'])
+		self.assertRaises(requests.HTTPError, list, ResponseStream(url, params, headers))
+		self.assertEqual(len(layer), 0)
+
+	def test_single_flight(self):
+		flights = SingleFlight()
+		calls = []
+		results = []
+		def call():
+			(flight, leader) = flights.begin('key')
+			if not leader:
+				results.append(flight.wait())
+				return
+			calls.append(1)
+			time.sleep(0.1)
+			flight.result = 'response'
+			flights.end('key', flight)
+			results.append(flight.result)
+		threads = [threading.Thread(target=call) for ct in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(results, ['response'] * 5)
+		self.assertEqual(flights.flights, {})
+
+	def test_coalesced_requests(self):
+		layer = use_temp_cache(self)
+		session = self.FakeSession([200] * 3, '{"businesses": [{"id": "a"}, {"id": "b"}]}')
+		get = session.get
+		session.get = lambda *args, **kwargs: (time.sleep(0.2), get(*args, **kwargs))[1]
+		HTTP_SESSIONS['yelp'] = session
+		self.addCleanup(HTTP_SESSIONS.pop, 'yelp')
+		(url, params, headers) = yelp_request(42.2808, -83.743)
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(make_request_using_cache(url, params, headers))) for ct in range(5)]
+		threads += [threading.Thread(target=lambda: results.append({'businesses': list(ResponseStream(url, params, headers))}))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(session.calls, 1)
+		self.assertEqual(results, [{'businesses': [{'id': 'a'}, {'id': 'b'}]}] * 6)
+		self.assertEqual((layer.stats['yelp']['writes'], layer.stats['yelp']['coalesced']), (1, 5))
+		#a follower of a stream abandoned part way makes its own request
+		(url, params, headers) = yelp_request(40.0, -80.0)
+		leader = iter(ResponseStream(url, params, headers))
+		self.assertEqual(next(leader), {'id': 'a'})
+		follower = threading.Thread(target=lambda: results.append(list(ResponseStream(url, params, headers))))
+		follower.start()
+		while layer.stats['yelp']['coalesced'] < 6:
+			time.sleep(0.01)
+		leader.close()
+		follower.join()
+		self.assertEqual(session.calls, 3)
+		self.assertEqual(results[-1], [{'id': 'a'}, {'id': 'b'}])
+		self.assertEqual(layer.stats['yelp']['writes'], 2)
+
+	def test_fixture_replay(self):
+		fixture_dir = tempfile.mkdtemp()
+		(url, params, headers) = yelp_request(42.2808, -83.743)
+		write_fixture(url, params, 200, {}, '{"businesses": []}', fixture_dir)
+		HTTP_SESSIONS['yelp'] = FixtureSession(fixture_dir, latency=0.05)
+		self.addCleanup(HTTP_SESSIONS.pop, 'yelp')
+		start = time.time()
+		resp = http_get(url, params=params, headers=headers)
+		self.assertGreaterEqual(time.time() - start, 0.05)
+		self.assertEqual(json.loads(resp.text), {'businesses': []})
+		(url, params, headers) = flickr_request(42.2808, -83.743)
+		write_fixture(url, params, 200, {}, 'jsonFlickrApi({})', fixture_dir)
+		with open(fixture_path(url, params, fixture_dir)) as f:
+			self.assertNotIn('api_key', json.loads(f.read())['params'])
+		self.assertRaises(FixtureMiss, http_get, *yelp_request(40, -80))
+
+	def test_token_bucket(self):
+		bucket = TokenBucket(50, 1)
+		start = time.time()
+		for ct in range(6):
+			bucket.acquire()
+		self.assertGreaterEqual(time.time() - start, 0.09)
+
+class TestBulkInsert(unittest.TestCase):
+
+	def test_upsert(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		places = [GooglePlace('Michigan League', 42.2790304, -83.7376361, 4.5)]
+		yelpplaces = [YelpPlace('Frita Batidos', 42.2803651, -83.7491532, 4.0, 100, '$$', 'Michigan League', 'https://www.yelp.com/biz/frita-batidos'),
+			YelpPlace('Zingermans', 42.28, -83.74, 4.5, 200, '$$', 'Michigan League', 'https://www.yelp.com/biz/zingermans')]
+		photos = [FlickrPhoto('Diag', 42.2790304, -83.7376361, 1, '123', str(ct), 'abc', 1, 'Michigan League') for ct in range(5)]
+		for ct in range(2):
+			insert_google_data(places, db_name)
+			insert_yelp_data(yelpplaces, db_name)
+			insert_flickr_data(photos, db_name)
+		yelpplaces[0].rating = 5.0
+		insert_yelp_data(yelpplaces[:1], db_name)
+
+		conn = sqlite3.connect(db_name)
+		cur = conn.cursor()
+		self.assertEqual(cur.execute('SELECT COUNT(*) FROM GooglePlaces').fetchone()[0], 1)
+		self.assertEqual(cur.execute('SELECT COUNT(*) FROM YelpPlaces WHERE SearchId = 1').fetchone()[0], 2)
+		self.assertEqual(cur.execute('SELECT COUNT(*) FROM FlickrImages WHERE SearchId = 1').fetchone()[0], 5)
+		self.assertEqual(cur.execute('SELECT Rating FROM YelpPlaces WHERE Name = "Frita Batidos"').fetchone()[0], 5.0)
+		conn.close()
+
+
+class TestSchema(unittest.TestCase):
+
+	def test_migrations(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		conn = connect_db(db_name)
+		cur = conn.cursor()
+		self.assertEqual(schema_version(cur), SCHEMA_MIGRATIONS[-1][0])
+		self.assertEqual(cur.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+		with self.assertRaises(sqlite3.IntegrityError):
+			cur.execute('INSERT INTO YelpPlaces (SearchId, SearchName, Name) VALUES (99, "Nowhere", "Nothing")')
+		with self.assertRaises(sqlite3.IntegrityError):
+			cur.execute('INSERT INTO FlickrImages (SearchId, SearchName, ReqId, PhotoId) VALUES (99, "Nowhere", 1, "1")')
+		conn.close()
+
+	def test_rebuild(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		conn = sqlite3.connect(db_name)
+		conn.execute('CREATE TABLE GooglePlaces (Id INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT, Latitude REAL, Longitude REAL, Rating REAL)')
+		conn.executemany('INSERT INTO GooglePlaces (Name, Latitude, Longitude, Rating) VALUES (?,?,?,?)',
+			[('Michigan League', 42.28, -83.74, 4.5), ('Michigan League', 42.28, -83.74, 4.5), ('Lake Tahoe', 39.1, -120.0, 4.8)])
+		conn.commit()
+		reader = sqlite3.connect('file:{}?mode=ro'.format(db_name), uri=True) # still open during the rebuild, as a server's would be
+		self.assertEqual(reader.execute('SELECT COUNT(*) FROM GooglePlaces').fetchone()[0], 3)
+		counts = rebuild_db(db_name)
+		self.assertEqual(counts, {'GooglePlaces': 2, 'YelpPlaces': 0, 'FlickrImages': 0})
+		self.assertEqual(reader.execute('SELECT COUNT(*) FROM GooglePlaces').fetchone()[0], 2)
+		reader.close()
+		conn.close()
+		init_db(db_name)
+		init_db(db_name)
+		conn = sqlite3.connect(db_name)
+		cur = conn.cursor()
+		self.assertEqual(schema_version(cur), SCHEMA_MIGRATIONS[-1][0])
+		self.assertEqual(cur.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0], len(SCHEMA_MIGRATIONS))
+		self.assertEqual(cur.execute('SELECT COUNT(*) FROM GooglePlacesRtree').fetchone()[0], 2)
+		conn.close()
+		rebuild_db(db_name) # the duplicate set aside by the first rebuild is carried over
+		conn = sqlite3.connect(db_name)
+		self.assertEqual(conn.execute('SELECT Name, Latitude, Longitude, Rating FROM GooglePlacesDuplicates').fetchall(),
+			[('Michigan League', 42.28, -83.74, 4.5)])
+		conn.close()
+		self.assertFalse(os.path.exists(db_name + '.rebuild'))
+
+	def test_connection_pool(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		pool = ConnectionPool(db_name, size=2)
+		conn1 = pool.checkout()
+		conn2 = pool.checkout()
+		self.assertEqual(pool.opened, 2)
+		self.assertEqual(conn1.execute('PRAGMA foreign_keys').fetchone()[0], 1)
+		pool.checkin(conn1)
+		self.assertIs(pool.checkout(), conn1)
+		pool.checkin(conn1)
+		pool.checkin(conn2)
+		with pool.connection() as conn:
+			conn.execute('INSERT INTO GooglePlaces (Name) VALUES ("Michigan League")')
+		reader = ConnectionPool(db_name, readonly=True)
+		with reader.connection() as conn:
+			self.assertEqual(conn.execute('SELECT COUNT(*) FROM GooglePlaces').fetchone()[0], 1)
+			with self.assertRaises(sqlite3.OperationalError):
+				conn.execute('DELETE FROM GooglePlaces')
+		pool.close()
+		reader.close()
+		self.assertEqual(pool.opened, 0)
+
+	def test_pool_close_in_use(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		pool = ConnectionPool(db_name, size=2)
+		idle = pool.checkout()
+		busy = pool.checkout()
+		pool.checkin(idle)
+		self.assertEqual(pool.in_use, {busy})
+		pool.close()
+		self.assertEqual(pool.opened, 1)
+		busy.execute('SELECT COUNT(*) FROM GooglePlaces') #still usable until it is returned
+		pool.checkin(busy)
+		self.assertEqual((pool.opened, pool.in_use), (0, set()))
+		for conn in (idle, busy):
+			with self.assertRaises(sqlite3.ProgrammingError):
+				conn.execute('SELECT 1')
+		with self.assertRaises(sqlite3.ProgrammingError):
+			pool.checkout()
+
+class TestSpatial(unittest.TestCase):
+
+	def test_radius(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		insert_google_data([GooglePlace('Michigan League', 42.2790304, -83.7376361, 4.5), GooglePlace('Yosemite National Park', 37.8651011, -119.5383294, 4.8)], db_name)
+		insert_yelp_data([YelpPlace('Frita Batidos', 42.2803651, -83.7491532, 4.0, 100, '$$', 'Michigan League', 'https://www.yelp.com/biz/frita-batidos'),
+			YelpPlace('Zingermans', 42.2846, -83.7452, 4.5, 200, '$$', 'Michigan League', 'https://www.yelp.com/biz/zingermans')], db_name)
+
+		nearby = places_within_radius(42.2790304, -83.7376361, 2, db_name=db_name)
+		self.assertEqual([ea[1].name for ea in nearby], ['Michigan League', 'Zingermans', 'Frita Batidos'])
+		self.assertLess(nearby[1][0], 1.0)
+		self.assertEqual(len(places_within_radius(42.2790304, -83.7376361, 2, source='yelp', db_name=db_name)), 2)
+		self.assertEqual(len(places_in_bbox(30, 40, -120, -119, db_name=db_name)), 1)
+
+		insert_google_data([GooglePlace('Michigan League', 37.87, -119.54, 4.5)], db_name) # moved: the index follows
+		self.assertEqual(len(places_within_radius(42.2790304, -83.7376361, 2, source='google', db_name=db_name)), 0)
+		self.assertEqual(len(places_within_radius(37.8651011, -119.5383294, 2, source='google', db_name=db_name)), 2)
+
+
+class TestMapBounds(unittest.TestCase):
+
+	def test_bounds(self):
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin(np.array([42.1, 42.3]), ['-83.1', '-83.7'])
+		self.assertAlmostEqual(center_lat, 42.2)
+		self.assertAlmostEqual(center_lon, -83.4)
+		self.assertAlmostEqual(lat_axis[0], 41.8)
+		self.assertAlmostEqual(lon_axis[1], -82.8)
+
+	def test_cluster_markers(self):
+		lat = [42.2790 + ct * 0.00001 for ct in range(1000)] + [37.8651]
+		lon = [-83.7376] * 1000 + [-119.5383]
+		names = ['Place {}'.format(ct) for ct in range(1001)]
+		(center_lat, center_lon, counts, text) = cluster_markers(lat, lon, names, 4)
+		self.assertEqual(sorted(counts.tolist()), [1, 1000])
+		self.assertIn('Place 1000', text)
+		self.assertIn('1000 places', text)
+		(center_lat, center_lon, counts, text) = cluster_markers(lat, lon, names, 18, max_markers=50)
+		self.assertLessEqual(len(counts), 50)
+		self.assertEqual(counts.sum(), 1001)
+
+	def test_zoom(self):
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin([42.27, 42.29], [-83.75, -83.73])
+		city = mapbox_zoom(lat_axis, lon_axis)
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin([25, 49], [-124, -67])
+		country = mapbox_zoom(lat_axis, lon_axis)
+		self.assertGreater(city, 12)
+		self.assertLess(country, 3)
+
+	def test_antimeridian(self):
+		#Fiji's islands lie on both sides of 180 degrees
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin([-16.8, -17.2, -16.5], [179.8, -179.9, 178.4])
+		self.assertAlmostEqual(center_lon, 179.25)
+		self.assertAlmostEqual(lon_axis[1] - lon_axis[0], 1.7 + 2 * 1.7 * MAP_PADDING)
+		self.assertGreater(mapbox_zoom(lat_axis, lon_axis), 6)
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin([-16.8, -17.2], [-179.2, 179.9])
+		self.assertAlmostEqual(center_lon, -179.65)
+		#the short way round across 0 degrees is unchanged
+		(center_lat, center_lon, lat_axis, lon_axis) = getmaxmin([51.5, 48.9], [-0.1, 2.35])
+		self.assertAlmostEqual(center_lon, 1.125)
+		self.assertAlmostEqual(lon_axis[0], -0.1 - 2.6 * MAP_PADDING)
+
+
+class TestRecordBatch(unittest.TestCase):
+
+	def test_batch(self):
+		batch = FlickrPhotoBatch()
+		batch.append('Diag', 42.2790304, -83.7376361, 1, '123', '456', 'abc', 1, 'Michigan League')
+		batch.append('Fountain', 42.2790304, None, 1, '123', '789', 'def', 1, 'Michigan League')
+		self.assertEqual(len(batch), 2)
+		self.assertIsInstance(batch[0], FlickrPhoto)
+		self.assertEqual(batch[0].lat, 42.2790304)
+		self.assertEqual(batch.values('url')[1], str(batch[1]))
+		self.assertTrue(np.isnan(batch.column('lon')[1]))
+		self.assertEqual(record_rows(batch, ['id', 'secret']), record_rows(list(batch), ['id', 'secret']))
+		with self.assertRaises(AttributeError):
+			batch[0].extra = 1
+
+class TestStreaming(unittest.TestCase):
+
+	def test_array_stream(self):
+		body = 'jsonFlickrApi({"photos":{"page":1,"photo":[{"id":"1","title":"a ] \\" }"},{"id":"2","title":"\u00e9"}]},"stat":"ok"})'
+		for size in [1, 7, len(body)]:
+			parser = JsonArrayStream(['photos', 'photo'])
+			records = []
+			for ct in range(0, len(body), size):
+				records.extend(parser.feed(body[ct:ct + size].encode('utf-8')))
+			envelope = parser.close()
+			self.assertEqual([ea['id'] for ea in records], ['1', '2'])
+			self.assertEqual(records[0]['title'], 'a ] " }')
+			self.assertEqual(envelope['stat'], 'ok')
+		for size in [1, 5, len(body)]:
+			chunks = [body[ct:ct + size].encode('utf-8') for ct in range(0, len(body), size)]
+			self.assertEqual(json.loads(b''.join(strip_jsonp(iter(chunks))).decode('utf-8'))['stat'], 'ok')
+		self.assertEqual(b''.join(strip_jsonp([b'', b'{"a": 1}', b'\n'])), b'{"a": 1}\n')
+
+	def test_stream_to_cache(self):
+		layer = use_temp_cache(self)
+		body = 'jsonFlickrApi({"photos":{"page":1,"pages":1,"photo":[' + ','.join('{"id":"%d"}' % ct for ct in range(2000)) + ']},"stat":"ok"})'
+		HTTP_SESSIONS['flickr'] = FixtureSession(tempfile.mkdtemp(), latency=0)
+		self.addCleanup(HTTP_SESSIONS.pop, 'flickr')
+		(url, params, headers) = flickr_request(42.2808, -83.743)
+		write_fixture(url, params, 200, {}, body, HTTP_SESSIONS['flickr'].fixture_dir)
+		stream = ResponseStream(url, params, headers)
+		self.assertEqual(len(list(stream)), 2000)
+		self.assertEqual(stream.envelope['stat'], 'ok')
+		self.assertEqual(len(layer.get(cache_key(url, params))['photos']['photo']), 2000)
+
+
+class TestPagination(unittest.TestCase):
+
+	def test_yelp_pages(self):
+		requested = []
+		def fetch(request):
+			(url, params, headers) = request
+			requested.append((params.get('offset', 0), params.get('limit', 20)))
+			start = params.get('offset', 0)
+			return {'businesses': [{'id': ct} for ct in range(start, start + params.get('limit', 20))], 'total': 95}
+		pages = list(iter_pages(yelp_request(42.28, -83.74), yelp_next_page, fetch=fetch))
+		self.assertEqual([len(ea) for ea in pages], [20, 50, 25])
+		self.assertEqual(requested, [(0, 20), (20, 50), (70, 25)])
+		self.assertEqual(len(list(iter_pages(yelp_request(42.28, -83.74), yelp_next_page, max_pages=2, fetch=fetch))), 2)
+
+	def test_google_and_flickr_pages(self):
+		data = {'results': [{'name': 'a'}], 'next_page_token': 'abc'}
+		(url, params, headers) = google_next_page(google_request('Michigan League'), data, 1)
+		self.assertEqual((params['pagetoken'], params['page']), ('abc', 2))
+		self.assertEqual(google_next_page((url, params, headers), {'next_page_token': 'def'}, 2)[1]['page'], 3)
+		self.assertIsNone(google_next_page((url, params, headers), {'results': []}, 1))
+		data = {'photos': {'page': 2, 'pages': '3', 'photo': []}}
+		self.assertEqual(flickr_next_page(flickr_request(42.28, -83.74), data, 200)[1]['page'], 3)
+		data['photos']['page'] = 3
+		self.assertIsNone(flickr_next_page(flickr_request(42.28, -83.74), data, 300))
+
+	def test_google_page_cache_key(self):
+		use_temp_cache(self)
+		session = TestHttp.FakeSession([200] * 2, '{"results": [{"name": "b"}], "status": "OK"}')
+		HTTP_SESSIONS['google'] = session
+		self.addCleanup(HTTP_SESSIONS.pop, 'google')
+		first = google_request('Michigan League')
+		for token in ['abc', 'def']: # a replayed search gets a new token for the same page
+			request = google_next_page(first, {'next_page_token': token}, 1)
+			self.assertEqual(fetch_page(request)['results'], [{'name': 'b'}])
+		self.assertEqual(session.calls, 1)
+		self.assertEqual(sorted(session.params), ['key', 'pagetoken'])
+
+	def test_google_page_not_ready(self):
+		use_temp_cache(self)
+		session = TestHttp.FakeSession([200] * GOOGLE_PAGETOKEN_RETRIES, '{"results": [], "status": "INVALID_REQUEST"}')
+		HTTP_SESSIONS['google'] = session
+		self.addCleanup(HTTP_SESSIONS.pop, 'google')
+		sleeps = []
+		self.addCleanup(setattr, time, 'sleep', time.sleep)
+		time.sleep = sleeps.append
+		request = google_next_page(google_request('Michigan League'), {'next_page_token': 'abc'}, 1)
+		self.assertEqual(fetch_page(request)['status'], 'INVALID_REQUEST')
+		self.assertEqual(session.calls, GOOGLE_PAGETOKEN_RETRIES)
+		self.assertEqual(sleeps.count(GOOGLE_PAGETOKEN_DELAY), GOOGLE_PAGETOKEN_RETRIES - 1) #none after the last attempt
+
+
+class TestIngest(unittest.TestCase):
+
+	def test_stages(self):
+		def work(item):
+			if item[0] == 'bad':
+				raise ValueError(item[0])
+			return (item[0].upper(), )
+		queues = [queue.Queue(2) for ct in range(3)]
+		results = []
+		stages = [IngestStage('upper', work, queues[0], queues[1], 3),
+			IngestStage('collect', lambda item: results.append(item[0]), queues[1], None, 1)]
+		for stage in stages:
+			stage.start()
+		for term in ['a', 'bad', 'b', 'c']:
+			queues[0].put((term, ))
+		queues[0].put(INGEST_STOP)
+		for stage in stages:
+			stage.join()
+		self.assertEqual(sorted(results), ['A', 'B', 'C'])
+		self.assertEqual((stages[0].items, stages[0].failed), (4, 1))
+
+	def test_checkpoint_resume(self):
+		tmp = tempfile.mkdtemp()
+		checkpoint = os.path.join(tmp, 'checkpoint.txt')
+		with open(checkpoint, 'w') as f:
+			f.write('Michigan League\nLake Tahoe\n')
+		reports = ingest(['Lake Tahoe', 'Michigan League'], os.path.join(tmp, 'test.db'), checkpoint, offline=True)
+		self.assertEqual([ea['items'] for ea in reports], [0, 0, 0, 0])
+
+	#Caches one response per provider for 'Michigan League'; returns the keys
+	def cache_league(self, layer):
+		(lat, lon) = (42.2790304, -83.7376361)
+		layer[cache_key(*google_request('Michigan League')[:2])] = {'status': 'OK', 'results': [
+			{'name': 'Michigan League', 'geometry': {'location': {'lat': lat, 'lng': lon}}, 'rating': 4.5}]}
+		layer[cache_key(*yelp_request(lat, lon)[:2])] = {'total': 1, 'businesses': [
+			{'name': 'Frita Batidos', 'coordinates': {'latitude': 42.2803651, 'longitude': -83.7491532}, 'rating': 4.0,
+			'review_count': 100, 'price': '$$', 'url': 'https://www.yelp.com/biz/frita-batidos'}]}
+		layer[cache_key(*flickr_request(lat, lon)[:2])] = {'stat': 'ok', 'photos': {'page': 1, 'pages': 1, 'photo': [
+			{'id': '1', 'farm': 1, 'server': '2', 'secret': 'abc', 'title': 'League'}]}}
+		return [cache_key(*google_request('Michigan League')[:2]), cache_key(*yelp_request(lat, lon)[:2]),
+			cache_key(*flickr_request(lat, lon)[:2])]
+
+	def test_offline_replay(self):
+		layer = use_temp_cache(self)
+		(lat, lon) = (42.2790304, -83.7376361)
+		self.cache_league(layer)
+		tmp = tempfile.mkdtemp()
+		db_name = os.path.join(tmp, 'test.db')
+		reports = ingest(['Michigan League', 'Not cached'], db_name, os.path.join(tmp, 'checkpoint.txt'), offline=True)
+		self.assertEqual([(ea['items'], ea['failed']) for ea in reports], [(2, 1), (1, 0), (1, 0), (1, 0)])
+		self.assertEqual(read_checkpoint(os.path.join(tmp, 'checkpoint.txt')), set(['Michigan League']))
+		conn = sqlite3.connect(db_name)
+		self.assertEqual(conn.execute('SELECT Name, Latitude, Longitude, Rating FROM GooglePlaces').fetchall(),
+			[('Michigan League', lat, lon, 4.5)])
+		self.assertEqual(conn.execute('SELECT SearchName, Name, ReviewCount, Price FROM YelpPlaces').fetchall(),
+			[('Michigan League', 'Frita Batidos', 100, '$$')])
+		self.assertEqual(conn.execute('SELECT SearchName, Title, URL FROM FlickrImages').fetchall(),
+			[('Michigan League', 'League', 'https://farm1.staticflickr.com/2/1_abc_h.jpg')])
+		conn.close()
+
+	def test_offline_replay_expired(self):
+		layer = use_temp_cache(self)
+		keys = self.cache_league(layer)
+		for key in keys:
+			(offset, length, created) = layer.store.index[key]
+			layer.store.index[key] = (offset, length, created - CACHE_TTLS[provider_for_key(key)] - 1)
+		tmp = tempfile.mkdtemp()
+		db_name = os.path.join(tmp, 'test.db')
+		reports = ingest(['Michigan League'], db_name, os.path.join(tmp, 'checkpoint.txt'), offline=True)
+		self.assertEqual([(ea['items'], ea['failed']) for ea in reports], [(1, 0)] * 4)
+		self.assertEqual([key in layer.store.index for key in keys], [True] * 3)
+		self.assertEqual(layer.stats['yelp']['expired'], 1)
+		conn = sqlite3.connect(db_name)
+		self.assertEqual(conn.execute('SELECT COUNT(*) FROM YelpPlaces').fetchone()[0], 1)
+		conn.close()
+
+	def test_processes_read_only(self):
+		tmp = tempfile.mkdtemp()
+		cwd = os.getcwd()
+		os.chdir(tmp) # workers open the cache files in the working directory
+		self.addCleanup(os.chdir, cwd)
+		layer = CacheLayer(AppendLogCache())
+		keys = self.cache_league(layer)
+		for key in keys:
+			layer.store.set_raw(key, [json.dumps(layer.store[key]).encode('utf-8')], 0.0) # long expired
+		layer.close()
+		with open(CACHE_INDEX_FNAME) as f:
+			index = f.read()
+		reports = ingest(['Michigan League', 'Not cached'], 'test.db', 'checkpoint.txt', processes=2)
+		self.assertEqual([(ea['stage'], ea['items'], ea['failed']) for ea in reports], [('parse', 2, 1), ('write', 1, 0)])
+		with open(CACHE_INDEX_FNAME) as f:
+			self.assertEqual(f.read(), index)
+
+	def test_processes_cache_only(self):
+		tmp = tempfile.mkdtemp()
+		terms = ['Not cached {}'.format(ct) for ct in range(20)]
+		reports = ingest(terms, os.path.join(tmp, 'test.db'), os.path.join(tmp, 'checkpoint.txt'), processes=2)
+		self.assertEqual([(ea['stage'], ea['items'], ea['failed']) for ea in reports], [('parse', 20, 20), ('write', 0, 0)])
+		self.assertEqual(read_checkpoint(os.path.join(tmp, 'checkpoint.txt')), set())
+
+
+class TestRatingsSummary(unittest.TestCase):
+
+	def test_summary(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		insert_google_data([GooglePlace('Michigan League', 42.2790304, -83.7376361, 4.5), GooglePlace('Lake Tahoe', 39.1, -120.0, 4.8)], db_name)
+		yelpplaces = [YelpPlace('Frita Batidos', 42.2803651, -83.7491532, 4.0, 100, '$$', 'Michigan League', ''),
+			YelpPlace('Zingermans', 42.2846, -83.7452, 4.5, 300, '$$', 'Michigan League', ''),
+			YelpPlace('Blimpy Burger', 42.2806, -83.7436, 3.0, 100, 'None', 'Michigan League', ''),
+			YelpPlace('Lakeside', 39.1, -120.0, 5.0, 10, '$', 'Lake Tahoe', '')]
+		insert_yelp_data(yelpplaces, db_name)
+		yelpplaces[2].rating = 4.0 # an upsert moves the aggregates with it
+		insert_yelp_data(yelpplaces[2:3], db_name)
+
+		summary = ratings_summary('Michigan League', db_name)
+		self.assertEqual(summary.places, 3)
+		self.assertAlmostEqual(summary.average, 12.5 / 3)
+		self.assertAlmostEqual(summary.weighted, (400 + 1350 + 400) / 500.0)
+		self.assertEqual(summary.prices, {'$': 0, '$$': 2, '$$$': 0, '$$$$': 0, 'None': 1})
+		self.assertEqual([ea.searchterm for ea in compare_ratings(['Michigan League', 'Lake Tahoe', 'Nowhere'], db_name)], ['Lake Tahoe', 'Michigan League'])
+		self.assertIsNone(ratings_summary('Nowhere', db_name))
+		(places, averages) = ratings_figure('Michigan League', db_name)['data']
+		self.assertEqual(sorted(places['x']), [4.0, 4.0, 4.5])
+		self.assertEqual(list(averages['x']), [summary.average, summary.weighted])
+
+
+class TestFigures(unittest.TestCase):
+
+	def test_figure_cache_key(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		insert_google_data([GooglePlace('Michigan League', 42.2790304, -83.7376361, 4.5)], db_name)
+		insert_yelp_data([YelpPlace('Zingermans', 42.2846, -83.7452, 4.5, 200, '$$', 'Michigan League', '')], db_name)
+		fig = ratings_figure('Michigan League', db_name)
+		path = figure_path(fig, 'Nearby Ratings Michigan League')
+		self.assertTrue(path.startswith(os.path.join(FIGURE_DIR, 'nearby-ratings-michigan-league-')))
+		self.assertEqual(path, figure_path(ratings_figure('Michigan League', db_name), 'Nearby Ratings Michigan League'))
+		insert_yelp_data([YelpPlace('Frita Batidos', 42.2803651, -83.7491532, 4.0, 100, '$$', 'Michigan League', '')], db_name)
+		self.assertNotEqual(path, figure_path(ratings_figure('Michigan League', db_name), 'Nearby Ratings Michigan League'))
+		self.assertEqual(len(mapbox_figure('Michigan League', 42.2790304, -83.7376361, db_name)['data']), 2)
+
+	def test_render_offline(self):
+		figure_dir = tempfile.mkdtemp()
+		(saved, final.FIGURE_DIR) = (final.FIGURE_DIR, figure_dir)
+		self.addCleanup(setattr, final, 'FIGURE_DIR', saved)
+		fig = {'data': [{'type': 'bar', 'x': ['Zingermans'], 'y': [4.5]}], 'layout': {'title': 'Nearby Ratings'}}
+		path = render_figure(fig, 'Nearby Ratings', auto_open=False)
+		self.assertTrue(os.path.exists(path))
+		self.assertEqual(os.listdir(figure_dir), [os.path.basename(path)])
+		self.assertEqual(render_figure(fig, 'Nearby Ratings', auto_open=False), path)
+
+class TestServer(unittest.TestCase):
+
+	def test_endpoints(self):
+		from final_server import QueryServer
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		insert_google_data([GooglePlace('Lake Tahoe', 39.09, -120.03, 4.5)], db_name)
+		insert_yelp_data([YelpPlace('Beach', 39.1, -120.0, 4.0, 10, '$', 'Lake Tahoe', 'https://www.yelp.com/biz/beach')], db_name)
+		server = QueryServer(db_name, fetch=False)
+		loop = asyncio.new_event_loop()
+		port = loop.run_until_complete(server.start('127.0.0.1', 0))
+		thread = threading.Thread(target=loop.run_forever)
+		thread.start()
+		try:
+			base = 'http://127.0.0.1:{}'.format(port)
+			resp = requests.get(base + '/places/Lake%20Tahoe/nearby')
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json()['places'][0]['name'], 'Beach')
+			etag = resp.headers['ETag']
+			self.assertEqual(requests.get(base + '/places/Lake%20Tahoe/nearby', headers={'If-None-Match': etag}).status_code, 304)
+			self.assertEqual(requests.get(base + '/places/Lake%20Tahoe/ratings').json()['average'], 4.0)
+			self.assertEqual(requests.get(base + '/places/Nowhere/photos').status_code, 404)
+			self.assertEqual(requests.get(base + '/search?q=Nowhere').json()['places'], [])
+			insert_yelp_data([YelpPlace('Pier', 39.1, -120.0, 5.0, 30, '$$', 'Lake Tahoe', 'https://www.yelp.com/biz/pier')], db_name)
+			resp = requests.get(base + '/places/Lake%20Tahoe/nearby', headers={'If-None-Match': etag})
+			self.assertEqual((resp.status_code, len(resp.json()['places'])), (200, 2))
+			for ct in range(3): # writes in quick succession, within one file time tick
+				insert_yelp_data([YelpPlace('Dock {}'.format(ct), 39.1, -120.0, 3.0, 5, '$', 'Lake Tahoe', '')], db_name)
+				self.assertEqual(len(requests.get(base + '/places/Lake%20Tahoe/nearby').json()['places']), 3 + ct)
+			conn = sqlite3.connect(db_name)
+			conn.execute('PRAGMA wal_checkpoint(RESTART)') # the next write reuses the start of the WAL: its size is unchanged
+			requests.get(base + '/places/Lake%20Tahoe/nearby')
+			fnames = [db_name, db_name + '-wal']
+			times = [os.stat(fname).st_mtime_ns for fname in fnames]
+			conn.execute("UPDATE YelpPlaces SET Rating = 1.0 WHERE Name = 'Beach'")
+			conn.commit()
+			for (fname, ns) in zip(fnames, times): # as if written within one tick of a coarse file clock
+				os.utime(fname, ns=(ns, ns))
+			places = requests.get(base + '/places/Lake%20Tahoe/nearby').json()['places']
+			self.assertEqual([ea['rating'] for ea in places if ea['name'] == 'Beach'], [1.0])
+			conn.close()
+		finally:
+			asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+			loop.call_soon_threadsafe(loop.stop)
+			thread.join()
+			loop.close()
+			server.close()
+
+	def test_search_off_readers(self):
+		import final_server
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		insert_google_data([GooglePlace('Lake Tahoe', 39.09, -120.03, 4.5)], db_name)
+		release = threading.Event()
+		def search(searchterm, db_name=DBNAME): # a new search still waiting on the network
+			release.wait(10)
+			return [GooglePlace(searchterm, 1.0, 2.0, 3.0)] if db_name == server.db_name else []
+		(saved, final_server.user_search) = (final_server.user_search, search)
+		self.addCleanup(setattr, final_server, 'user_search', saved)
+		server = final_server.QueryServer(db_name, threads=1)
+		loop = asyncio.new_event_loop()
+		port = loop.run_until_complete(server.start('127.0.0.1', 0))
+		thread = threading.Thread(target=loop.run_forever)
+		thread.start()
+		try:
+			base = 'http://127.0.0.1:{}'.format(port)
+			with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+				searching = executor.submit(requests.get, base + '/search?q=Nowhere')
+				time.sleep(0.2)
+				resp = requests.get(base + '/places/Lake%20Tahoe', timeout=5) # the only reader is free
+				self.assertEqual(resp.json()['name'], 'Lake Tahoe')
+				self.assertFalse(searching.done())
+				release.set()
+				self.assertEqual(searching.result().json()['places'][0]['name'], 'Nowhere')
+		finally:
+			release.set()
+			asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+			loop.call_soon_threadsafe(loop.stop)
+			thread.join()
+			loop.close()
+			server.close()
+
+class TestBench(unittest.TestCase):
+
+	def report(self, calls, per_sec, p50_ms, p99_ms):
+		return {'calls': calls, 'per_sec': per_sec, 'p50_ms': p50_ms, 'p99_ms': p99_ms}
+
+	def test_regression_flagged(self):
+		from final_bench import baseline, regressions
+		runs = [{'insert': self.report(500, 100, 9.0 + ct, 20.0)} for ct in range(3)]
+		previous = baseline(runs)
+		self.assertEqual(previous['insert']['p50_ms'], 10.0)
+		flags = regressions({'insert': self.report(500, 40, 25.0, 60.0)}, previous)
+		self.assertEqual(flags, {'insert': ['throughput', 'p50', 'p99']})
+
+	def test_small_stage_noise(self):
+		from final_bench import baseline, regressions
+		previous = baseline([{'cached': self.report(50, 20000, 0.05, 0.1)}])
+		#four times slower, but by a fraction of a millisecond, and p99 of 50 calls is just the slowest one
+		self.assertEqual(regressions({'cached': self.report(50, 5000, 0.2, 1.5)}, previous), {})
+		self.assertEqual(regressions({'parse': self.report(50, 10, 100.0, 200.0)}, previous), {})
+
+
+class TestSampling(unittest.TestCase):
+
+	def test_sample_rows(self):
+		conn = sqlite3.connect(':memory:')
+		conn.execute('CREATE TABLE Photos (Id INTEGER PRIMARY KEY, SearchName TEXT, Title TEXT)')
+		conn.executemany('INSERT INTO Photos (SearchName, Title) VALUES (?,?)', [('P{}'.format(ct % 3), 't{}'.format(ct)) for ct in range(3000)])
+		conn.execute('DELETE FROM Photos WHERE Id % 7 = 0')
+		rows = sample_rows(conn, 'Photos', ['Title'], 50)
+		self.assertEqual(len(set(rows)), 50)
+		conn.execute('DELETE FROM Photos WHERE Id > 12')
+		self.assertEqual(sorted(sample_rows(conn, 'Photos', ['Id'], 100)), [(1,), (2,), (3,), (4,), (5,), (6,), (8,), (9,), (10,), (11,), (12,)])
+		conn.execute('DELETE FROM Photos WHERE Id BETWEEN 2 AND 11')
+		conn.execute("INSERT INTO Photos (Id, SearchName, Title) VALUES (5000, 'P1', 'last')")
+		self.assertEqual(sorted(sample_rows(conn, 'Photos', ['Id'], 3)), [(1,), (12,), (5000,)]) #mostly gaps
+		conn.close()
+
+	def test_sample_key_rows(self):
+		conn = sqlite3.connect(':memory:')
+		conn.execute('CREATE TABLE Photos (Id INTEGER PRIMARY KEY, SearchName TEXT, Ordinal INTEGER, Title TEXT)')
+		conn.execute('CREATE INDEX PhotosSearchNameOrdinal ON Photos (SearchName, Ordinal)')
+		conn.executemany('INSERT INTO Photos (SearchName, Ordinal, Title) VALUES (?,?,?)',
+			[('P1', ct // 2, 't{}'.format(ct)) if ct % 2 == 0 else ('P2', ct // 2, 't{}'.format(ct)) for ct in range(60)])
+		rnd = random.Random(25)
+		seen = collections.Counter()
+		for ct in range(3000):
+			rows = sample_key_rows(conn, 'Photos', ['SearchName', 'Title'], 2, 'SearchName', 'P1', 'Ordinal', 30, rnd)
+			self.assertEqual(len(set(rows)), 2)
+			self.assertEqual(set(ea[0] for ea in rows), set(['P1']))
+			seen.update(ea[1] for ea in rows)
+		self.assertEqual(len(seen), 30)
+		self.assertGreater(min(seen.values()), 120) # 200 each if uniform
+		self.assertLess(max(seen.values()), 280)
+		self.assertEqual(len(sample_key_rows(conn, 'Photos', ['Title'], 50, 'SearchName', 'P1', 'Ordinal', 30)), 30)
+		conn.close()
+
+	def test_sample_key_plan(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		init_db(db_name)
+		conn = sqlite3.connect(db_name)
+		select = ordinal_select('FlickrImages', ['Title', 'SearchName', 'URL'], 'SearchName', 'Ordinal')
+		plan = ' '.join(ea[-1] for ea in conn.execute('EXPLAIN QUERY PLAN ' + select, ['Lake Tahoe', 0]))
+		self.assertIn('USING INDEX FlickrImagesSearchNameOrdinal (SearchName=? AND Ordinal=?)', plan)
+		self.assertNotIn('TEMP B-TREE', plan)
+		conn.close()
+
+	def test_photo_counts(self):
+		db_name = os.path.join(tempfile.mkdtemp(), 'test.db')
+		migrate_db(db_name, 7)
+		conn = sqlite3.connect(db_name)
+		insert = "INSERT INTO FlickrImages (SearchName, Title, PhotoId, URL) VALUES (?,?,?,?) ON CONFLICT (SearchName, PhotoId) DO UPDATE SET Title = excluded.Title"
+		conn.executemany(insert, [('Lake Tahoe', 't{}'.format(ct), str(ct), 'u{}'.format(ct)) for ct in range(30)] + [('Michigan League', 'm', '1', 'm')])
+		conn.commit()
+		init_db(db_name) # numbers the photos already there
+		conn.executemany(insert, [('Lake Tahoe', 't{}'.format(ct), str(ct), 'u{}'.format(ct)) for ct in range(30, 40)])
+		conn.executemany(insert, [('Lake Tahoe', 'new', str(ct), 'u') for ct in range(5)]) # upserts leave the count alone
+		conn.execute("UPDATE FlickrImages SET SearchName = 'Michigan League' WHERE PhotoId = '39'")
+		conn.execute("DELETE FROM FlickrImages WHERE PhotoId = '38'")
+		conn.commit()
+		conn.execute("DELETE FROM FlickrImages WHERE PhotoId IN ('3', '30', '31', '37')") # several rows, the last one among them
+		conn.execute("INSERT INTO FlickrImages (SearchName, Title, PhotoId) VALUES ('Lake Tahoe', 'late', '99')")
+		conn.commit()
+		self.assertEqual(conn.execute('SELECT SearchName, Photos FROM FlickrCounts ORDER BY SearchName').fetchall(),
+			[('Lake Tahoe', 35), ('Michigan League', 2)])
+		for (searchname, photos) in conn.execute('SELECT SearchName, Photos FROM FlickrCounts').fetchall():
+			ordinals = conn.execute('SELECT Ordinal FROM FlickrImages WHERE SearchName = ? ORDER BY Ordinal', [searchname]).fetchall()
+			self.assertEqual([ea[0] for ea in ordinals], list(range(photos)))
+		conn.close()
+		photos = getrandomphotos_fromdb('Lake Tahoe', 10, db_name)
+		self.assertEqual(len(set(ea[2] for ea in photos)), 10)
+		self.assertEqual(set(ea[1] for ea in photos), set(['Lake Tahoe']))
+		self.assertEqual(getrandomphotos_fromdb('Nowhere', 10, db_name), [])
+
+class TestInstrumentation(unittest.TestCase):
+
+	def test_measure(self):
+		fname = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+		for ct in range(2):
+			with measure('search', fname=fname, searchterm='Lake Tahoe'):
+				with timed_stage('http.yelp'):
+					time.sleep(0.02)
+				with timed_stage('http.yelp'):
+					pass
+				count_event('cache.miss')
+		with open(fname) as f:
+			records = [json.loads(line) for line in f]
+		self.assertEqual(len(records), 2)
+		self.assertEqual(records[0]['searchterm'], 'Lake Tahoe')
+		self.assertEqual(records[0]['stages']['http.yelp']['calls'], 2)
+		self.assertGreaterEqual(records[0]['stages']['http.yelp']['seconds'], 0.02)
+		self.assertGreaterEqual(records[0]['wall'], records[0]['stages']['http.yelp']['seconds'])
+		totals = aggregate_metrics(fname)
+		self.assertEqual((totals['runs'], totals['stages']['http.yelp']['calls'], totals['counters']['cache.miss']), (2, 4, 2))
+		self.assertIsNone(aggregate_metrics(fname, 'display'))
+
+	def test_measure_off(self):
+		fname = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+		STAGE_METRICS.reset()
+		count_event('cache.miss')
+		self.addCleanup(setattr, final, 'METRICS', True)
+		final.METRICS = False
+		with measure('search', fname=fname, searchterm='Lake Tahoe'):
+			count_event('cache.miss')
+		self.assertFalse(os.path.exists(fname))
+		self.assertEqual(STAGE_METRICS.snapshot()[1]['cache.miss'], 1) # not reset either
+
+	def test_stage_hook(self):
+		seen = []
+		STAGE_HOOKS.append(lambda stage, seconds: seen.append(stage))
+		try:
+			with timed_stage('render.offline'):
+				pass
+		finally:
+			STAGE_HOOKS.pop()
+		self.assertEqual(seen, ['render.offline'])
+
+
+
+
+if __name__ == "__main__": #spawned ingest workers import this file as __mp_main__
+	unittest.main()